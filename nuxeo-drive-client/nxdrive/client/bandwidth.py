@@ -0,0 +1,148 @@
+# coding: utf-8
+""" Bandwidth shaping of the uploads and downloads. """
+
+import re
+import time
+from datetime import datetime
+from threading import Lock
+
+from nxdrive.logging_config import get_logger
+
+log = get_logger(__name__)
+
+# Seconds of transfer at full rate allowed in a burst
+BURST = 1
+# Longest sleep in seconds between two checks of the suspension of a transfer
+MAX_SLEEP = 0.5
+# Seconds over which the achieved throughput is measured
+THROUGHPUT_WINDOW = 5
+
+SCHEDULE_PATTERN = re.compile(r'^(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})=(\d+)$')
+
+
+def parse_schedule(schedule):
+    """
+    Parse time-of-day rates, like ['08:00-18:00=128', '18:00-08:00=0'],
+    into (start minute, end minute, bytes per second) tuples.
+    Rates are in KiB/s, 0 for unlimited.
+    """
+
+    slots = []
+    for spec in schedule or ():
+        match = SCHEDULE_PATTERN.match(spec.strip())
+        if not match:
+            raise ValueError('Invalid bandwidth schedule %r, expected'
+                             ' HH:MM-HH:MM=KiB/s' % spec)
+        start_h, start_m, end_h, end_m, rate = map(int, match.groups())
+        if start_h > 23 or end_h > 24 or start_m > 59 or end_m > 59:
+            raise ValueError('Invalid bandwidth schedule %r' % spec)
+        slots.append((start_h * 60 + start_m, end_h * 60 + end_m, rate * 1024))
+    return slots
+
+
+class RateLimiter(object):
+    """
+    Token bucket limiting the rate of a transfer direction, in bytes per
+    second, None or 0 meaning unlimited.
+
+    Transfers take their chunk size from the bucket, which may go into
+    debt, and then sleep for the time needed to pay it back: the rate is
+    enforced over the chunks, whatever their size.
+    A limiter with a parent, an engine one with the global one of the
+    Manager, also waits for its parent.
+    """
+
+    def __init__(self, rate=None, schedule=None, parent=None):
+        self._lock = Lock()
+        self.parent = parent
+        self._rate = None
+        self._schedule = []
+        self._tokens = 0
+        self._last = time.time()
+        self._window_start = self._last
+        self._window_bytes = 0
+        self._throughput = 0
+        self._bytes = 0
+        self.configure(rate, schedule)
+
+    def configure(self, rate=None, schedule=None):
+        """ Set the rate in bytes per second and the time-of-day rates. """
+        slots = parse_schedule(schedule)
+        with self._lock:
+            self._rate = rate or None
+            self._schedule = slots
+
+    def get_rate(self, now=None):
+        """ Rate in bytes per second at `now`, None if unlimited. """
+        if self._schedule:
+            now = now or datetime.now()
+            minute = now.hour * 60 + now.minute
+            for start, end, rate in self._schedule:
+                if (start <= minute < end
+                        or (end <= start and (minute >= start or minute < end))):
+                    return rate or None
+        return self._rate
+
+    def reserve(self, size, now=None):
+        """
+        Take `size` bytes from the bucket and return the seconds to wait
+        before sending them, parent included.
+        """
+
+        now = time.time() if now is None else now
+        with self._lock:
+            self._measure(size, now)
+            rate = self.get_rate(datetime.fromtimestamp(now))
+            if rate is None:
+                self._tokens = 0
+                wait = 0
+            else:
+                burst = rate * BURST
+                self._tokens = min(burst, self._tokens + (now - self._last) * rate)
+                self._tokens -= size
+                wait = -self._tokens / rate if self._tokens < 0 else 0
+            self._last = now
+        if self.parent is not None:
+            wait = max(wait, self.parent.reserve(size, now=now))
+        return wait
+
+    def consume(self, size, check=None):
+        """
+        Wait until `size` bytes can be sent, calling `check` regularly
+        so that the transfer can be suspended meanwhile.
+        """
+
+        wait = self.reserve(size)
+        while wait > 0:
+            if check is not None:
+                check()
+            time.sleep(min(wait, MAX_SLEEP))
+            wait -= MAX_SLEEP
+
+    def _measure(self, size, now):
+        self._bytes += size
+        elapsed = now - self._window_start
+        if elapsed >= THROUGHPUT_WINDOW:
+            self._throughput = self._window_bytes / elapsed
+            self._window_start = now
+            self._window_bytes = 0
+        self._window_bytes += size
+
+    def get_throughput(self, now=None):
+        """ Bytes per second transferred over the last complete window. """
+        now = time.time() if now is None else now
+        with self._lock:
+            elapsed = now - self._window_start
+            if elapsed >= 2 * THROUGHPUT_WINDOW:
+                # Nothing transferred since the last window
+                return 0
+            if elapsed >= THROUGHPUT_WINDOW:
+                return self._window_bytes / elapsed
+            return self._throughput
+
+    def get_metrics(self, prefix):
+        return {
+            prefix + '_rate': self.get_rate() or 0,
+            prefix + '_throughput': int(self.get_throughput()),
+            prefix + '_bytes': self._bytes,
+        }
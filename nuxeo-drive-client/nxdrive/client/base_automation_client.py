@@ -6,11 +6,14 @@ import hashlib
 import json
 import os
 import random
+import re
 import socket
 import sys
 import tempfile
 import time
 import urllib2
+from Queue import Empty, Queue
+from threading import Event, Thread
 from urllib import urlencode
 from urllib2 import ProxyHandler
 from urlparse import urlparse
@@ -19,6 +22,7 @@ from poster.streaminghttp import get_handlers
 
 from nxdrive.client.common import BaseClient, FILE_BUFFER_SIZE, safe_filename
 from nxdrive.engine.activity import Action, FileAction
+from nxdrive.engine.workers import ThreadInterrupt
 from nxdrive.logging_config import get_logger
 from nxdrive.options import Options
 from nxdrive.utils import TOKEN_PERMISSION, force_decode, get_device, \
@@ -35,6 +39,11 @@ DOWNLOAD_TMP_FILE_SUFFIX = '.nxpart'
 # 1s audit time resolution because of the datetime resolution of MYSQL
 AUDIT_CHANGE_FINDER_TIME_RESOLUTION = 1.0
 
+CONTENT_RANGE = re.compile(r'^\s*bytes\s+(\d+)-\d+/(?:\d+|\*)\s*$')
+
+# Seconds between two checks of the suspension of a chunked upload
+CHUNK_CHECK_INTERVAL = 0.2
+
 socket.setdefaulttimeout(DEFAULT_NUXEO_TX_TIMEOUT)
 
 
@@ -99,6 +108,27 @@ def get_proxy_handler(proxies, proxy_exceptions=None, url=None):
         return urllib2.ProxyHandler(proxies)
 
 
+def encode_chunks(chunks, count):
+    """ Bitmap of the uploaded `chunks` indexes among `count` chunks. """
+    bitmap = bytearray((count + 7) // 8)
+    for index in chunks:
+        bitmap[index // 8] |= 1 << (index % 8)
+    return bytes(bitmap)
+
+
+def decode_chunks(bitmap):
+    """ Set of the uploaded chunks indexes of a bitmap from encode_chunks(). """
+    bitmap = bytearray(bitmap or '')
+    return set(index for index in xrange(len(bitmap) * 8)
+               if bitmap[index // 8] & (1 << (index % 8)))
+
+
+def get_range_start(content_range):
+    """ First byte position of a Content-Range header, None if it is missing or invalid. """
+    match = CONTENT_RANGE.match(content_range or '')
+    return int(match.group(1)) if match else None
+
+
 def get_opener_proxies(opener):
     for handler in opener.handlers:
         if isinstance(handler, ProxyHandler):
@@ -168,6 +198,11 @@ class BaseAutomationClient(BaseClient):
         # Function to check during long-running processing like upload /
         # download if the synchronization thread needs to be suspended
         self.check_suspended = check_suspended
+        # RateLimiter of each transfer direction, set by the engine
+        self.upload_limiter = None
+        self.download_limiter = None
+        # EngineDAO keeping the state of the chunked uploads, set by the engine
+        self.upload_store = None
 
         if timeout is None or timeout < 0:
             timeout = 20
@@ -398,6 +433,8 @@ class BaseAutomationClient(BaseClient):
                         buffer_ = resp.read(FILE_BUFFER_SIZE)
                         if buffer_ == '':
                             break
+                        self._throttle(self.download_limiter, len(buffer_),
+                                       'File download: %s' % file_out)
                         if current_action:
                             current_action.progress += FILE_BUFFER_SIZE
                         f.write(buffer_)
@@ -415,9 +452,16 @@ class BaseAutomationClient(BaseClient):
         """
         tick = time.time()
         action = FileAction("Upload", file_path, filename)
+        chunked = False
         try:
             batch_id = None
-            if self.is_new_upload_api_available():
+            chunks = set()
+            chunked = (self.is_new_upload_api_available()
+                       and os.path.getsize(file_path) > Options.chunk_upload_limit)
+            if chunked:
+                # Resume the interrupted upload of the file, if any
+                batch_id, chunks = self._get_chunked_upload(file_path)
+            if batch_id is None and self.is_new_upload_api_available():
                 try:
                     # Init resumable upload getting a batch id generated by the server
                     # This batch id is to be used as a resumable session id
@@ -425,11 +469,19 @@ class BaseAutomationClient(BaseClient):
                 except NewUploadAPINotAvailable:
                     log.debug('New upload API is not available on server %s', self.server_url)
                     self.new_upload_api_available = False
+                    chunked = False
             if batch_id is None:
                 # New upload API is not available, generate a batch id
                 batch_id = self._generate_unique_id()
-            upload_result = self.upload(batch_id, file_path, filename=filename,
-                                        mime_type=mime_type)
+            if chunked:
+                stat = os.stat(file_path)
+                upload_result = self.upload_chunks(
+                    batch_id, file_path, filename=filename, mime_type=mime_type,
+                    uploaded=chunks, callback=lambda uploaded: self._save_chunked_upload(
+                        file_path, stat, batch_id, uploaded))
+            else:
+                upload_result = self.upload(batch_id, file_path, filename=filename,
+                                            mime_type=mime_type)
             upload_duration = int(time.time() - tick)
             action.transfer_duration = upload_duration
             # Use upload duration * 2 as Nuxeo transaction timeout
@@ -441,20 +493,108 @@ class BaseAutomationClient(BaseClient):
             if upload_duration > 0:
                 log.trace("Speed for %d o is %d s : %f o/s", os.stat(file_path).st_size, upload_duration, os.stat(file_path).st_size / upload_duration)
             # NXDRIVE-433: Compat with 7.4 intermediate state
-            if upload_result.get('uploaded') is None:
+            if not chunked and upload_result.get('uploaded') is None:
                 self.new_upload_api_available = False
             if upload_result.get('batchId') is not None:
                 result = self.execute_batch(command, batch_id, '0', tx_timeout,
                                           **params)
+                if chunked:
+                    self._remove_chunked_upload(file_path)
                 return result
             else:
                 raise ValueError("Bad response from batch upload with id '%s'"
                                  " and file path '%s'" % (batch_id, file_path))
         except InvalidBatchException:
             self.cookie_jar.clear_session_cookies()
+            if chunked:
+                # The batch expired on the server, upload again from scratch
+                self._remove_chunked_upload(file_path)
         finally:
             self.end_action()
 
+    def _get_chunked_upload(self, file_path):
+        """ Batch id and uploaded chunks of the interrupted upload of a file. """
+        if self.upload_store is None:
+            return None, set()
+        upload = self.upload_store.get_upload(file_path)
+        if upload is None:
+            return None, set()
+        stat = os.stat(file_path)
+        if (upload.file_size != stat.st_size or upload.mtime != stat.st_mtime
+                or upload.chunk_size != Options.chunk_upload_size):
+            log.debug('Discarding the outdated chunked upload of %r', file_path)
+            self.upload_store.remove_upload(file_path)
+            return None, set()
+        chunks = decode_chunks(upload.chunks)
+        log.debug('Resuming the upload of %r in batch %s, %d chunks already uploaded',
+                  file_path, upload.batch_id, len(chunks))
+        return upload.batch_id, chunks
+
+    def _save_chunked_upload(self, file_path, stat, batch_id, chunks):
+        if self.upload_store is None:
+            return
+        count = (stat.st_size + Options.chunk_upload_size - 1) // Options.chunk_upload_size
+        self.upload_store.save_upload(file_path, batch_id, stat.st_size, stat.st_mtime,
+                                      Options.chunk_upload_size, encode_chunks(chunks, count))
+
+    def _remove_chunked_upload(self, file_path):
+        if self.upload_store is not None:
+            self.upload_store.remove_upload(file_path)
+
+    def execute_with_blobs_streaming(self, command, files, **params):
+        """Execute an Automation operation on each file of a list, the files
+        being uploaded in a single batch.
+
+        `files` are (file path, filename) tuples. Return the result of the
+        operation or the error for each file, so that the files in error
+        can be retried one by one.
+        Requires the new upload API, raise NewUploadAPINotAvailable otherwise.
+        """
+        if not self.is_new_upload_api_available():
+            raise NewUploadAPINotAvailable()
+        tick = time.time()
+        try:
+            batch_id = self.init_upload()['batchId']
+        except NewUploadAPINotAvailable:
+            log.debug('New upload API is not available on server %s', self.server_url)
+            self.new_upload_api_available = False
+            raise
+        results = [None] * len(files)
+        uploaded = []
+        for file_idx, (file_path, filename) in enumerate(files):
+            try:
+                upload_result = self.upload(batch_id, file_path, filename=filename,
+                                            file_index=file_idx)
+                if upload_result.get('batchId') is None:
+                    raise ValueError("Bad response from batch upload with id '%s'"
+                                     " and file path '%s'" % (batch_id, file_path))
+                uploaded.append(file_idx)
+            except InvalidBatchException as e:
+                # Nothing more can be uploaded to this batch
+                self.cookie_jar.clear_session_cookies()
+                for idx in range(file_idx, len(files)):
+                    results[idx] = e
+                break
+            except (IOError, OSError, ValueError) as e:
+                log.debug('Batch upload of %r failed: %r', file_path, e)
+                results[file_idx] = e
+        upload_duration = int(time.time() - tick)
+        tx_timeout = max(DEFAULT_NUXEO_TX_TIMEOUT, upload_duration * 2)
+        log.trace('Uploaded %d/%d files in batch %s in %ds', len(uploaded),
+                  len(files), batch_id, upload_duration)
+        for count, file_idx in enumerate(uploaded):
+            # The batch is dropped by the server with its last execution
+            drop = count == len(uploaded) - 1
+            try:
+                results[file_idx] = self.execute_batch(
+                    command, batch_id, str(file_idx), tx_timeout, drop=drop,
+                    **params)
+            except (IOError, ValueError) as e:
+                log.debug('Batch execution of %r failed: %r',
+                          files[file_idx][0], e)
+                results[file_idx] = e
+        return results
+
     @staticmethod
     def get_upload_buffer(input_file):
         if sys.platform != 'win32':
@@ -518,22 +658,9 @@ class BaseAutomationClient(BaseClient):
             url = self.automation_url.encode('ascii') + self.batch_upload_url
 
         # HTTP headers
-        if filename is None:
-            filename = os.path.basename(file_path)
-        file_size = os.path.getsize(file_path)
-        if mime_type is None:
-            mime_type = guess_mime_type(filename)
-        # Quote UTF-8 filenames even though JAX-RS does not seem to be able
-        # to retrieve them as per: https://tools.ietf.org/html/rfc5987
-        filename = safe_filename(filename)
-        quoted_filename = urllib2.quote(filename.encode('utf-8'))
-        headers = {
-            "X-File-Name": quoted_filename,
-            "X-File-Size": file_size,
-            "X-File-Type": mime_type,
-            "Content-Type": "application/octet-stream",
-            "Content-Length": file_size,
-        }
+        headers = self._get_upload_headers(file_path, filename=filename,
+                                           mime_type=mime_type)
+        headers['Content-Length'] = headers['X-File-Size']
         if not self.is_new_upload_api_available():
             headers.update({"X-Batch-Id": batch_id, "X-File-Idx": file_index})
         headers.update(self._get_common_headers())
@@ -552,25 +679,178 @@ class BaseAutomationClient(BaseClient):
         try:
             resp = self.streaming_opener.open(req, timeout=self.blob_timeout)
         except Exception as e:
-            log_details = self._log_details(e)
-            if isinstance(log_details, tuple):
-                _, _, _, error = log_details
-                if error and error.startswith("Unable to find batch"):
-                    raise InvalidBatchException()
-            raise e
+            self._raise_upload_error(e)
         finally:
             input_file.close()
         self.end_action()
         return self._read_response(resp, url)
 
+    def upload_chunks(self, batch_id, file_path, filename=None, file_index=0,
+                      mime_type=None, chunk_size=None, uploaded=None,
+                      callback=None):
+        """Upload a file in chunks through a batch of the new upload API
+
+        The chunks already `uploaded`, a set of their indexes, are skipped
+        and `callback` is called with the set of the uploaded chunks after
+        each one, so that an interrupted upload can be resumed in the same
+        batch. Up to Options.chunk_upload_threads chunks are sent at once by
+        threads that are stopped at their next buffer when the calling one
+        is suspended: only the calling thread can be checked by the engine.
+        """
+        if chunk_size is None:
+            chunk_size = Options.chunk_upload_size
+        FileAction("Upload", file_path, filename)
+        url = self.rest_api_url + self.batch_upload_path + '/' + batch_id + '/' + str(file_index)
+        headers = self._get_upload_headers(file_path, filename=filename,
+                                           mime_type=mime_type)
+        file_size = headers['X-File-Size']
+        chunk_count = max(1, (file_size + chunk_size - 1) // chunk_size)
+        headers.update({
+            "X-Upload-Type": "chunked",
+            "X-Upload-Chunk-Count": chunk_count,
+        })
+        uploaded = set(uploaded or ())
+        missing = Queue()
+        for index in xrange(chunk_count):
+            if index not in uploaded:
+                missing.put(index)
+        remaining = missing.qsize()
+        log.trace('Uploading %d/%d chunks of file %s to %s', remaining,
+                  chunk_count, file_path, url)
+        current_action = Action.get_current_action()
+        if current_action is not None:
+            current_action.progress = min(len(uploaded) * chunk_size, file_size)
+        # Every chunk already uploaded, the batch only has to be executed
+        result = {'batchId': batch_id, 'fileIdx': file_index}
+        done = Queue()
+        interrupted = Event()
+
+        def upload_missing():
+            while not interrupted.is_set():
+                try:
+                    index = missing.get_nowait()
+                except Empty:
+                    return
+                try:
+                    done.put((index, self._upload_chunk(
+                        url, headers, file_path, index, chunk_size,
+                        interrupted=interrupted), None))
+                except Exception as e:
+                    done.put((index, None, e))
+                    return
+
+        threads = [Thread(target=upload_missing, name='ChunkUpload-%d' % i)
+                   for i in xrange(min(max(Options.chunk_upload_threads, 1), remaining))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            while remaining:
+                try:
+                    index, response, error = done.get(timeout=CHUNK_CHECK_INTERVAL)
+                except Empty:
+                    if self.check_suspended is not None:
+                        self.check_suspended('File upload: %s' % file_path)
+                    continue
+                remaining -= 1
+                if error is not None:
+                    raise error
+                uploaded.add(index)
+                result = response
+                if callback is not None:
+                    callback(uploaded)
+                if current_action is not None:
+                    current_action.progress = min(len(uploaded) * chunk_size, file_size)
+                # Check if synchronization thread was suspended
+                if remaining and self.check_suspended is not None:
+                    self.check_suspended('File upload: %s' % file_path)
+        finally:
+            # Stop the chunks still running without waiting for them, only
+            # the ones already uploaded are kept to resume the upload
+            interrupted.set()
+            finished = False
+            while True:
+                try:
+                    index, _, error = done.get_nowait()
+                except Empty:
+                    break
+                if error is None:
+                    uploaded.add(index)
+                    finished = True
+            if finished and callback is not None:
+                callback(uploaded)
+        self.end_action()
+        return result
+
+    def _upload_chunk(self, url, headers, file_path, index, chunk_size,
+                      interrupted=None):
+        offset = index * chunk_size
+        size = min(chunk_size, headers['X-File-Size'] - offset)
+        headers = dict(headers)
+        headers.update({
+            "X-Upload-Chunk-Index": index,
+            "Content-Length": size,
+        })
+        headers.update(self._get_common_headers())
+        with open(file_path, 'rb') as input_file:
+            input_file.seek(offset)
+            data = self._read_data(input_file, self.get_upload_buffer(input_file),
+                                   size=size, interrupted=interrupted)
+            log.trace("Calling %s with headers %r for chunk %d of file %s",
+                      url, headers, index, file_path)
+            req = urllib2.Request(url, data, headers)
+            try:
+                resp = self.streaming_opener.open(req, timeout=self.blob_timeout)
+            except urllib2.HTTPError as e:
+                # 308 Resume Incomplete: the file is still missing chunks
+                if e.code != 308:
+                    self._raise_upload_error(e)
+                resp = e
+            except Exception as e:
+                self._raise_upload_error(e)
+        return self._read_response(resp, url)
+
+    def _raise_upload_error(self, e):
+        log_details = self._log_details(e)
+        if isinstance(log_details, tuple):
+            _, _, _, error = log_details
+            if error and error.startswith("Unable to find batch"):
+                raise InvalidBatchException()
+        raise e
+
+    @staticmethod
+    def _get_upload_headers(file_path, filename=None, mime_type=None):
+        if filename is None:
+            filename = os.path.basename(file_path)
+        file_size = os.path.getsize(file_path)
+        if mime_type is None:
+            mime_type = guess_mime_type(filename)
+        # Quote UTF-8 filenames even though JAX-RS does not seem to be able
+        # to retrieve them as per: https://tools.ietf.org/html/rfc5987
+        filename = safe_filename(filename)
+        quoted_filename = urllib2.quote(filename.encode('utf-8'))
+        return {
+            "X-File-Name": quoted_filename,
+            "X-File-Size": file_size,
+            "X-File-Type": mime_type,
+            "Content-Type": "application/octet-stream",
+        }
+
     @staticmethod
     def end_action():
         Action.finish_action()
 
-    def execute_batch(self, op_id, batch_id, file_idx, tx_timeout, **params):
-        """Execute a file upload Automation batch"""
+    def execute_batch(self, op_id, batch_id, file_idx, tx_timeout, drop=True,
+                      **params):
+        """Execute a file upload Automation batch
+
+        Keep the batch on the server with drop=False, to execute the
+        operation on its other files.
+        """
         extra_headers = {'Nuxeo-Transaction-Timeout': tx_timeout, }
         if self.is_new_upload_api_available():
+            if not drop:
+                extra_headers['X-Batch-No-Drop'] = 'true'
             url = (self.rest_api_url + self.batch_upload_path + '/' + batch_id + '/' + file_idx
                    + '/execute/' + op_id)
             return self.execute(None, url=url, timeout=tx_timeout,
@@ -796,22 +1076,58 @@ class BaseAutomationClient(BaseClient):
 
         return str(time.time()) + '_' + str(random.randint(0, 1000000000))
 
-    def _read_data(self, file_object, buffer_size):
+    def _read_data(self, file_object, buffer_size, size=None, interrupted=None):
+        """
+        Yield the content of `file_object`, up to `size` bytes.
+        A thread reading for another one stops when the `interrupted` Event
+        is set, instead of checking its own suspension.
+        """
+
+        check_suspended = self.check_suspended
+        if interrupted is not None:
+            def check_suspended(_):
+                if interrupted.is_set():
+                    raise ThreadInterrupt()
         while True:
             current_action = Action.get_current_action()
             if current_action is not None and current_action.suspend:
                 break
             # Check if synchronization thread was suspended
-            if self.check_suspended is not None:
-                self.check_suspended('File upload: %s' % file_object.name)
+            if check_suspended is not None:
+                check_suspended('File upload: %s' % file_object.name)
+            if size is not None:
+                # Only read the `size` next bytes, for a chunk
+                buffer_size = min(buffer_size, size)
             r = file_object.read(buffer_size)
             if not r:
                 break
+            if size is not None:
+                size -= len(r)
+            self._throttle(self.upload_limiter, len(r),
+                           'File upload: %s' % file_object.name,
+                           check_suspended=check_suspended)
             if current_action is not None:
                 current_action.progress += buffer_size
             yield r
 
-    def do_get(self, url, file_out=None, digest=None, digest_algorithm=None):
+    def _throttle(self, limiter, size, message, check_suspended=None):
+        """ Wait for the bandwidth limiter to allow the transfer of `size` bytes. """
+        if limiter is None:
+            return
+        if check_suspended is None:
+            check_suspended = self.check_suspended
+        check = None
+        if check_suspended is not None:
+            check = lambda: check_suspended(message)
+        limiter.consume(size, check=check)
+
+    def do_get(self, url, file_out=None, digest=None, digest_algorithm=None, resume=False):
+        """
+        Download the content at `url`, in memory or to `file_out`.
+        With `resume`, an existing `file_out` is taken as the beginning of
+        the content and only the rest is requested with a Range header.
+        """
+
         log.trace('Downloading file from %r to %r with digest=%s, digest_algorithm=%s', url, file_out, digest,
                   digest_algorithm)
         h = None
@@ -824,24 +1140,64 @@ class BaseAutomationClient(BaseClient):
                 raise ValueError('Unknow digest method: ' + digest_algorithm)
             h = digester()
         headers = self._get_common_headers()
+        offset = 0
+        if resume and file_out is not None and os.path.exists(file_out):
+            offset = os.path.getsize(file_out)
+        if offset:
+            headers['Range'] = 'bytes=%d-' % offset
         base_error_message = (
             "Failed to connect to Nuxeo server %r with user %r"
         ) % (self.server_url, self.user_id)
         try:
             log.trace("Calling '%s' with headers: %r", url, headers)
             req = urllib2.Request(url, headers=headers)
-            response = self.opener.open(req, timeout=self.blob_timeout)
+            try:
+                response = self.opener.open(req, timeout=self.blob_timeout)
+            except urllib2.HTTPError as e:
+                if e.code != 416 or not offset:
+                    raise
+                # The partial file is not a prefix of the content anymore
+                log.debug('Cannot resume the download of %r from %d bytes, restarting it', file_out, offset)
+                response = None
+            if response is not None and offset and response.getcode() == 206:
+                content_range = response.info().getheader('Content-Range')
+                if get_range_start(content_range) != offset:
+                    # Appending that part would corrupt the file
+                    log.debug('Got range %r instead of bytes %d-, restarting the download of %r', content_range,
+                              offset, file_out)
+                    response.close()
+                    response = None
+            if response is None:
+                offset = 0
+                del headers['Range']
+                req = urllib2.Request(url, headers=headers)
+                response = self.opener.open(req, timeout=self.blob_timeout)
+            if offset and response.getcode() != 206:
+                log.debug('Range request ignored by the server, restarting the download of %r', file_out)
+                offset = 0
+            elif offset:
+                log.debug('Resuming the download of %r from %d bytes', file_out, offset)
             current_action = Action.get_current_action()
             # Get the size file
             if (current_action
                     and response is not None
                     and response.info() is not None):
-                current_action.size = int(response.info().getheader(
+                current_action.size = offset + int(response.info().getheader(
                                                     'Content-Length', 0))
+                current_action.progress = offset
             if file_out is not None:
                 locker = self.unlock_path(file_out)
                 try:
-                    with open(file_out, "wb") as f:
+                    if offset and h is not None:
+                        # The digest state of the interrupted download was
+                        # not kept, compute it again from the partial file
+                        with open(file_out, 'rb') as f:
+                            while True:
+                                buffer_ = f.read(FILE_BUFFER_SIZE)
+                                if buffer_ == '':
+                                    break
+                                h.update(buffer_)
+                    with open(file_out, 'ab' if offset else 'wb') as f:
                         while True:
                             # Check if synchronization thread was suspended
                             if self.check_suspended is not None:
@@ -850,6 +1206,8 @@ class BaseAutomationClient(BaseClient):
                             buffer_ = response.read(FILE_BUFFER_SIZE)
                             if buffer_ == '':
                                 break
+                            self._throttle(self.download_limiter, len(buffer_),
+                                           'File download: %s' % file_out)
                             if current_action:
                                 current_action.progress += FILE_BUFFER_SIZE
                             f.write(buffer_)
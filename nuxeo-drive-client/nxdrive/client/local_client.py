@@ -9,6 +9,7 @@ import re
 import shutil
 import sys
 import tempfile
+import time
 import unicodedata
 import warnings
 
@@ -39,6 +40,10 @@ log = get_logger(__name__)
 
 DEDUPED_BASENAME_PATTERN = ur'^(.*)__(\d{1,3})$'
 
+# Files modified less than this many seconds before their digest computation
+# could change again without their mtime changing, their digest is not cached
+DIGEST_CACHE_RACY_DELAY = 2
+
 
 # Data transfer objects
 
@@ -76,6 +81,9 @@ class FileInfo(object):
         # Function to use
         self._digest_func = kwargs.pop('digest_func', 'MD5').lower()
 
+        # DAO storing the digests of the files by stat identity
+        self._digest_cache = kwargs.pop('digest_cache', None)
+
         # Precompute base name once and for all are it's often useful in
         # practice
         self.name = os.path.basename(path)
@@ -98,9 +106,20 @@ class FileInfo(object):
         if digester is None:
             raise ValueError('Unknown digest method: ' + digest_func)
 
+        filepath = safe_long_path(self.filepath)
+        cache = self._digest_cache
+        stat_key = None
+        # Files read in one buffer are cheaper to hash than to look up
+        if cache is not None and self.size > FILE_BUFFER_SIZE:
+            stat_key = self._get_stat_key(filepath)
+            if stat_key is not None:
+                digest = cache.get_cached_digest(self.filepath, digest_func, stat_key)
+                if digest is not None:
+                    return digest
+
         h = digester()
         try:
-            with open(safe_long_path(self.filepath), 'rb') as f:
+            with open(filepath, 'rb') as f:
                 while True:
                     # Check if synchronization thread was suspended
                     if self.check_suspended is not None:
@@ -112,7 +131,23 @@ class FileInfo(object):
                     h.update(buffer_)
         except IOError:
             return UNACCESSIBLE_HASH
-        return h.hexdigest()
+        digest = h.hexdigest()
+
+        # Only keep the digest if the file did not change while being read
+        if (stat_key is not None
+                and time.time() - stat_key[2] > DIGEST_CACHE_RACY_DELAY
+                and self._get_stat_key(filepath) == stat_key):
+            cache.cache_digest(self.filepath, digest_func, stat_key, digest)
+        return digest
+
+    @staticmethod
+    def _get_stat_key(filepath):
+        """ The (inode, size, mtime) identity of the file, None if missing. """
+        try:
+            stat_info = os.stat(filepath)
+        except OSError:
+            return None
+        return stat_info.st_ino, stat_info.st_size, stat_info.st_mtime
 
 
 class LocalClient(BaseClient):
@@ -132,6 +167,9 @@ class LocalClient(BaseClient):
             base_folder = base_folder[:-1]
         self.base_folder = base_folder
         self._digest_func = kwargs.pop('digest_func', 'md5')
+        self._digest_cache = kwargs.pop('digest_cache', None)
+        if not Options.digest_cache_size:
+            self._digest_cache = None
 
     def __repr__(self):
         return ('<{name}'
@@ -437,6 +475,7 @@ FolderType=Generic
         # uid = str(stat_info.st_ino)
         return FileInfo(self.base_folder, ref, folderish, mtime,
                         digest_func=self._digest_func,
+                        digest_cache=self._digest_cache,
                         check_suspended=self.check_suspended,
                         remote_ref=remote_ref, size=size)
 
@@ -88,9 +88,12 @@ class RemoteFileSystemClient(BaseAutomationClient):
         return content
 
     def stream_content(self, fs_item_id, file_path, parent_fs_item_id=None,
-                       fs_item_info=None, file_out=None):
+                       fs_item_info=None, file_out=None, resume=False):
         """Stream the binary content of a file system item to a tmp file
 
+        With resume, an existing file_out is completed instead of being
+        downloaded again, and it is kept if the download fails.
+
         Raises NotFound if file system item with id fs_item_id
         cannot be found
         """
@@ -107,9 +110,10 @@ class RemoteFileSystemClient(BaseAutomationClient):
         try:
             _, tmp_file = self.do_get(download_url, file_out=file_out,
                                       digest=fs_item_info.digest,
-                                      digest_algorithm=fs_item_info.digest_algorithm)
+                                      digest_algorithm=fs_item_info.digest_algorithm,
+                                      resume=resume)
         except Exception as e:
-            if os.path.exists(file_out):
+            if not resume and os.path.exists(file_out):
                 os.remove(file_out)
             raise e
         finally:
@@ -162,6 +166,18 @@ class RemoteFileSystemClient(BaseAutomationClient):
                                                    overwrite=overwrite)
         return self.file_to_info(fs_item)
 
+    def stream_files(self, parent_id, files, overwrite=False):
+        """Create documents by streaming the files in a single batch
+        :param files (file path, filename) tuples.
+        :return the info of each created document, or its error.
+        """
+        results = self.execute_with_blobs_streaming("NuxeoDrive.CreateFile",
+                                                    files,
+                                                    parentId=parent_id,
+                                                    overwrite=overwrite)
+        return [result if isinstance(result, Exception)
+                else self.file_to_info(result) for result in results]
+
     def update_content(self, fs_item_id, content, filename=None,
                        mime_type=None):
         """Update a document with the given content
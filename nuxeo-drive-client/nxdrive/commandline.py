@@ -164,6 +164,117 @@ class CliHandler(object):
             '--max-errors', default=Options.max_errors, type=int,
             help='Maximum number of tries before giving up synchronization of'
                  ' a file in error')
+        common_parser.add_argument(
+            '--min-processors', default=Options.min_processors, type=int,
+            help='Minimum number of concurrent file synchronizations')
+        common_parser.add_argument(
+            '--max-processors', default=Options.max_processors, type=int,
+            help='Maximum number of concurrent file synchronizations, the'
+                 ' number of processors adapts to the throughput in between')
+        common_parser.add_argument(
+            '--batch-upload-files', default=Options.batch_upload_files,
+            type=int,
+            help='Maximum number of small files created in a same folder to'
+                 ' upload together, 1 to upload them one by one')
+        common_parser.add_argument(
+            '--batch-upload-size', default=Options.batch_upload_size,
+            type=int,
+            help='Maximum size in bytes of the files uploaded together')
+        common_parser.add_argument(
+            '--chunk-upload-limit', default=Options.chunk_upload_limit,
+            type=int,
+            help='Size in bytes above which the files are uploaded in'
+                 ' chunks, allowing to resume an interrupted upload')
+        common_parser.add_argument(
+            '--chunk-upload-size', default=Options.chunk_upload_size,
+            type=int,
+            help='Size in bytes of the chunks of an upload')
+        common_parser.add_argument(
+            '--chunk-upload-threads', default=Options.chunk_upload_threads,
+            type=int,
+            help='Number of chunks of a same file uploaded concurrently')
+        common_parser.add_argument(
+            '--upload-rate', default=Options.upload_rate, type=int,
+            help='Maximum upload rate of all the engines in KiB/s, 0 for'
+                 ' unlimited')
+        common_parser.add_argument(
+            '--download-rate', default=Options.download_rate, type=int,
+            help='Maximum download rate of all the engines in KiB/s, 0 for'
+                 ' unlimited')
+        common_parser.add_argument(
+            '--upload-schedule', default=Options.upload_schedule, nargs='*',
+            metavar='HH:MM-HH:MM=KIB',
+            help='Upload rates of all the engines by time of day, overriding'
+                 ' --upload-rate')
+        common_parser.add_argument(
+            '--download-schedule', default=Options.download_schedule,
+            nargs='*', metavar='HH:MM-HH:MM=KIB',
+            help='Download rates of all the engines by time of day,'
+                 ' overriding --download-rate')
+        common_parser.add_argument(
+            '--db-journal-mode', default=Options.db_journal_mode,
+            choices=('DELETE', 'MEMORY', 'PERSIST', 'TRUNCATE', 'WAL'),
+            help='SQLite journal mode of the internal databases, WAL lets'
+                 ' readers run concurrently with the writer')
+        common_parser.add_argument(
+            '--db-synchronous', default=Options.db_synchronous,
+            choices=('OFF', 'NORMAL', 'FULL', 'EXTRA'),
+            help='SQLite synchronous setting of the internal databases')
+        common_parser.add_argument(
+            '--db-cache-size', default=Options.db_cache_size, type=int,
+            help='SQLite page cache size, in pages or in KiB if negative')
+        common_parser.add_argument(
+            '--db-mmap-size', default=Options.db_mmap_size, type=int,
+            help='SQLite memory-mapped I/O size in bytes')
+        common_parser.add_argument(
+            '--db-read-pool-max', default=Options.db_read_pool_max,
+            type=int,
+            help='Maximum number of read connections leased at once per'
+                 ' database')
+        common_parser.add_argument(
+            '--db-read-pool-size', default=Options.db_read_pool_size,
+            type=int,
+            help='Maximum number of idle read connections kept per database')
+        common_parser.add_argument(
+            '--db-writer-thread', default=Options.db_writer_thread,
+            action='store_true',
+            help='Run the background database writes in a dedicated thread')
+        common_parser.add_argument(
+            '--db-writer-batch-size', default=Options.db_writer_batch_size,
+            type=int,
+            help='Maximum number of background writes committed together')
+        common_parser.add_argument(
+            '--db-fetch-size', default=Options.db_fetch_size, type=int,
+            help='Number of rows fetched at once when iterating over large'
+                 ' database results')
+        common_parser.add_argument(
+            '--db-profiling', default=Options.db_profiling,
+            action='store_true',
+            help='Record the statistics of the database queries, shown in'
+                 ' the engine metrics')
+        common_parser.add_argument(
+            '--db-slow-query-threshold',
+            default=Options.db_slow_query_threshold, type=int,
+            help='Duration in ms from which profiled queries are written to'
+                 ' the slow queries log')
+        common_parser.add_argument(
+            '--db-maintenance-interval',
+            default=Options.db_maintenance_interval, type=int,
+            help='Number of seconds between two maintenance checks of the'
+                 ' databases, 0 to disable')
+        common_parser.add_argument(
+            '--queue-page-size', default=Options.queue_page_size, type=int,
+            help='Number of pending items loaded at once from the persisted'
+                 ' synchronization queue')
+        common_parser.add_argument(
+            '--queue-policies', default=Options.queue_policies, nargs='*',
+            choices=('direct_edit', 'pin', 'recency', 'size'),
+            help='Scheduling policies of the synchronization queue')
+        common_parser.add_argument(
+            '--digest-cache-size', default=Options.digest_cache_size,
+            type=int,
+            help='Number of file digests kept in the internal databases to'
+                 ' avoid hashing unchanged files again, 0 to disable')
         common_parser.add_argument(
             '-v', '--version', action='version', version=self.get_version(),
             help='Print the current version of the Nuxeo Drive client'
@@ -289,6 +400,83 @@ class CliHandler(object):
         )
         clean_parser.set_defaults(command='clean_folder')
 
+        # Maintenance of the databases
+        db_maintenance_parser = subparsers.add_parser(
+            'db-maintenance',
+            help='Analyze, vacuum and checkpoint the databases of idle'
+                 ' engines.',
+            parents=[common_parser],
+        )
+        db_maintenance_parser.set_defaults(command='db_maintenance')
+        db_maintenance_parser.add_argument(
+            "--full", default=False, action="store_true",
+            help="Analyze all the tables, give back all the free space and"
+                 " truncate the write-ahead logs.")
+
+        # Snapshot of the states of a binding
+        export_states_parser = subparsers.add_parser(
+            'export-states',
+            help='Export the synchronization states of a local folder.',
+            parents=[common_parser],
+        )
+        export_states_parser.set_defaults(command='export_states')
+        export_states_parser.add_argument(
+            "--local-folder",
+            help="Local folder bound with the 'bind-server' command.",
+            default=DEFAULT_NX_DRIVE_FOLDER,
+        )
+        export_states_parser.add_argument(
+            "file", help="Snapshot file to create.")
+
+        # Seed a new binding with a snapshot
+        import_states_parser = subparsers.add_parser(
+            'import-states',
+            help='Seed a new binding with the synchronization states exported'
+                 ' from another computer, and check the local files instead'
+                 ' of downloading them again.',
+            parents=[common_parser],
+        )
+        import_states_parser.set_defaults(command='import_states')
+        import_states_parser.add_argument(
+            "--local-folder",
+            help="Local folder bound with the 'bind-server' command to the"
+                 " same server and user than the exported one.",
+            default=DEFAULT_NX_DRIVE_FOLDER,
+        )
+        import_states_parser.add_argument(
+            "--rebase", nargs=2, metavar=('OLD', 'NEW'),
+            help="Import the states under the OLD path, relative to the"
+                 " exported local folder, under the NEW one.")
+        import_states_parser.add_argument(
+            "file", help="Snapshot file created by 'export-states'.")
+
+        # Bandwidth limits of a binding
+        bandwidth_parser = subparsers.add_parser(
+            'bandwidth',
+            help='Display or set the bandwidth limits of a local folder,'
+                 ' within the global ones. A running application applies'
+                 ' them after its next remote poll.',
+            parents=[common_parser],
+        )
+        bandwidth_parser.set_defaults(command='bandwidth')
+        bandwidth_parser.add_argument(
+            "--local-folder",
+            help="Local folder bound with the 'bind-server' command.",
+            default=DEFAULT_NX_DRIVE_FOLDER,
+        )
+        bandwidth_parser.add_argument(
+            "--max-upload", type=int, help="Maximum upload rate in KiB/s, 0 for"
+                                       " unlimited.")
+        bandwidth_parser.add_argument(
+            "--max-download", type=int, help="Maximum download rate in KiB/s, 0"
+                                         " for unlimited.")
+        bandwidth_parser.add_argument(
+            "--upload-hours", nargs='*', metavar='HH:MM-HH:MM=KIB',
+            help="Upload rates by time of day, overriding --max-upload.")
+        bandwidth_parser.add_argument(
+            "--download-hours", nargs='*', metavar='HH:MM-HH:MM=KIB',
+            help="Download rates by time of day, overriding --max-download.")
+
         # Display the metadata window
         metadata_parser = subparsers.add_parser(
             'metadata',
@@ -495,6 +683,64 @@ class CliHandler(object):
             pydevd.settrace()
         return self.launch(options=options, console=True)
 
+    def db_maintenance(self, options):
+        from nxdrive.engine.maintenance import DatabaseMaintenance
+        worker = DatabaseMaintenance(self.manager)
+        for name, stats in sorted(worker.maintain(full=options.full).items()):
+            print('%s: %d KiB, %d free pages (%d%%), WAL %d KiB' % (
+                name, stats['db_size'] // 1024, stats['db_freelist'],
+                stats['db_fragmentation'], stats['db_wal_size'] // 1024))
+        return 0
+
+    def _get_engine(self, local_folder):
+        for engine in self.manager.get_engines().values():
+            if engine.local_folder == local_folder:
+                return engine
+        self.log.error('No engine registered for local folder %s', local_folder)
+        return None
+
+    def export_states(self, options):
+        engine = self._get_engine(options.local_folder)
+        if engine is None:
+            return 1
+        count = engine.export_states(options.file)
+        print('%d states exported to %s' % (count, options.file))
+        return 0
+
+    def import_states(self, options):
+        engine = self._get_engine(options.local_folder)
+        if engine is None:
+            return 1
+        info = engine.import_states(options.file, rebase=options.rebase)
+        print('%d states imported, %d skipped: %d files verified,'
+              ' %d missing, %d modified' % (
+                  info['imported'], info['skipped'], info['verified'],
+                  info['missing'], info['modified']))
+        return 0
+
+    def bandwidth(self, options):
+        engine = self._get_engine(options.local_folder)
+        if engine is None:
+            return 1
+        changed = False
+        for direction in ('upload', 'download'):
+            rate = getattr(options, 'max_' + direction)
+            schedule = getattr(options, direction + '_hours')
+            if rate is not None or schedule is not None:
+                current, current_schedule = engine.get_rate_limit(direction)
+                engine.set_rate_limit(
+                    direction, rate=current if rate is None else rate,
+                    schedule=current_schedule if schedule is None else schedule)
+                changed = True
+            rate, schedule = engine.get_rate_limit(direction)
+            print('%s: %s%s' % (
+                direction, '%d KiB/s' % rate if rate else 'unlimited',
+                ' (%s)' % ', '.join(schedule) if schedule else ''))
+        if changed:
+            print('A running application applies these limits after its next'
+                  ' remote poll.')
+        return 0
+
     def metadata(self, options):
         file_path = normalized_path(options.file)
         self.manager.open_metadata_window(file_path)
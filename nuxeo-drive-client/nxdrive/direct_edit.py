@@ -3,7 +3,6 @@ import os
 import shutil
 import sys
 from Queue import Empty, Queue
-from time import sleep
 
 from PyQt4.QtCore import pyqtSignal, pyqtSlot
 
@@ -48,7 +47,8 @@ class DirectEdit(Worker):
         if isinstance(folder, bytes):
             folder = unicode(folder)
         self._folder = folder
-        self._local_client = LocalClient(self._folder)
+        self._local_client = LocalClient(self._folder,
+                                         digest_cache=manager.get_dao())
         self._upload_queue = Queue()
         self._lock_queue = Queue()
         self._error_queue = BlacklistQueue()
@@ -67,14 +67,17 @@ class DirectEdit(Worker):
                     continue
                 ref = self._local_client.get_path(lock.path)
                 self._lock_queue.put((ref, 'unlock_orphan'))
+        self.wake()
 
     def autolock_lock(self, src_path):
         ref = self._local_client.get_path(src_path)
         self._lock_queue.put((ref, 'lock'))
+        self.wake()
 
     def autolock_unlock(self, src_path):
         ref = self._local_client.get_path(src_path)
         self._lock_queue.put((ref, 'unlock'))
+        self.wake()
 
     def start(self):
         self._stop = False
@@ -337,6 +340,14 @@ class DirectEdit(Worker):
         dir_path = os.path.dirname(ref)
         self._local_client.set_remote_id(dir_path, unicode(digest), "nxdirecteditdigest")
         self._upload_queue.put(ref)
+        self.wake()
+
+    @staticmethod
+    def _boost_synchronized_copy(engine, uid):
+        """ Favor the synchronization of the document just edited, if synchronized. """
+        pair = engine.get_dao().get_first_state_from_partial_remote(uid)
+        if pair is not None:
+            engine.get_queue_manager().boost(pair.id, 'direct_edit')
 
     def _handle_queues(self):
         uploaded = False
@@ -411,6 +422,7 @@ class DirectEdit(Worker):
                 dir_path = os.path.dirname(ref)
                 self._local_client.set_remote_id(dir_path, current_digest, 'nxdirecteditdigest')
                 self._last_action_timing = current_milli_time() - start_time
+                self._boost_synchronized_copy(engine, uid)
                 self.editDocument.emit(remote_info)
             except ThreadInterrupt:
                 raise
@@ -456,7 +468,8 @@ class DirectEdit(Worker):
                     raise
                 except Exception as ex:
                     log.debug(ex)
-                sleep(0.01)
+                # Woken up by the edits, locks and watchdog events
+                self._wait()
         except ThreadInterrupt:
             raise
         finally:
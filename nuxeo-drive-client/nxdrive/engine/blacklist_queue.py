@@ -1,7 +1,128 @@
 # coding: utf-8
+import random
 import time
+from heapq import heapify, heappop, heappush
+from itertools import count
 from threading import Lock
 
+# Ratio of the retry delays randomly added or removed, so that the items
+# failing together are not retried together
+BACKOFF_JITTER = 0.1
+# Longest retry delay in seconds
+BACKOFF_MAX = 3600
+
+
+def backoff(attempt, interval, jitter=BACKOFF_JITTER, maximum=BACKOFF_MAX):
+    """ Delay in seconds before the retry following the `attempt`th failure. """
+    delay = min(interval * 2 ** max(attempt - 1, 0), max(interval, maximum))
+    return delay * random.uniform(1 - jitter, 1 + jitter)
+
+
+class RetryScheduler(object):
+    """
+    Items waiting for their retry time, by key.
+
+    The items are kept in a min-heap of their retry time: pushing an item
+    and popping the next due one are O(log n). Pushing an item for a key
+    already scheduled replaces it, the replaced heap entry is only flagged
+    and skipped when reaching the head of the heap.
+    """
+
+    # Rebuild the heap when it holds more replaced entries than this
+    COMPACT_THRESHOLD = 64
+
+    def __init__(self):
+        self._lock = Lock()
+        # Entries are [retry time, sequence, key, item], key is None for
+        # replaced entries
+        self._heap = []
+        self._entries = dict()
+        self._sequence = count()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def push(self, key, item, next_try):
+        """
+        Schedule the item at the `next_try` timestamp.
+        Return True if it is the next item to retry.
+        """
+
+        with self._lock:
+            self._remove(key)
+            entry = [next_try, next(self._sequence), key, item]
+            heappush(self._heap, entry)
+            self._entries[key] = entry
+            self._clean()
+            return self._heap[0] is entry
+
+    def remove(self, key):
+        with self._lock:
+            removed = self._remove(key)
+            self._clean()
+            return removed
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        entry[2] = None
+        return True
+
+    def _clean(self):
+        # Drop the replaced entries at the head, the next retry time is then
+        # always the head one
+        while self._heap and self._heap[0][2] is None:
+            heappop(self._heap)
+        if len(self._heap) - len(self._entries) > self.COMPACT_THRESHOLD:
+            self._heap = [entry for entry in self._heap if entry[2] is not None]
+            heapify(self._heap)
+
+    def get_next_try(self):
+        """ Timestamp of the next retry, None if empty. """
+        with self._lock:
+            return self._heap[0][0] if self._heap else None
+
+    def pop(self, cur_time=None):
+        """ Return the next item to retry if its time has come, else None. """
+        if cur_time is None:
+            cur_time = time.time()
+        with self._lock:
+            if not self._heap or self._heap[0][0] > cur_time:
+                return None
+            _, _, key, item = heappop(self._heap)
+            del self._entries[key]
+            self._clean()
+            return item
+
+    def pop_all(self, cur_time=None):
+        """ Return the items to retry at `cur_time`, in their retry order. """
+        if cur_time is None:
+            cur_time = time.time()
+        items = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= cur_time:
+                _, _, key, item = heappop(self._heap)
+                del self._entries[key]
+                items.append(item)
+                self._clean()
+        return items
+
+    def retry_all(self, next_try=0):
+        """ Move the retry time of all the items to `next_try`, if later. """
+        with self._lock:
+            for entry in self._entries.itervalues():
+                entry[0] = min(entry[0], next_try)
+            self._heap = self._entries.values()
+            heapify(self._heap)
+
+    def values(self):
+        with self._lock:
+            return [entry[3] for entry in sorted(self._entries.itervalues())]
+
 
 class BlacklistItem(object):
 
@@ -30,23 +151,18 @@ class BlacklistItem(object):
         if next_try is not None:
             self._next_try = next_try + cur_time
         else:
-            self._next_try = self._count * self._interval + cur_time
+            self._next_try = int(round(backoff(self._count, self._interval))) + cur_time
 
 
 class BlacklistQueue(object):
 
     def __init__(self, delay=30):
-        self._queue = dict()
-        self._lock = Lock()
+        self._queue = RetryScheduler()
         self._delay = delay
 
     def push(self, id_obj, obj):
         item = BlacklistItem(item_id=id_obj, item=obj, next_try=self._delay)
-        self._lock.acquire()
-        try:
-            self._queue[item.get_id()] = item
-        finally:
-            self._lock.release()
+        self._queue.push(item.get_id(), item, item._next_try)
 
     def repush(self, item, increase_wait=True):
         if not isinstance(item, BlacklistItem):
@@ -55,19 +171,13 @@ class BlacklistQueue(object):
             item.increase()
         else:
             item.increase(next_try=self._delay)
-        self._lock.acquire()
-        try:
-            self._queue[item.get_id()] = item
-        finally:
-            self._lock.release()
+        self._queue.push(item.get_id(), item, item._next_try)
 
     def get(self):
-        cur_time = int(time.time())
-        self._lock.acquire()
-        try:
-            for item in self._queue.values():
-                if item.check(cur_time=cur_time):
-                    del self._queue[item.get_id()]
-                    return item
-        finally:
-            self._lock.release()
+        # Same as BlacklistItem.check(), items are due after their retry time
+        return self._queue.pop(cur_time=int(time.time()) - 1)
+
+    def get_next_try(self):
+        """ Timestamp of the next item to become available, None if empty. """
+        next_try = self._queue.get_next_try()
+        return None if next_try is None else next_try + 1
@@ -1,19 +1,58 @@
 # coding: utf-8
 import inspect
 import os
+import re
 import sqlite3
 import sys
+from Queue import Empty, Queue
+from collections import OrderedDict, deque
 from datetime import datetime
-from threading import RLock, current_thread, local
+from threading import Condition, Event, Lock, RLock, Thread, current_thread, local
+from time import sleep, time
 
 from PyQt4.QtCore import QObject, pyqtSignal
 
-from nxdrive.logging_config import get_logger
+from nxdrive.logging_config import SLOW_QUERIES_LOGGER, get_logger
+from nxdrive.options import Options
 
 log = get_logger(__name__)
+# Statements slower than Options.db_slow_query_threshold, see QueryProfiler
+slow_log = get_logger(SLOW_QUERIES_LOGGER)
 
 SCHEMA_VERSION = "schema_version"
 
+IDENTIFIER = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+JOURNAL_MODES = ('DELETE', 'MEMORY', 'PERSIST', 'TRUNCATE', 'WAL')
+SYNCHRONOUS_MODES = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+
+# Initial delay in seconds between two tries on a locked database,
+# doubled at each try
+RETRY_DELAY = 0.01
+MAX_RETRIES = 5
+
+# Digest cache hits only refresh the last access time once it is older than
+# this many seconds, and the cache is trimmed every that many stored digests
+DIGEST_CACHE_ACCESS_RESOLUTION = 3600
+DIGEST_CACHE_TRIM_INTERVAL = 1000
+
+# PRAGMA auto_vacuum value of the databases giving back their free pages
+# on demand, and the maximum number of pages given back by a maintenance
+AUTO_VACUUM_INCREMENTAL = 2
+INCREMENTAL_VACUUM_PAGES = 1000
+
+# Configuration of an engine kept in its States snapshots: the binding
+# to check against and the remote markers avoiding a full remote scan
+SNAPSHOT_CONFIG = ('server_url', 'remote_user', 'remote_last_sync_date',
+                   'remote_last_event_log_id', 'remote_last_root_definitions',
+                   'remote_last_full_scan')
+SNAPSHOT_REMOTE_MARKERS = SNAPSHOT_CONFIG[2:]
+
+# Recursive common table expressions need SQLite 3.8.3
+RECURSIVE_CTE = sqlite3.sqlite_version_info >= (3, 8, 3)
+
+MAX_CODE_POINT = 0x10ffff
+
 # Summary status from last known pair of states
 # (local_state, remote_state)
 PAIR_STATES = {
@@ -56,8 +95,175 @@ PAIR_STATES = {
 }
 
 
+# Secondary indexes of the States table (name, columns)
+STATE_INDEXES = (
+    ('idx_states_local_path', 'local_path'),
+    ('idx_states_local_parent_path', 'local_parent_path'),
+    ('idx_states_remote_parent_ref', 'remote_parent_ref'),
+    ('idx_states_remote_parent_path', 'remote_parent_path'),
+    ('idx_states_remote_digest', 'remote_digest'),
+    ('idx_states_pair_state', 'pair_state, folderish'),
+    ('idx_states_error_count', 'error_count'),
+)
+
+# The StateCounters table holds the number of States rows and their size
+# for each (pair_state, folderish, error_count), it is kept up to date by
+# the triggers below. NULL values are stored as '' or -1 to stay in the key.
+STATE_COUNTERS_KEY = ("IFNULL({0}.pair_state, ''), IFNULL({0}.folderish, -1),"
+                      " IFNULL({0}.error_count, -1)")
+STATE_COUNTERS_MATCH = ("pair_state = IFNULL({0}.pair_state, '')"
+                        " AND folderish = IFNULL({0}.folderish, -1)"
+                        " AND error_count = IFNULL({0}.error_count, -1)")
+STATE_COUNTERS_INCREMENT = (
+    "INSERT OR IGNORE INTO StateCounters(pair_state, folderish, error_count)"
+    " VALUES (" + STATE_COUNTERS_KEY.format('NEW') + ");"
+    " UPDATE StateCounters SET count = count + 1, size = size + IFNULL(NEW.size, 0)"
+    " WHERE " + STATE_COUNTERS_MATCH.format('NEW') + ";")
+STATE_COUNTERS_DECREMENT = (
+    "UPDATE StateCounters SET count = count - 1, size = size - IFNULL(OLD.size, 0)"
+    " WHERE " + STATE_COUNTERS_MATCH.format('OLD') + ";"
+    " DELETE FROM StateCounters WHERE count <= 0;")
+STATE_COUNTERS_TRIGGERS = (
+    ('trg_states_counters_insert', 'AFTER INSERT ON States',
+     STATE_COUNTERS_INCREMENT),
+    ('trg_states_counters_delete', 'AFTER DELETE ON States',
+     STATE_COUNTERS_DECREMENT),
+    ('trg_states_counters_update',
+     'AFTER UPDATE OF pair_state, folderish, error_count, size ON States'
+     ' WHEN OLD.pair_state IS NOT NEW.pair_state'
+     ' OR OLD.folderish IS NOT NEW.folderish'
+     ' OR OLD.error_count IS NOT NEW.error_count'
+     ' OR OLD.size IS NOT NEW.size',
+     STATE_COUNTERS_DECREMENT + ' ' + STATE_COUNTERS_INCREMENT),
+)
+
+# The StateQueue table holds the States rows waiting to be processed along
+# with their retry state, so that the QueueManager resumes from it after a
+# restart. Rows enter it when their pair_state needs a synchronization and
+# leave it when synchronized, the triggers below maintain it.
+STATE_QUEUE_SYNCED = ("IFNULL({0}.pair_state, 'synchronized')"
+                      " IN ('synchronized', 'unsynchronized')")
+STATE_QUEUE_PUSH = (
+    "INSERT OR IGNORE INTO StateQueue(row_id, priority)"
+    " SELECT NEW.id, IFNULL(NEW.folderish, 0)"
+    " WHERE NOT " + STATE_QUEUE_SYNCED.format('NEW') + ";")
+STATE_QUEUE_TRIGGERS = (
+    ('trg_states_queue_insert', 'AFTER INSERT ON States', STATE_QUEUE_PUSH),
+    ('trg_states_queue_delete', 'AFTER DELETE ON States',
+     "DELETE FROM StateQueue WHERE row_id = OLD.id;"),
+    ('trg_states_queue_update',
+     'AFTER UPDATE OF pair_state ON States'
+     ' WHEN OLD.pair_state IS NOT NEW.pair_state',
+     "DELETE FROM StateQueue WHERE row_id = NEW.id"
+     " AND " + STATE_QUEUE_SYNCED.format('NEW') + "; "
+     # A new state is not the one that failed, retry it at once
+     "UPDATE StateQueue SET not_before = 0, attempt = 0 WHERE row_id = NEW.id; "
+     + STATE_QUEUE_PUSH),
+)
+
+
+class QueryProfiler(object):
+    """
+    Statistics of the statements run by the connections of a DAO.
+
+    Statements are grouped by template: their literal values are replaced
+    by ? so that the queries built by formatting are grouped too.
+    The latencies only cover Cursor.execute(), not the fetch of the rows.
+    The time spent waiting for the DAO lock before the statement is added
+    to its template.
+    """
+
+    # Latencies kept per template for the percentiles
+    SAMPLES = 1024
+    LITERALS = re.compile(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|\b\d+(?:\.\d+)?\b")
+    SPACES = re.compile(r'\s+')
+
+    def __init__(self, lock=None, threshold=None):
+        self._lock = Lock()
+        self._dao_lock = lock
+        self._threshold = threshold
+        self._templates = dict()
+        self._stats = dict()
+        self.calls = 0
+        self.total_time = 0
+        self.retries = 0
+        self.slow = 0
+
+    def get_template(self, sql):
+        template = self._templates.get(sql)
+        if template is None:
+            template = self.SPACES.sub(' ', self.LITERALS.sub('?', sql)).strip()
+            if len(self._templates) < 10000:
+                self._templates[sql] = template
+        return template
+
+    def record(self, sql, params, duration, retries):
+        lock_wait = 0
+        if self._dao_lock is not None:
+            lock_wait = self._dao_lock.pop_wait()
+        template = self.get_template(sql)
+        slow = self._threshold is not None and duration * 1000 >= self._threshold
+        with self._lock:
+            stats = self._stats.get(template)
+            if stats is None:
+                stats = self._stats[template] = {
+                    'calls': 0, 'total_time': 0, 'retries': 0, 'lock_wait': 0,
+                    'samples': deque(maxlen=self.SAMPLES)}
+            stats['calls'] += 1
+            stats['total_time'] += duration
+            stats['retries'] += retries
+            stats['lock_wait'] += lock_wait
+            stats['samples'].append(duration)
+            self.calls += 1
+            self.total_time += duration
+            self.retries += retries
+            if slow:
+                self.slow += 1
+        if slow:
+            slow_log.warning('%.1f ms (retries: %d, lock wait: %.1f ms): %s %r',
+                             duration * 1000, retries, lock_wait * 1000, template, params)
+
+    def get_metrics(self):
+        with self._lock:
+            return {
+                'db_queries': self.calls,
+                'db_query_time': int(self.total_time * 1000),
+                'db_query_retries': self.retries,
+                'db_slow_queries': self.slow,
+            }
+
+    def get_stats(self):
+        """ Statistics by template, in ms, the most time consuming first. """
+        with self._lock:
+            items = [(template, dict(stats, samples=sorted(stats['samples'])))
+                     for template, stats in self._stats.iteritems()]
+        result = []
+        for template, stats in items:
+            samples = stats['samples']
+            result.append({
+                'query': template,
+                'calls': stats['calls'],
+                'retries': stats['retries'],
+                'total_time': round(stats['total_time'] * 1000, 3),
+                'lock_wait': round(stats['lock_wait'] * 1000, 3),
+                'p50': round(samples[int(len(samples) * 0.50)] * 1000, 3),
+                'p95': round(samples[int(len(samples) * 0.95)] * 1000, 3),
+                'p99': round(samples[int(len(samples) * 0.99)] * 1000, 3),
+            })
+        result.sort(key=lambda stats: stats['total_time'], reverse=True)
+        return result
+
+    def reset(self):
+        with self._lock:
+            self._stats = dict()
+            self.calls = self.total_time = self.retries = self.slow = 0
+
+
 class AutoRetryCursor(sqlite3.Cursor):
     def execute(self, *args, **kwargs):
+        profiler = self.connection.profiler
+        if profiler is not None:
+            start = time()
         count = 0
         while True:
             count += 1
@@ -65,22 +271,384 @@ class AutoRetryCursor(sqlite3.Cursor):
                 obj = super(AutoRetryCursor, self).execute(*args, **kwargs)
                 if count > 1:
                     log.trace('Result returned from try #%d', count)
+                if profiler is not None:
+                    profiler.record(args[0], args[1] if len(args) > 1 else None,
+                                    time() - start, count - 1)
                 return obj
             except sqlite3.OperationalError as e:
+                if 'locked' not in str(e) and 'busy' not in str(e):
+                    raise e
                 log.trace('Retry locked database #%d', count)
-                if count > 5:
+                if count > MAX_RETRIES:
                     raise e
+                stats = self.connection.stats
+                if stats is not None:
+                    with self.connection.stats_lock:
+                        stats['retries'] += 1
+                sleep(RETRY_DELAY * 2 ** (count - 1))
 
 
 class AutoRetryConnection(sqlite3.Connection):
+    # Counters shared by all the connections of a DAO, and their lock
+    stats = None
+    stats_lock = None
+    # QueryProfiler of the DAO, if enabled
+    profiler = None
+
     def cursor(self):
         return super(AutoRetryConnection, self).cursor(AutoRetryCursor)
 
 
-class StateRow(sqlite3.Row):
+class ConnectionPool(object):
+    """
+    Pool of read connections.
+
+    A connection is leased to the calling thread until it calls release(),
+    it is then kept to be reused by the next thread asking for one.
+    No more than `size` idle connections are kept open, and no more than
+    `max_leases` connections are leased at once: past that, a thread waits
+    for another one to release its connection.  After `timeout` seconds it
+    gets a new connection anyway, as the lease holders may be waiting on it,
+    and the overflow is counted.
+    """
+
+    def __init__(self, factory, size=4, max_leases=32, timeout=5):
+        self._factory = factory
+        self._size = size
+        self._max_leases = max_leases
+        self._timeout = timeout
+        self._lock = Condition(Lock())
+        self._idle = []
+        self._leased = dict()
+        self.created = 0
+        self.reused = 0
+        self.waits = 0
+        self.overflows = 0
+
+    def acquire(self):
+        ident = current_thread().ident
+        with self._lock:
+            con = self._leased.get(ident)
+            if con is not None:
+                return con
+            if not self._idle and len(self._leased) >= self._max_leases:
+                self.waits += 1
+                deadline = time() + self._timeout
+                while not self._idle and len(self._leased) >= self._max_leases:
+                    remaining = deadline - time()
+                    if remaining <= 0:
+                        log.warning('No read connection released in %ds, %d leased',
+                                    self._timeout, len(self._leased))
+                        self.overflows += 1
+                        break
+                    self._lock.wait(remaining)
+            if self._idle:
+                con = self._idle.pop()
+                self.reused += 1
+            else:
+                con = self._factory()
+                self.created += 1
+            self._leased[ident] = con
+        return con
+
+    def release(self):
+        """
+        Give back the connection of the current thread.
+        Return the connection if the pool is full and it must be closed.
+        """
+
+        with self._lock:
+            con = self._leased.pop(current_thread().ident, None)
+            if con is None:
+                return None
+            self._lock.notify()
+            if len(self._idle) < self._size:
+                self._idle.append(con)
+                return None
+        return con
+
+    def clear(self):
+        with self._lock:
+            self._idle = []
+            self._leased = dict()
+            self._lock.notify_all()
+
+    def get_metrics(self):
+        return {
+            'db_read_connections_leased': len(self._leased),
+            'db_read_connections_idle': len(self._idle),
+            'db_read_connections_created': self.created,
+            'db_read_connections_reused': self.reused,
+            'db_read_connections_waits': self.waits,
+            'db_read_connections_overflows': self.overflows,
+        }
+
+
+class ProcessorLeases(object):
+    """
+    In-memory table of the States rows being processed, by thread id.
+
+    Leases are never written to the database: they vanish with the process,
+    so a crash cannot leave a row locked for the next start.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._owners = dict()
+        self._rows = dict()
+
+    def __len__(self):
+        return len(self._owners)
+
+    def acquire(self, owner, row_id):
+        """ Lease the row, unless another owner already holds it. """
+        with self._lock:
+            if self._owners.get(row_id, owner) != owner:
+                return False
+            self._owners[row_id] = owner
+            self._rows.setdefault(owner, set()).add(row_id)
+        return True
+
+    def release(self, owner):
+        """ Release all the rows of the owner, return how many there were. """
+        with self._lock:
+            rows = self._rows.pop(owner, ())
+            for row_id in rows:
+                del self._owners[row_id]
+        return len(rows)
+
+    def release_row(self, row_id):
+        with self._lock:
+            owner = self._owners.pop(row_id, None)
+            if owner is not None:
+                rows = self._rows[owner]
+                rows.discard(row_id)
+                if not rows:
+                    del self._rows[owner]
+
+    def get_owner(self, row_id):
+        """ Thread id processing the row, 0 if none. """
+        return self._owners.get(row_id, 0)
+
+    def clear(self):
+        with self._lock:
+            self._owners = dict()
+            self._rows = dict()
+
+
+class PathTrie(object):
+    """
+    Set of folder paths stored by path components.
+
+    Checking whether a path or one of its ancestors belongs to the set, or
+    dropping a whole subtree, costs one dict lookup per path component
+    instead of a pass over every path of the set.
+    """
+
+    def __init__(self, paths=()):
+        self._lock = Lock()
+        # Nodes are dicts of child nodes by name, the path of the node is
+        # stored under the None key when it belongs to the set
+        self._root = dict()
+        self._count = 0
+        for path in paths:
+            self.add(path)
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, path):
+        node = self._get_node(path)
+        return node is not None and None in node
+
+    @staticmethod
+    def _split(path):
+        return [name for name in path.split('/') if name]
+
+    def _get_node(self, path):
+        node = self._root
+        for name in self._split(path):
+            node = node.get(name)
+            if node is None:
+                return None
+        return node
+
+    def add(self, path):
+        """ Add the path, return False if it was already there. """
+        with self._lock:
+            node = self._root
+            for name in self._split(path):
+                node = node.setdefault(name, dict())
+            if None in node:
+                return False
+            node[None] = path
+            self._count += 1
+        return True
+
+    def discard(self, path):
+        with self._lock:
+            node = self._get_node(path)
+            if node is not None and None in node:
+                del node[None]
+                self._count -= 1
+
+    def discard_subtree(self, path):
+        """ Remove the path and all its descendants, return how many there were. """
+        names = self._split(path)
+        with self._lock:
+            if not names:
+                removed = self._count
+                self._root = dict()
+                self._count = 0
+                return removed
+            parent = self._get_node('/'.join(names[:-1]))
+            node = parent.pop(names[-1], None) if parent is not None else None
+            removed = len(self._get_paths(node)) if node is not None else 0
+            self._count -= removed
+        return removed
+
+    def has_ancestor(self, path):
+        """ Return True if the path or one of its ancestors is in the set. """
+        node = self._root
+        if None in node:
+            return True
+        for name in self._split(path):
+            node = node.get(name)
+            if node is None:
+                return False
+            if None in node:
+                return True
+        return False
+
+    def clear(self):
+        with self._lock:
+            self._root = dict()
+            self._count = 0
+
+    def get_paths(self):
+        with self._lock:
+            return self._get_paths(self._root)
+
+    @staticmethod
+    def _get_paths(node):
+        paths = []
+        nodes = [node]
+        while nodes:
+            node = nodes.pop()
+            for name, child in node.iteritems():
+                if name is None:
+                    paths.append(child)
+                else:
+                    nodes.append(child)
+        return paths
+
+
+class StateRow(object):
+    """
+    Row factory of the DAO connections.
+
+    StateRow(cursor, values) returns an instance of a subclass generated
+    once per set of columns, holding the values in __slots__: reading
+    `row.local_path` is a plain slot access instead of a key search in a
+    sqlite3.Row. Rows still support indexes, keys and extra attributes.
+    """
+
+    __slots__ = ()
+    _columns = ()
+    _slots = ()
+    _indexes = {}
+    _factory = None
+    _classes = {}
+    _last_class = (None, None)
+
+    def __new__(cls, cursor, values):
+        # All the rows of a query share the same description
+        description, row_cls = cls._last_class
+        if description is not cursor.description:
+            description = cursor.description
+            row_cls = cls._get_class(tuple(column[0] for column in description))
+            cls._last_class = (description, row_cls)
+        row = object.__new__(row_cls)
+        row_cls._fill(row, values)
+        return row
+
+    def __reduce__(self):
+        # Allow copy and deepcopy of the rows, in the queues for instance
+        return _restore_row, (self._factory, self._columns, tuple(self), getattr(self, '__dict__', None))
+
+    @classmethod
+    def _from_values(cls, columns, values):
+        row_cls = cls._get_class(columns)
+        row = object.__new__(row_cls)
+        row_cls._fill(row, values)
+        return row
+
+    @classmethod
+    def _get_class(cls, columns):
+        row_cls = cls._classes.get((cls, columns))
+        if row_cls is None:
+            row_cls = cls._create_class(columns)
+        return row_cls
+
+    @classmethod
+    def _create_class(cls, columns):
+        slots = []
+        indexes = {}
+        for index, name in enumerate(columns):
+            # Like sqlite3.Row, keys are case insensitive and the first wins
+            indexes.setdefault(name.lower(), index)
+            if not IDENTIFIER.match(name) or name in slots or hasattr(cls, name):
+                # Only reachable by index or key, e.g. COUNT(*)
+                name = '_column_%d' % index
+            slots.append(str(name))
+        # __dict__ is only allocated when an extra attribute is set
+        row_cls = type(cls.__name__, (cls,), {
+            '__slots__': tuple(slots) + ('__dict__',),
+            '_columns': columns,
+            '_slots': tuple(slots),
+            '_indexes': indexes,
+            '_factory': cls,
+        })
+        # Like namedtuple, generate the code setting all the slots at once:
+        # one unpacking is several times faster than a setattr() per column
+        # Statements like PRAGMA incremental_vacuum return rows without columns
+        namespace = {}
+        assignment = ', '.join('row.' + slot for slot in slots) + ', = values'
+        exec ('def fill(row, values):\n'
+              '    ' + (assignment if slots else 'pass') + '\n') in namespace
+        row_cls._fill = staticmethod(namespace['fill'])
+        cls._classes[(cls, columns)] = row_cls
+        return row_cls
+
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            try:
+                key = self._indexes[key.lower()]
+            except KeyError:
+                raise IndexError('No item with that key')
+        if isinstance(key, slice):
+            return tuple(self)[key]
+        return getattr(self, self._slots[key])
+
+    def __iter__(self):
+        for slot in self._slots:
+            yield getattr(self, slot)
+
+    def __len__(self):
+        return len(self._slots)
+
+    def __eq__(self, other):
+        return (isinstance(other, StateRow) and self._columns == other._columns
+                and tuple(self) == tuple(other))
+
+    def __ne__(self, other):
+        return not self == other
 
-    def __init__(self, arg1, arg2):
-        super(StateRow, self).__init__(arg1, arg2)
+    def __hash__(self):
+        return hash((self._columns, tuple(self)))
+
+    def keys(self):
+        return list(self._columns)
 
     def __repr__(self):
         return ('<{name}[{cls.id!r}]'
@@ -93,10 +661,10 @@ class StateRow(sqlite3.Row):
                 ).format(name=type(self).__name__, cls=self)
 
     def __getattr__(self, name):
-        try:
-            return self[name]
-        except IndexError:
-            raise IndexError('No key with that name.', locals())
+        # Only called for unknown attributes
+        if name.startswith('__'):
+            raise AttributeError(name)
+        raise IndexError('No key with that name.', name)
 
     def is_readonly(self):
         if self.folderish:
@@ -111,6 +679,13 @@ class StateRow(sqlite3.Row):
             self.remote_state = remote_state
 
 
+def _restore_row(factory, columns, values, attributes):
+    row = factory._from_values(columns, values)
+    if attributes:
+        row.__dict__.update(attributes)
+    return row
+
+
 class LogLock(object):
     def __init__(self):
         self._lock = RLock()
@@ -126,6 +701,9 @@ class LogLock(object):
 
 
 class FakeLock(object):
+    waits = 0
+    wait_time = 0
+
     def acquire(self):
         pass
 
@@ -133,6 +711,139 @@ class FakeLock(object):
         pass
 
 
+class TimedLock(object):
+    """ RLock counting the times and duration callers had to wait for it. """
+
+    def __init__(self):
+        self._lock = RLock()
+        self._local = local()
+        self.waits = 0
+        self.wait_time = 0
+
+    def acquire(self):
+        if self._lock.acquire(False):
+            return
+        start = time()
+        self._lock.acquire()
+        waited = time() - start
+        self.waits += 1
+        self.wait_time += waited
+        self._local.wait = getattr(self._local, 'wait', 0) + waited
+
+    def pop_wait(self):
+        """ Time the current thread waited for the lock since the last call. """
+        waited = getattr(self._local, 'wait', 0)
+        self._local.wait = 0
+        return waited
+
+    def release(self):
+        self._lock.release()
+
+
+class WriteFuture(object):
+    """ Result of a write submitted with ConfigurationDAO.submit(). """
+
+    def __init__(self):
+        self._event = Event()
+        self._result = None
+        self._exception = None
+
+    def done(self):
+        return self._event.is_set()
+
+    def set_result(self, result):
+        self._result = result
+        self._event.set()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._event.set()
+
+    def result(self, timeout=None):
+        """ Wait for the write to be committed and return its result. """
+        if not self._event.wait(timeout):
+            raise RuntimeError('Write not committed after %r seconds' % timeout)
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+
+class DAOWriter(Thread):
+    """
+    Thread running the writes submitted to a DAO.
+
+    The writes waiting in the queue are run in one batch, so they share a
+    single commit, and their futures are resolved once it is done.
+    """
+
+    def __init__(self, dao, batch_size=100):
+        super(DAOWriter, self).__init__(name='DAOWriter')
+        self.daemon = True
+        self._dao = dao
+        self._batch_size = max(1, batch_size)
+        self._queue = Queue()
+        self.transactions = 0
+        self.writes = 0
+
+    def submit(self, func, *args, **kwargs):
+        future = WriteFuture()
+        self._queue.put((future, func, args, kwargs))
+        return future
+
+    def stop(self):
+        """ Run the pending writes and stop the thread. """
+        self._queue.put(None)
+        self.join()
+
+    def get_metrics(self):
+        return {
+            'db_writer_queue_size': self._queue.qsize(),
+            'db_writer_transactions': self.transactions,
+            'db_writer_writes': self.writes,
+        }
+
+    def run(self):
+        stop = False
+        while not stop:
+            writes = [self._queue.get()]
+            while len(writes) < self._batch_size:
+                try:
+                    writes.append(self._queue.get_nowait())
+                except Empty:
+                    break
+            if None in writes:
+                stop = True
+                writes = [write for write in writes if write is not None]
+            if writes:
+                self._run_batch(writes)
+
+    def _run_batch(self, writes):
+        results = []
+        try:
+            self._dao.begin_batch()
+            try:
+                for future, func, args, kwargs in writes:
+                    try:
+                        results.append((future, func(*args, **kwargs), None))
+                    except Exception as e:
+                        log.exception('Asynchronous write %r failed', func)
+                        results.append((future, None, e))
+            finally:
+                self._dao.end_batch()
+        except Exception as e:
+            log.exception('Cannot commit %d asynchronous writes', len(writes))
+            for future, _, _, _ in writes:
+                future.set_exception(e)
+            return
+        self.transactions += 1
+        self.writes += len(writes)
+        for future, result, exception in results:
+            if exception is None:
+                future.set_result(result)
+            else:
+                future.set_exception(exception)
+
+
 class ConfigurationDAO(QObject):
 
     def __init__(self, db):
@@ -146,13 +857,28 @@ class ConfigurationDAO(QObject):
         self.schema_version = self.get_schema_version()
         self.in_tx = None
         self._tx_lock = RLock()
+        self._batch_thread = None
+        self._batch_depth = 0
+        self._batch_auto_commit = True
         # If we dont share connection no need to lock
         if self.share_connection:
-            self._lock = RLock()
+            self._lock = TimedLock()
         else:
             self._lock = FakeLock()
+        self._stats = {'retries': 0}
+        self._stats_lock = Lock()
+        self._profiler = None
+        if Options.db_profiling:
+            self._profiler = QueryProfiler(lock=self._lock if self.share_connection else None,
+                                           threshold=Options.db_slow_query_threshold)
+        self._digest_stats = {'hits': 0, 'misses': 0, 'stores': 0}
+        self._db_stats = dict()
+        self._maintenance_stats = {'runs': 0, 'last': 0, 'time': 0, 'vacuumed': 0}
         # Use to clean
         self._connections = []
+        self._pool = ConnectionPool(self._create_connection,
+                                    size=Options.db_read_pool_size,
+                                    max_leases=Options.db_read_pool_max)
         self._create_main_conn()
         self._conn.row_factory = StateRow
         c = self._conn.cursor()
@@ -168,7 +894,10 @@ class ConfigurationDAO(QObject):
         else:
             c.execute("INSERT INTO Configuration(name,value) VALUES(?,?)", (SCHEMA_VERSION, self.schema_version))
         self._conn.commit()
-        self._conns = local()
+        self._writer = None
+        if Options.db_writer_thread:
+            self._writer = DAOWriter(self, batch_size=Options.db_writer_batch_size)
+            self._writer.start()
         # FOR PYTHON 3.3...
         # if log.getEffectiveLevel() < 6:
         #    self._conn.set_trace_callback(self._log_trace)
@@ -214,34 +943,312 @@ class ConfigurationDAO(QObject):
 
     def _init_db(self, cursor):
         # http://www.stevemcarthur.co.uk/blog/post/some-kind-of-disk-io-error-occurred-sqlite
-        cursor.execute("PRAGMA journal_mode = MEMORY")
+        journal_mode = Options.db_journal_mode.upper()
+        if journal_mode not in JOURNAL_MODES:
+            log.warning('Unknown journal mode %r, using MEMORY', journal_mode)
+            journal_mode = 'MEMORY'
+        # Only effective on new databases, or existing ones after a VACUUM
+        cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        cursor.execute("PRAGMA journal_mode = " + journal_mode)
         self._create_configuration_table(cursor)
+        self._create_digest_cache_table(cursor)
 
     def _create_configuration_table(self, cursor):
         cursor.execute("CREATE TABLE if not exists Configuration(name VARCHAR NOT NULL, value VARCHAR, PRIMARY KEY (name))")
 
+    def _create_digest_cache_table(self, cursor):
+        cursor.execute("CREATE TABLE if not exists DigestCache(path VARCHAR NOT NULL, algorithm VARCHAR NOT NULL,"
+                       " inode INTEGER, size INTEGER, mtime REAL, digest VARCHAR NOT NULL,"
+                       " last_access INTEGER NOT NULL, PRIMARY KEY (path, algorithm))")
+        cursor.execute("CREATE INDEX if not exists idx_digest_cache_last_access ON DigestCache(last_access)")
+
+    def get_cached_digest(self, path, algorithm, stat_key):
+        """
+        Return the digest of the file computed when it had the same
+        (inode, size, mtime) stat identity, None otherwise.
+        """
+
+        c = self._get_read_connection().cursor()
+        row = c.execute("SELECT inode, size, mtime, digest, last_access FROM DigestCache"
+                        " WHERE path=? AND algorithm=?", (path, algorithm)).fetchone()
+        if row is None or (row.inode, row.size, row.mtime) != tuple(stat_key):
+            self._digest_stats['misses'] += 1
+            return None
+        self._digest_stats['hits'] += 1
+        now = int(time())
+        if row.last_access < now - DIGEST_CACHE_ACCESS_RESOLUTION:
+            self.submit(self._touch_cached_digest, path, algorithm, now)
+        return row.digest
+
+    def _touch_cached_digest(self, path, algorithm, last_access):
+        self._lock.acquire()
+        try:
+            con = self._get_write_connection()
+            c = con.cursor()
+            c.execute("UPDATE DigestCache SET last_access=? WHERE path=? AND algorithm=?",
+                      (last_access, path, algorithm))
+            if self.auto_commit:
+                con.commit()
+        finally:
+            self._lock.release()
+
+    def cache_digest(self, path, algorithm, stat_key, digest):
+        """ Store the digest of the file for its current stat identity. """
+        inode, size, mtime = stat_key
+        self._lock.acquire()
+        try:
+            con = self._get_write_connection()
+            c = con.cursor()
+            c.execute("INSERT OR REPLACE INTO DigestCache(path, algorithm, inode, size, mtime, digest, last_access)"
+                      " VALUES (?, ?, ?, ?, ?, ?, ?)", (path, algorithm, inode, size, mtime, digest, int(time())))
+            self._digest_stats['stores'] += 1
+            if self._digest_stats['stores'] % DIGEST_CACHE_TRIM_INTERVAL == 0:
+                self._trim_digest_cache(c, Options.digest_cache_size)
+            if self.auto_commit:
+                con.commit()
+        finally:
+            self._lock.release()
+
+    def trim_digest_cache(self, size=None):
+        """ Only keep the `size` most recently used digests. """
+        if size is None:
+            size = Options.digest_cache_size
+        self._lock.acquire()
+        try:
+            con = self._get_write_connection()
+            self._trim_digest_cache(con.cursor(), size)
+            if self.auto_commit:
+                con.commit()
+        finally:
+            self._lock.release()
+
+    @staticmethod
+    def _trim_digest_cache(cursor, size):
+        cursor.execute("DELETE FROM DigestCache WHERE rowid IN (SELECT rowid FROM DigestCache"
+                       " ORDER BY last_access DESC LIMIT -1 OFFSET ?)", (size,))
+
     def _create_main_conn(self):
         log.debug('Create main connexion on %r (dir_exists=%r, file_exists=%r)',
                   self._db, os.path.exists(os.path.dirname(self._db)), os.path.exists(self._db))
-        self._conn = AutoRetryConnection(self._db, check_same_thread=False)
-        self._connections.append(self._conn)
+        self._conn = self._create_connection()
+
+    def _create_connection(self):
+        # Dont check same thread for closing purpose
+        con = AutoRetryConnection(self._db, check_same_thread=False)
+        con.stats = self._stats
+        con.stats_lock = self._stats_lock
+        con.profiler = self._profiler
+        c = con.cursor()
+        synchronous = Options.db_synchronous
+        if synchronous is not None and synchronous.upper() in SYNCHRONOUS_MODES:
+            c.execute("PRAGMA synchronous = " + synchronous.upper())
+        if Options.db_cache_size is not None:
+            c.execute("PRAGMA cache_size = %d" % Options.db_cache_size)
+        if Options.db_mmap_size is not None:
+            c.execute("PRAGMA mmap_size = %d" % Options.db_mmap_size)
+        self._connections.append(con)
+        return con
+
+    def get_metrics(self):
+        metrics = {
+            'db_lock_waits': self._lock.waits,
+            'db_lock_wait_time': int(self._lock.wait_time * 1000),
+            'db_retries': self._stats['retries'],
+            'digest_cache_hits': self._digest_stats['hits'],
+            'digest_cache_misses': self._digest_stats['misses'],
+            'db_maintenance_runs': self._maintenance_stats['runs'],
+            'db_maintenance_time': int(self._maintenance_stats['time'] * 1000),
+            'db_last_maintenance': self._maintenance_stats['last'],
+            'db_vacuumed_pages': self._maintenance_stats['vacuumed'],
+        }
+        metrics.update(self._db_stats)
+        metrics.update(self._pool.get_metrics())
+        if self._profiler is not None:
+            metrics.update(self._profiler.get_metrics())
+        if self._writer is not None:
+            metrics.update(self._writer.get_metrics())
+        return metrics
+
+    def get_query_stats(self):
+        """ Statistics of the statements by template, empty unless Options.db_profiling is set. """
+        if self._profiler is None:
+            return []
+        return self._profiler.get_stats()
+
+    def get_db_stats(self, cursor=None):
+        """
+        Size of the database and of its WAL in bytes, number of free pages
+        and fragmentation, the percentage of free pages.
+        The last statistics are also part of the metrics.
+        """
+
+        if cursor is None:
+            cursor = self._get_read_connection().cursor()
+        page_size = cursor.execute("PRAGMA page_size").fetchone()[0]
+        page_count = cursor.execute("PRAGMA page_count").fetchone()[0]
+        freelist = cursor.execute("PRAGMA freelist_count").fetchone()[0]
+        wal = self._db + '-wal'
+        self._db_stats = {
+            'db_size': page_size * page_count,
+            'db_wal_size': os.path.getsize(wal) if os.path.isfile(wal) else 0,
+            'db_freelist': freelist,
+            'db_fragmentation': freelist * 100 // page_count if page_count else 0,
+        }
+        return self._db_stats
+
+    def get_last_maintenance(self):
+        return self._maintenance_stats['last']
+
+    def run_maintenance(self, full=False):
+        """
+        Update the statistics of the query planner, give back free pages to
+        the file system and checkpoint the WAL, if any.
+        A full maintenance analyzes all the tables, gives back all the free
+        pages, vacuuming the whole database if it is not in incremental
+        auto-vacuum mode yet, and truncates the WAL.
+        Return the database statistics after the maintenance.
+        """
+
+        start = time()
+        # VACUUM and checkpoints cannot run inside a pending transaction
+        self._tx_lock.acquire()
+        self._lock.acquire()
+        try:
+            con = self._get_write_connection()
+            c = con.cursor()
+            analyzed = c.execute("SELECT 1 FROM sqlite_master"
+                                 " WHERE name = 'sqlite_stat1'").fetchone()
+            c.execute("ANALYZE" if full or not analyzed else "PRAGMA optimize")
+            con.commit()
+            freelist = c.execute("PRAGMA freelist_count").fetchone()[0]
+            if c.execute("PRAGMA auto_vacuum").fetchone()[0] == AUTO_VACUUM_INCREMENTAL:
+                if freelist:
+                    pages = freelist if full else min(freelist, INCREMENTAL_VACUUM_PAGES)
+                    # Each page is a step of the statement
+                    c.execute("PRAGMA incremental_vacuum(%d)" % pages).fetchall()
+            elif full:
+                log.debug('Switching %r to incremental auto-vacuum', self._db)
+                c.execute("PRAGMA auto_vacuum = INCREMENTAL")
+                c.execute("VACUUM")
+            c.execute("PRAGMA wal_checkpoint(%s)"
+                      % ('TRUNCATE' if full else 'PASSIVE')).fetchall()
+            stats = self.get_db_stats(cursor=c)
+        finally:
+            self._lock.release()
+            self._tx_lock.release()
+        duration = time() - start
+        self._maintenance_stats['runs'] += 1
+        self._maintenance_stats['last'] = int(start)
+        self._maintenance_stats['time'] = duration
+        self._maintenance_stats['vacuumed'] += max(freelist - stats['db_freelist'], 0)
+        log.debug('Maintenance of %r in %.3fs: %r', self._db, duration, stats)
+        return stats
 
     def _log_trace(self, query):
         log.trace(query)
 
     def dispose(self):
         log.debug('Disposing SQLite database %r', self.get_db())
+        if self._writer is not None:
+            self._writer.stop()
+            self._writer = None
+        self._pool.clear()
         for con in self._connections:
             con.close()
         self._connections = []
         self._conn = None
 
     def dispose_thread(self):
-        if not hasattr(self._conns, '_conn'):
+        con = self._pool.release()
+        if con is None:
             return
-        if self._conns._conn in self._connections:
-            self._connections.remove(self._conns._conn)
-        self._conns._conn = None
+        if con in self._connections:
+            self._connections.remove(con)
+        con.close()
+
+    def begin_batch(self):
+        """
+        Group the next writes of the current thread in one transaction,
+        committed by the matching end_batch() call.
+        Batches can be nested, only the outermost one commits.
+        Other threads writes wait for the batch to end.
+        """
+
+        self._lock.acquire()
+        if not self._batch_depth:
+            self._batch_thread = current_thread().ident
+            self._batch_auto_commit = self.auto_commit
+            self.auto_commit = False
+        self._batch_depth += 1
+
+    def end_batch(self):
+        try:
+            self._batch_depth -= 1
+            if self._batch_depth:
+                return
+            self._batch_thread = None
+            self.auto_commit = self._batch_auto_commit
+            if self.auto_commit:
+                self._get_write_connection().commit()
+        finally:
+            self._lock.release()
+
+    def in_batch(self):
+        return self._batch_thread == current_thread().ident
+
+    def suspend_batch(self):
+        """
+        End all the batch levels of the current thread, committing its writes,
+        and return the depth to give back to resume_batch().
+        """
+
+        if not self.in_batch():
+            return 0
+        depth = self._batch_depth
+        for _ in xrange(depth):
+            self.end_batch()
+        return depth
+
+    def resume_batch(self, depth):
+        for _ in xrange(depth):
+            self.begin_batch()
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Run a write method of the DAO, in the background if the writer thread
+        is enabled, and return a WriteFuture.
+        Writes from a thread already in a batch are run synchronously, as the
+        writer would wait for the batch to end. Synchronous writes raise their
+        errors to the caller, like a direct call.
+        """
+
+        if self._writer is None or self.in_batch():
+            future = WriteFuture()
+            future.set_result(func(*args, **kwargs))
+            return future
+        return self._writer.submit(func, *args, **kwargs)
+
+    def flush(self, timeout=None):
+        """ Wait for the writes submitted so far to be committed. """
+        if self._writer is not None and not self.in_batch():
+            self._writer.submit(lambda: None).result(timeout)
+
+    @staticmethod
+    def _iter_rows(cursor, size=None):
+        """
+        Yield the rows of an executed cursor, fetching at most `size` rows
+        at once so that large results are never fully held in memory.
+        A commit on the cursor connection resets it: consume the rows
+        before writing from the same batch.
+        """
+
+        size = size or Options.db_fetch_size
+        while True:
+            rows = cursor.fetchmany(size)
+            if not rows:
+                return
+            for row in rows:
+                yield row
 
     def _get_write_connection(self, factory=StateRow):
         if self.share_connection or self.in_tx:
@@ -252,6 +1259,9 @@ class ConfigurationDAO(QObject):
         return self._get_read_connection(factory)
 
     def _get_read_connection(self, factory=StateRow):
+        # Pending changes of a batch are only visible from the write connection
+        if self.in_batch():
+            return self._get_write_connection(factory)
         # If in transaction
         if self.in_tx is not None:
             if current_thread().ident != self.in_tx:
@@ -262,15 +1272,9 @@ class ConfigurationDAO(QObject):
             else:
                 # Return the write connection
                 return self._conn
-        if not hasattr(self._conns, '_conn') or self._conns._conn is None:
-            # Dont check same thread for closing purpose
-            self._conns._conn = AutoRetryConnection(self._db, check_same_thread=False)
-            self._connections.append(self._conns._conn)
-        self._conns._conn.row_factory = factory
-            # Python3.3 feature
-            #if log.getEffectiveLevel() < 6:
-            #    self._conns._conn.set_trace_callback(self._log_trace)
-        return self._conns._conn
+        con = self._pool.acquire()
+        con.row_factory = factory
+        return con
 
     def begin_transaction(self):
         self.auto_commit = False
@@ -286,7 +1290,7 @@ class ConfigurationDAO(QObject):
         self.in_tx = None
 
     def commit(self):
-        if self.auto_commit:
+        if self.auto_commit or self.in_batch():
             return
         self._lock.acquire()
         try:
@@ -500,16 +1504,22 @@ class EngineDAO(ConfigurationDAO):
 
     def __init__(self, db, state_factory=StateRow):
         self._filters = None
+        self._paths_to_scan = None
+        self._scanned_paths = None
         self._queue_manager = None
+        # Queue pushes waiting for the current batch to be committed
+        self._batch_pushes = OrderedDict()
+        self._leases = ProcessorLeases()
         super(EngineDAO, self).__init__(db)
         self._state_factory = state_factory
-        self._filters = self.get_filters()
-        self._items_count = None
-        self._items_count = self.get_syncing_count()
+        self._filters = PathTrie(row.path for row in self.get_filters())
+        self._paths_to_scan = PathTrie(row.path for row in self.get_paths_to_scan())
+        c = self._get_read_connection().cursor()
+        self._scanned_paths = PathTrie(row.path for row in c.execute("SELECT path FROM RemoteScan"))
         self.reinit_processors()
 
     def get_schema_version(self):
-        return 3
+        return 11
 
     def _migrate_state(self, cursor):
         try:
@@ -518,6 +1528,13 @@ class EngineDAO(ConfigurationDAO):
             # If we cannot smoothly migrate harder migration
             cursor.execute("DROP TABLE if exists StatesMigration")
             self._reinit_states(cursor)
+        # Indexes and triggers were dropped along with the renamed table
+        self._create_state_indexes(cursor)
+        self._create_state_counters(cursor)
+        self._create_state_queue(cursor)
+        # The copied rows were counted and queued on top of the previous content
+        self._rebuild_state_counters(cursor)
+        self._rebuild_state_queue(cursor)
 
     def _migrate_db(self, cursor, version):
         if version < 1:
@@ -531,6 +1548,35 @@ class EngineDAO(ConfigurationDAO):
         if version < 3:
             self._migrate_state(cursor)
             self.update_config(SCHEMA_VERSION, 3)
+        if version < 4:
+            self._create_state_indexes(cursor)
+            self.update_config(SCHEMA_VERSION, 4)
+        if version < 5:
+            self._create_state_indexes(cursor)
+            self.update_config(SCHEMA_VERSION, 5)
+        if version < 6:
+            self._create_state_counters(cursor)
+            self._rebuild_state_counters(cursor)
+            self.update_config(SCHEMA_VERSION, 6)
+        if version < 7:
+            # Processors are now tracked in memory, clean the previous leases once
+            cursor.execute("UPDATE States SET processor=0 WHERE processor != 0")
+            self.update_config(SCHEMA_VERSION, 7)
+        if version < 8:
+            self._create_state_queue(cursor)
+            self._rebuild_state_queue(cursor)
+            self.update_config(SCHEMA_VERSION, 8)
+        if version < 9:
+            self._create_download_table(cursor)
+            self.update_config(SCHEMA_VERSION, 9)
+        if version < 10:
+            self._create_upload_table(cursor)
+            self.update_config(SCHEMA_VERSION, 10)
+        if version < 11:
+            # The update trigger now resets the retries of the queued rows
+            cursor.execute("DROP TRIGGER if exists trg_states_queue_update")
+            self._create_state_queue(cursor)
+            self.update_config(SCHEMA_VERSION, 11)
 
     def _reinit_database(self):
         self.reinit_states()
@@ -556,12 +1602,98 @@ class EngineDAO(ConfigurationDAO):
           + "remote_can_create_child INTEGER, last_remote_modifier VARCHAR,"
           + "last_sync_date TIMESTAMP, error_count INTEGER DEFAULT (0), last_sync_error_date TIMESTAMP, last_error VARCHAR, last_error_details TEXT, version INTEGER DEFAULT (0), processor INTEGER DEFAULT (0), last_transfer VARCHAR, PRIMARY KEY (id),"
           +  "UNIQUE(remote_ref, remote_parent_ref), UNIQUE(remote_ref, local_path));")
+        EngineDAO._create_state_indexes(cursor)
+        EngineDAO._create_state_counters(cursor)
+        EngineDAO._create_state_queue(cursor)
+
+    @staticmethod
+    def _create_state_indexes(cursor):
+        # remote_ref lookups are already served by the UNIQUE constraints
+        for name, columns in STATE_INDEXES:
+            cursor.execute("CREATE INDEX if not exists " + name
+                           + " ON States(" + columns + ")")
+
+    @staticmethod
+    def _create_state_counters(cursor):
+        cursor.execute("CREATE TABLE if not exists StateCounters(pair_state VARCHAR NOT NULL,"
+                       " folderish INTEGER NOT NULL, error_count INTEGER NOT NULL,"
+                       " count INTEGER NOT NULL DEFAULT (0), size INTEGER NOT NULL DEFAULT (0),"
+                       " PRIMARY KEY (pair_state, folderish, error_count))")
+        for name, event, statements in STATE_COUNTERS_TRIGGERS:
+            cursor.execute("CREATE TRIGGER if not exists " + name + " " + event
+                           + " BEGIN " + statements + " END")
+
+    @staticmethod
+    def _rebuild_state_counters(cursor):
+        """
+        Count the whole States table, only when the triggers did not follow
+        its content: the check_state_counters() test helper detects drifts.
+        """
+
+        # Start from the current content, the triggers take over from there
+        cursor.execute("DELETE FROM StateCounters")
+        cursor.execute("INSERT INTO StateCounters(pair_state, folderish, error_count, count, size)"
+                       " SELECT " + STATE_COUNTERS_KEY.format('States') + ","
+                       "        COUNT(*), SUM(IFNULL(size, 0))"
+                       "   FROM States GROUP BY 1, 2, 3")
+
+    @staticmethod
+    def _create_state_queue(cursor):
+        cursor.execute("CREATE TABLE if not exists StateQueue(row_id INTEGER NOT NULL,"
+                       " priority INTEGER NOT NULL DEFAULT (0), not_before INTEGER NOT NULL DEFAULT (0),"
+                       " attempt INTEGER NOT NULL DEFAULT (0), PRIMARY KEY (row_id))")
+        cursor.execute("CREATE INDEX if not exists idx_state_queue_order ON StateQueue(priority DESC, row_id)")
+        for name, event, statements in STATE_QUEUE_TRIGGERS:
+            cursor.execute("CREATE TRIGGER if not exists " + name + " " + event
+                           + " BEGIN " + statements + " END")
+
+    @staticmethod
+    def _rebuild_state_queue(cursor):
+        """ Queue the whole States table, only when the triggers did not follow its content. """
+
+        # Drop the rows that do not need a synchronization anymore, keeping
+        # the retry state of the others
+        cursor.execute("DELETE FROM StateQueue WHERE row_id NOT IN"
+                       " (SELECT id FROM States WHERE NOT " + STATE_QUEUE_SYNCED.format('States') + ")")
+        cursor.execute("INSERT OR IGNORE INTO StateQueue(row_id, priority)"
+                       " SELECT id, IFNULL(folderish, 0) FROM States"
+                       "  WHERE NOT " + STATE_QUEUE_SYNCED.format('States'))
+
+    @staticmethod
+    def _create_download_table(cursor):
+        cursor.execute("CREATE TABLE if not exists Downloads(path VARCHAR NOT NULL, remote_ref VARCHAR,"
+                       " digest VARCHAR, downloaded INTEGER NOT NULL DEFAULT (0), last_update TIMESTAMP,"
+                       " PRIMARY KEY (path))")
+
+    @staticmethod
+    def _create_upload_table(cursor):
+        cursor.execute("CREATE TABLE if not exists Uploads(path VARCHAR NOT NULL, batch_id VARCHAR NOT NULL,"
+                       " file_size INTEGER, mtime REAL, chunk_size INTEGER, chunks BLOB, last_update TIMESTAMP,"
+                       " PRIMARY KEY (path))")
+
+    def check_state_counters(self):
+        """
+        Compare the StateCounters table with the States content.
+        Return the list of (key, expected, actual) mismatches, used by the tests.
+        """
+
+        c = self._get_read_connection().cursor()
+        expected = dict(((row[0], row[1], row[2]), (row[3], row[4])) for row in c.execute(
+            "SELECT " + STATE_COUNTERS_KEY.format('States') + ", COUNT(*), SUM(IFNULL(size, 0))"
+            "  FROM States GROUP BY 1, 2, 3"))
+        actual = dict(((row[0], row[1], row[2]), (row[3], row[4])) for row in c.execute(
+            "SELECT pair_state, folderish, error_count, count, size FROM StateCounters"))
+        return [(key, expected.get(key), actual.get(key))
+                for key in sorted(set(expected) | set(actual))
+                if expected.get(key) != actual.get(key)]
 
     def _init_db(self, cursor):
         super(EngineDAO, self)._init_db(cursor)
         cursor.execute("CREATE TABLE if not exists Filters(path STRING NOT NULL, PRIMARY KEY(path))")
         cursor.execute("CREATE TABLE if not exists RemoteScan(path STRING NOT NULL, PRIMARY KEY(path))")
         cursor.execute("CREATE TABLE if not exists ToRemoteScan(path STRING NOT NULL, PRIMARY KEY(path))")
+        self._create_download_table(cursor)
+        self._create_upload_table(cursor)
         self._create_state_table(cursor)
 
     def _get_read_connection(self, factory=None):
@@ -572,28 +1704,26 @@ class EngineDAO(ConfigurationDAO):
     def acquire_state(self, thread_id, row_id):
         if self.acquire_processor(thread_id, row_id):
             # Avoid any lock for this call by using the write connection
+            # Only release this row, the thread may hold others for a batch
             try:
-                return self.get_state_from_id(row_id, from_write=True)
+                state = self.get_state_from_id(row_id, from_write=True)
             except:
-                self.release_processor(thread_id)
+                self._leases.release_row(row_id)
                 raise
+            if state is not None:
+                return state
+            self._leases.release_row(row_id)
         raise sqlite3.OperationalError("Cannot acquire")
 
-    def release_state(self, thread_id):
+    def release_state(self, thread_id, row_id=None):
+        """ Release the rows acquired by the thread, or only `row_id`. """
+        if row_id is not None:
+            self._leases.release_row(row_id)
+            return
         self.release_processor(thread_id)
 
     def release_processor(self, processor_id):
-        self._lock.acquire()
-        try:
-            con = self._get_write_connection()
-            c = con.cursor()
-            # TO_REVIEW Might go back to primary key id
-            c.execute("UPDATE States SET processor=0 WHERE processor=?", (processor_id,))
-            if self.auto_commit:
-                con.commit()
-        finally:
-            self._lock.release()
-        res = c.rowcount > 0
+        res = self._leases.release(processor_id) > 0
         if res:
             log.trace('Released processor %d', processor_id)
         else:
@@ -601,26 +1731,32 @@ class EngineDAO(ConfigurationDAO):
         return res
 
     def acquire_processor(self, thread_id, row_id):
-        self._lock.acquire()
-        try:
-            con = self._get_write_connection()
-            c = con.cursor()
-            c.execute("UPDATE States SET processor=? WHERE id=? AND (processor=0 OR processor=?)", (thread_id, row_id, thread_id))
-            if self.auto_commit:
-                con.commit()
-        finally:
-            self._lock.release()
-        res = c.rowcount == 1
+        # The processor column is not used anymore, leases only live in memory
+        res = self._leases.acquire(thread_id, row_id)
         if res:
             log.trace('Acquired processor %d for row %d', thread_id, row_id)
         else:
-            log.trace("Couldn't acquire processor %d for row %d: either row does't exist or it is being processed",
+            log.trace("Couldn't acquire processor %d for row %d: it is being processed",
                       thread_id, row_id)
         return res
 
+    def get_processor(self, row_id):
+        """ Return the id of the thread processing the row, 0 if none. """
+        return self._leases.get_owner(row_id)
+
+    def is_processing(self, row_id):
+        return self._leases.get_owner(row_id) > 0
+
+    def get_metrics(self):
+        metrics = super(EngineDAO, self).get_metrics()
+        metrics['db_processor_leases'] = len(self._leases)
+        return metrics
+
     def _reinit_states(self, cursor):
         cursor.execute("DROP TABLE States")
         self._create_state_table(cursor, force=True)
+        self._rebuild_state_counters(cursor)
+        self._rebuild_state_queue(cursor)
         self._delete_config(cursor, "remote_last_sync_date")
         self._delete_config(cursor, "remote_last_event_log_id")
         self._delete_config(cursor, "remote_last_event_last_root_definitions")
@@ -640,12 +1776,178 @@ class EngineDAO(ConfigurationDAO):
         finally:
             self._lock.release()
 
+    def export_states(self, path, **info):
+        """
+        Write a snapshot of the States, the Filters and the configuration
+        of the binding in a new database, to seed another binding with
+        import_states(). Extra `info` is stored in the snapshot configuration.
+        """
+
+        if os.path.exists(path):
+            raise ValueError('Snapshot %r already exists' % path)
+        # ATTACH cannot run inside a pending transaction
+        self._tx_lock.acquire()
+        self._lock.acquire()
+        try:
+            con = self._get_write_connection()
+            con.commit()
+            c = con.cursor()
+            c.execute("ATTACH DATABASE ? AS snapshot", (path,))
+            try:
+                c.execute("CREATE TABLE snapshot.States AS SELECT * FROM States")
+                c.execute("CREATE TABLE snapshot.Filters AS SELECT * FROM Filters")
+                c.execute("CREATE TABLE snapshot.Configuration(name VARCHAR NOT NULL,"
+                          " value VARCHAR, PRIMARY KEY (name))")
+                c.execute("INSERT INTO snapshot.Configuration(name, value)"
+                          " SELECT name, value FROM Configuration WHERE name IN ("
+                          + ', '.join('?' * len(SNAPSHOT_CONFIG)) + ")", SNAPSHOT_CONFIG)
+                info[SCHEMA_VERSION] = self.schema_version
+                c.executemany("INSERT OR REPLACE INTO snapshot.Configuration(name, value)"
+                              " VALUES (?, ?)", info.items())
+                count = c.execute("SELECT COUNT(*) FROM snapshot.States").fetchone()[0]
+                con.commit()
+            finally:
+                c.execute("DETACH DATABASE snapshot")
+        finally:
+            self._lock.release()
+            self._tx_lock.release()
+        log.debug('Exported %d states to %r', count, path)
+        return count
+
+    def import_states(self, path, rebase=None):
+        """
+        Replace the States and the Filters by the ones of a snapshot written
+        by export_states() for the same server and user.
+        Only the synchronized and unsynchronized states are imported. The
+        remote markers are kept only if there was no other state, else the
+        next remote scan is a full one.
+        `rebase` is an optional (old, new) couple of local paths: the states
+        under `old` in the snapshot are imported under `new`.
+        Return the snapshot configuration, with the number of imported and
+        skipped states.
+        """
+
+        self._tx_lock.acquire()
+        self._lock.acquire()
+        try:
+            con = self._get_write_connection()
+            con.commit()
+            c = con.cursor()
+            c.execute("ATTACH DATABASE ? AS snapshot", (path,))
+            try:
+                info = dict((row.name, row.value) for row in
+                            c.execute("SELECT name, value FROM snapshot.Configuration"))
+                if info.get(SCHEMA_VERSION) != str(self.schema_version):
+                    raise ValueError('Snapshot schema version %r is not %r'
+                                     % (info.get(SCHEMA_VERSION), self.schema_version))
+                for name in ('server_url', 'remote_user'):
+                    current = self.get_config(name)
+                    if current is not None and info.get(name) != current:
+                        raise ValueError('Snapshot %s %r is not %r'
+                                         % (name, info.get(name), current))
+                columns = ', '.join(self._get_columns(c, 'States'))
+                c.execute("DELETE FROM States")
+                c.execute("INSERT INTO States(" + columns + ") SELECT " + columns
+                          + " FROM snapshot.States WHERE " + STATE_QUEUE_SYNCED.format('snapshot.States'))
+                info['imported'] = c.rowcount
+                total = c.execute("SELECT COUNT(*) FROM snapshot.States").fetchone()[0]
+                info['skipped'] = total - info['imported']
+                if rebase is not None:
+                    self._rebase_local_paths(c, *rebase)
+                c.execute("DELETE FROM Filters")
+                c.execute("INSERT INTO Filters(path) SELECT path FROM snapshot.Filters")
+                c.execute("DELETE FROM RemoteScan")
+                c.execute("DELETE FROM ToRemoteScan")
+                for name in SNAPSHOT_REMOTE_MARKERS:
+                    self._delete_config(c, name)
+                    if not info['skipped'] and info.get(name) is not None:
+                        c.execute("INSERT INTO Configuration(name, value) VALUES (?, ?)",
+                                  (name, info[name]))
+                con.commit()
+            except:
+                con.rollback()
+                raise
+            finally:
+                c.execute("DETACH DATABASE snapshot")
+        finally:
+            self._lock.release()
+            self._tx_lock.release()
+        self._filters = PathTrie(row.path for row in self.get_filters())
+        self._paths_to_scan.clear()
+        self._scanned_paths.clear()
+        log.debug('Imported %d states from %r, skipped %d', info['imported'],
+                  path, info['skipped'])
+        return info
+
+    def _rebase_local_paths(self, cursor, old, new):
+        if old in ('', '/') or new in ('', '/'):
+            raise ValueError('The root cannot be rebased')
+        start = len(old) + 1
+        condition, args = self._get_descendants_condition('local_parent_path', old)
+        cursor.execute("UPDATE States SET local_parent_path = ? || substr(local_parent_path, ?),"
+                       "                  local_path = ? || substr(local_path, ?)"
+                       " WHERE" + condition, (new, start, new, start) + args)
+        cursor.execute("UPDATE States SET local_parent_path = ?, local_path = ?, local_name = ?"
+                       " WHERE local_path = ?",
+                       (os.path.dirname(new), new, os.path.basename(new), old))
+
+    def iter_states(self, size=None):
+        """
+        Iterate over all the states by pages of `size` rows, fetched
+        completely before being yielded so that the states can be updated
+        during the iteration.
+        """
+
+        size = size or Options.db_fetch_size
+        last_id = -1
+        while True:
+            c = self._get_read_connection().cursor()
+            rows = c.execute("SELECT * FROM States WHERE id > ? ORDER BY id LIMIT ?",
+                             (last_id, size)).fetchall()
+            for row in rows:
+                yield row
+            if len(rows) < size:
+                return
+            last_id = rows[-1].id
+
+    def update_imported_state(self, row, info, digest=None):
+        """
+        Update an imported state after the check of its local file:
+        `info` is None when the file is missing, then it is downloaded again,
+        and `digest` is the local digest when it differs from the remote one,
+        then the remote content is downloaded again.
+        """
+
+        if info is None:
+            row.local_state, row.remote_state = 'unknown', 'created'
+            row.last_local_updated = row.local_digest = None
+        else:
+            row.local_state = 'synchronized'
+            row.remote_state = 'synchronized' if digest is None else 'modified'
+            row.last_local_updated = info.last_modification_time
+            if digest is not None:
+                row.local_digest = digest
+        row.pair_state = self._get_pair_state(row)
+        self._lock.acquire()
+        try:
+            con = self._get_write_connection()
+            c = con.cursor()
+            c.execute("UPDATE States SET last_local_updated=?, local_digest=?,"
+                      " local_state=?, remote_state=?, pair_state=? WHERE id=?",
+                      (row.last_local_updated, row.local_digest, row.local_state,
+                       row.remote_state, row.pair_state, row.id))
+            if self.auto_commit:
+                con.commit()
+            self._queue_pair_state(row.id, row.folderish, row.pair_state, pair=row)
+        finally:
+            self._lock.release()
+
     def reinit_processors(self):
+        self._leases.clear()
         self._lock.acquire()
         try:
             con = self._get_write_connection()
             c = con.cursor()
-            c.execute("UPDATE States SET processor=0")
             c.execute("UPDATE States SET error_count=0, last_sync_error_date=NULL, last_error = NULL WHERE pair_state='synchronized'")
             if self.auto_commit:
                 con.commit()
@@ -663,9 +1965,10 @@ class EngineDAO(ConfigurationDAO):
             update = "UPDATE States SET remote_state='deleted', pair_state=?"
             c.execute(update + " WHERE id=?", ('remotely_deleted', doc_pair.id))
             if doc_pair.folderish:
-                c.execute(update + self._get_recursive_remote_condition(doc_pair), ('parent_remotely_deleted',))
+                condition, args = self._get_recursive_remote_condition(doc_pair)
+                c.execute(update + condition, ('parent_remotely_deleted',) + args)
             # Only queue parent
-            self._queue_pair_state(doc_pair.id, doc_pair.folderish, 'remotely_deleted')
+            self._queue_pair_state(doc_pair.id, doc_pair.folderish, 'remotely_deleted', pair=doc_pair)
             if self.auto_commit:
                 con.commit()
         finally:
@@ -686,7 +1989,8 @@ class EngineDAO(ConfigurationDAO):
             update = "UPDATE States SET local_state='deleted', pair_state=?"
             c.execute(update + " WHERE id=?", (current_state, doc_pair.id))
             if doc_pair.folderish:
-                c.execute(update + self._get_recursive_condition(doc_pair), ('parent_locally_deleted',))
+                condition, args = self._get_recursive_condition(doc_pair)
+                c.execute(update + condition, ('parent_locally_deleted',) + args)
             if self.auto_commit:
                 con.commit()
         finally:
@@ -694,7 +1998,7 @@ class EngineDAO(ConfigurationDAO):
             self._queue_manager.interrupt_processors_on(doc_pair.local_path, exact_match=False)
             # Only queue parent
             if current_state is not None and current_state == "locally_deleted":
-                self._queue_pair_state(doc_pair.id, doc_pair.folderish, current_state)
+                self._queue_pair_state(doc_pair.id, doc_pair.folderish, current_state, pair=doc_pair)
 
     def insert_local_state(self, info, parent_path):
         pair_state = PAIR_STATES.get(('created', 'unknown'))
@@ -709,13 +2013,10 @@ class EngineDAO(ConfigurationDAO):
                       + " VALUES(?,?,?,?,?,?,?,'created','unknown',?)", (info.last_modification_time, digest, info.path,
                                                     parent_path, name, info.folderish, info.size, pair_state))
             row_id = c.lastrowid
-            parent = c.execute("SELECT * FROM States WHERE local_path=?", (parent_path,)).fetchone()
-            # Dont queue if parent is not yet created
-            if (parent is None and parent_path == '') or (parent is not None and parent.pair_state != "locally_created"):
-                self._queue_pair_state(row_id, info.folderish, pair_state)
+            # Held by the QueueManager while its parent is in creation
+            self._queue_pair_state(row_id, info.folderish, pair_state, pair=info)
             if self.auto_commit:
                 con.commit()
-            self._items_count = self._items_count + 1
         finally:
             self._lock.release()
         return row_id
@@ -739,27 +2040,92 @@ class EngineDAO(ConfigurationDAO):
         return "pair_state != 'synchronized' AND pair_state != 'unsynchronized'"
 
     def register_queue_manager(self, manager):
-        # Prevent any update while init queue
+        # The manager loads the pending rows from the StateQueue table
+        self._queue_manager = manager
+
+    def get_queue_items(self, after=None, last_id=None, limit=None):
+        """
+        Return the next rows of the StateQueue table, ordered by priority,
+        local path then id, following the key `after` of the last row
+        previously returned and not beyond the row `last_id`.
+        The path order keeps the parents before their children across the
+        pages, the folders all coming before the files by priority.
+        Rows have the id, priority, not_before, attempt, folderish,
+        pair_state, local_path, local_parent_path, size and
+        last_local_updated fields, use get_queue_key() for their key.
+        """
+
+        conditions, args = [], []
+        if after is not None:
+            priority, path, row_id = after
+            conditions.append("(q.priority < ? OR (q.priority = ? AND (IFNULL(s.local_path, '') > ?"
+                              " OR (IFNULL(s.local_path, '') = ? AND q.row_id > ?))))")
+            args.extend((priority, priority, path, path, row_id))
+        if last_id is not None:
+            conditions.append("q.row_id <= ?")
+            args.append(last_id)
+        query = ("SELECT q.row_id AS id, q.priority, q.not_before, q.attempt,"
+                 "       s.folderish, s.pair_state, s.local_path, s.local_parent_path,"
+                 "       s.size, s.last_local_updated"
+                 "  FROM StateQueue q"
+                 "  JOIN States s ON s.id = q.row_id")
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY q.priority DESC, IFNULL(s.local_path, '') ASC, q.row_id ASC"
+        if limit is not None:
+            query += " LIMIT %d" % limit
+        c = self._get_read_connection(factory=self._state_factory).cursor()
+        return c.execute(query, args).fetchall()
+
+    @staticmethod
+    def get_queue_key(item):
+        """ Key of a row returned by get_queue_items(), to get the next ones. """
+        return item.priority, item.local_path or '', item.id
+
+    def get_queue_last_id(self):
+        c = self._get_read_connection().cursor()
+        return c.execute("SELECT MAX(row_id) AS id FROM StateQueue").fetchone().id
+
+    def update_queue_retry(self, row_id, not_before, attempt):
+        """ Persist the retry state of a queued row after an error. """
+        self._lock.acquire()
+        try:
+            con = self._get_write_connection()
+            c = con.cursor()
+            c.execute("UPDATE StateQueue SET not_before=?, attempt=? WHERE row_id=?",
+                      (not_before, attempt, row_id))
+            if self.auto_commit:
+                con.commit()
+        finally:
+            self._lock.release()
+
+    def reset_queue_retries(self):
         self._lock.acquire()
         try:
-            self._queue_manager = manager
-            con = self._get_write_connection(factory=self._state_factory)
+            con = self._get_write_connection()
             c = con.cursor()
-            # Order by path to be sure to process parents before childs
-            pairs = c.execute("SELECT * FROM States WHERE " + self._get_to_sync_condition() + " ORDER BY local_path ASC").fetchall()
-            folders = dict()
-            for pair in pairs:
-                # Add all the folders
-                if pair.folderish:
-                    folders[pair.local_path] = True
-                if pair.local_parent_path not in folders:
-                    self._queue_manager.push_ref(pair.id, pair.folderish, pair.pair_state)
-        # Dont block everything if queue manager fail
-        # TODO As the error should be fatal not sure we need this
+            c.execute("UPDATE StateQueue SET not_before=0 WHERE not_before > 0")
+            if self.auto_commit:
+                con.commit()
         finally:
             self._lock.release()
 
+    def end_batch(self):
+        pushes = None
+        if self._batch_depth == 1:
+            pushes = self._batch_pushes.values()
+            self._batch_pushes = OrderedDict()
+        super(EngineDAO, self).end_batch()
+        # Push once the changes are committed and the lock is released
+        for args in pushes or []:
+            self._queue_pair_state(*args)
+
     def _queue_pair_state(self, row_id, folderish, pair_state, pair=None):
+        if self.in_batch():
+            # Only the last state of a pair matters
+            self._batch_pushes.pop(row_id, None)
+            self._batch_pushes[row_id] = (row_id, folderish, pair_state, pair)
+            return
         if (self._queue_manager is not None
                 and pair_state not in ('synchronized', 'unsynchronized')):
             if pair_state == 'conflicted':
@@ -767,7 +2133,7 @@ class EngineDAO(ConfigurationDAO):
                 self.newConflict.emit(row_id)
             else:
                 log.trace("Push to queue: %s, pair=%r", pair_state, pair)
-                self._queue_manager.push_ref(row_id, folderish, pair_state)
+                self._queue_manager.push_ref(row_id, folderish, pair_state, pair=pair)
         else:
             log.trace("Will not push pair: %s, pair=%r", pair_state, pair)
 
@@ -841,14 +2207,8 @@ class EngineDAO(ConfigurationDAO):
                           row.id,
                       ))
             if queue:
-                parent = c.execute('SELECT *'
-                                   '  FROM States'
-                                   ' WHERE local_path = ?',
-                                   (parent_path,)).fetchone()
-                # Don't queue if parent is not yet created
-                if ((not parent and not parent_path)
-                        or (parent and parent.local_state != 'created')):
-                    self._queue_pair_state(row.id, info.folderish, row.pair_state, pair=row)
+                # Held by the QueueManager while its parent is in creation
+                self._queue_pair_state(row.id, info.folderish, row.pair_state, pair=info)
             if self.auto_commit:
                 con.commit()
         finally:
@@ -862,12 +2222,75 @@ class EngineDAO(ConfigurationDAO):
         return c.execute("SELECT * FROM States WHERE remote_digest=? AND pair_state='synchronized'", (digest,)).fetchone()
 
     def get_remote_descendants(self, path):
+        return list(self.iter_remote_descendants(path))
+
+    def iter_remote_descendants(self, path):
         c = self._get_read_connection(factory=self._state_factory).cursor()
-        return c.execute("SELECT * FROM States WHERE remote_parent_path LIKE ?", (path + '%',)).fetchall()
+        c.execute("SELECT * FROM States WHERE remote_parent_path >= ? AND remote_parent_path < ?",
+                  self._prefix_range(path))
+        return self._iter_rows(c)
 
     def get_remote_descendants_from_ref(self, ref):
+        return list(self.iter_remote_descendants_from_ref(ref))
+
+    def iter_remote_descendants_from_ref(self, ref):
+        # Follow the parent references rather than the remote paths as the
+        # descendants paths are outdated when the folder has been moved
+        if not RECURSIVE_CTE:
+            return self._iter_remote_descendants_by_level(ref)
         c = self._get_read_connection(factory=self._state_factory).cursor()
-        return c.execute("SELECT * FROM States WHERE remote_parent_path LIKE ?", ('%' + ref + '%',)).fetchall()
+        c.execute("WITH RECURSIVE Tree(ref) AS ("
+                  "    SELECT ?"
+                  "     UNION"
+                  "    SELECT States.remote_ref"
+                  "      FROM States"
+                  "      JOIN Tree ON States.remote_parent_ref = Tree.ref"
+                  ") SELECT * FROM States WHERE remote_parent_ref IN Tree", (ref,))
+        return self._iter_rows(c)
+
+    def get_remote_descendant_refs(self, path=None, ref=None):
+        """
+        Map the UTF-8 encoded remote ref of the descendants of a remote
+        path, or of a remote ref when the folder has been moved, to their
+        row id. The rows are read by pages and only these two fields are
+        kept, under 300 bytes a row: 90 MB at most for 300k documents.
+        """
+
+        if ref is not None:
+            rows = self.iter_remote_descendants_from_ref(ref)
+        else:
+            rows = self.iter_remote_descendants(path)
+        return {row.remote_ref.encode('utf-8'): row.id for row in rows}
+
+    def iter_states_from_ids(self, row_ids):
+        """
+        Yield the rows of the given ids that still exist, with a query for
+        500 ids at once. Each chunk is fully fetched before its rows are
+        yielded, so the caller can write in between.
+        """
+
+        row_ids = list(row_ids)
+        c = self._get_read_connection(factory=self._state_factory).cursor()
+        for i in xrange(0, len(row_ids), 500):
+            chunk = row_ids[i:i + 500]
+            c.execute("SELECT * FROM States WHERE id IN (" + ', '.join('?' * len(chunk)) + ")", chunk)
+            for row in c.fetchall():
+                yield row
+
+    def _iter_remote_descendants_by_level(self, ref):
+        """ iter_remote_descendants_from_ref() without recursive CTE, a level of folders at once. """
+        refs = [ref]
+        c = self._get_read_connection(factory=self._state_factory).cursor()
+        while refs:
+            parents, refs = refs, []
+            for i in xrange(0, len(parents), 500):
+                chunk = parents[i:i + 500]
+                c.execute("SELECT * FROM States WHERE remote_parent_ref IN ("
+                          + ', '.join('?' * len(chunk)) + ")", chunk)
+                for row in self._iter_rows(c):
+                    if row.folderish:
+                        refs.append(row.remote_ref)
+                    yield row
 
     def get_remote_children(self, ref):
         c = self._get_read_connection(factory=self._state_factory).cursor()
@@ -878,21 +2301,18 @@ class EngineDAO(ConfigurationDAO):
         return c.execute("SELECT * FROM States WHERE remote_parent_ref=? AND remote_state='created' AND local_state='unknown'", (ref,)).fetchall()
 
     def get_unsynchronized_count(self):
-        return self.get_count("pair_state='unsynchronized'")
+        return self._get_counter("pair_state='unsynchronized'")
 
     def get_conflict_count(self):
-        return self.get_count("pair_state='conflicted'")
+        return self._get_counter("pair_state='conflicted'")
 
     def get_error_count(self, threshold=3):
-        return self.get_count("error_count > " + str(threshold))
+        return self._get_counter("error_count > ?", (threshold,))
 
     def get_syncing_count(self, threshold=3):
-        query = "pair_state!='synchronized' AND pair_state!='conflicted' AND pair_state!='unsynchronized' AND error_count < " + str(threshold)
-        count = self.get_count(query)
-        if self._items_count is not None and count != self._items_count:
-            log.trace("Cache Syncing count incorrect should be %d was %d", count, self._items_count)
-            self._items_count = count
-        return count
+        query = ("pair_state NOT IN ('synchronized', 'conflicted', 'unsynchronized')"
+                 " AND error_count >= 0 AND error_count < ?")
+        return self._get_counter(query, (threshold,))
 
     def get_sync_count(self, filetype=None):
         query = "pair_state='synchronized'"
@@ -900,7 +2320,13 @@ class EngineDAO(ConfigurationDAO):
             query = query + " AND folderish=0"
         elif filetype == "folder":
             query = query + " AND folderish=1"
-        return self.get_count(query)
+        return self._get_counter(query)
+
+    def _get_counter(self, condition, args=()):
+        """ Number of States rows matching the condition, read from the StateCounters table. """
+        c = self._get_read_connection().cursor()
+        return c.execute("SELECT IFNULL(SUM(count), 0) as count FROM StateCounters WHERE " + condition,
+                         args).fetchone().count
 
     def get_count(self, condition=None):
         query = "SELECT COUNT(*) as count FROM States"
@@ -911,7 +2337,7 @@ class EngineDAO(ConfigurationDAO):
 
     def get_global_size(self):
         c = self._get_read_connection(factory=self._state_factory).cursor()
-        return c.execute("SELECT SUM(size) as sum FROM States WHERE pair_state='synchronized'").fetchone().sum
+        return c.execute("SELECT SUM(size) as sum FROM StateCounters WHERE pair_state='synchronized'").fetchone().sum
 
     def get_unsynchronizeds(self):
         c = self._get_read_connection(factory=self._state_factory).cursor()
@@ -922,16 +2348,25 @@ class EngineDAO(ConfigurationDAO):
         return c.execute("SELECT * FROM States WHERE pair_state='conflicted'").fetchall()
 
     def get_errors(self, limit=3):
+        return list(self.iter_errors(limit))
+
+    def iter_errors(self, limit=3):
         c = self._get_read_connection(factory=self._state_factory).cursor()
-        return c.execute("SELECT * FROM States WHERE error_count>?", (limit,)).fetchall()
+        c.execute("SELECT * FROM States WHERE error_count>?", (limit,))
+        return self._iter_rows(c)
 
     def get_local_children(self, path):
         c = self._get_read_connection(factory=self._state_factory).cursor()
         return c.execute("SELECT * FROM States WHERE local_parent_path=?", (path,)).fetchall()
 
     def get_states_from_partial_local(self, path):
+        return list(self.iter_states_from_partial_local(path))
+
+    def iter_states_from_partial_local(self, path):
         c = self._get_read_connection(factory=self._state_factory).cursor()
-        return c.execute("SELECT * FROM States WHERE local_path LIKE ?", (path + '%',)).fetchall()
+        c.execute("SELECT * FROM States WHERE local_path >= ? AND local_path < ?",
+                  self._prefix_range(path))
+        return self._iter_rows(c)
 
     def get_first_state_from_partial_remote(self, ref):
         c = self._get_read_connection(factory=self._state_factory).cursor()
@@ -972,19 +2407,54 @@ class EngineDAO(ConfigurationDAO):
                 self._lock.release()
         return state
 
+    @staticmethod
+    def _prefix_range(prefix):
+        """
+        Bounds of the values starting with the given prefix.
+        Unlike LIKE, comparing a column to them can use its index.
+        The upper bound increments the last code point of the prefix, the
+        characters beyond U+FFFF being surrogate pairs on the narrow builds.
+        """
+
+        if isinstance(prefix, bytes):
+            prefix = prefix.decode('utf-8')
+        code_points = []
+        for char in prefix:
+            code_point = ord(char)
+            if 0xdc00 <= code_point <= 0xdfff and code_points and 0xd800 <= code_points[-1] <= 0xdbff:
+                code_point = 0x10000 + ((code_points.pop() - 0xd800) << 10) + code_point - 0xdc00
+            code_points.append(code_point)
+        while code_points and code_points[-1] == MAX_CODE_POINT:
+            code_points.pop()
+        if not code_points:
+            # No upper bound: BLOB values sort after all the TEXT ones
+            return prefix, buffer(b'')
+        code_point = code_points.pop() + 1
+        if 0xd800 <= code_point <= 0xdfff:
+            # Surrogates are not characters and cannot be stored
+            code_point = 0xe000
+        code_points.append(code_point)
+        upper = u''.join(('\\U%08x' % code_point).decode('unicode-escape') for code_point in code_points)
+        return prefix, upper
+
+    def _get_descendants_condition(self, column, path):
+        """ Condition and arguments matching the children and descendants of a path. """
+        condition = (" (" + column + " = ?"
+                     " OR (" + column + " >= ? AND " + column + " < ?))")
+        return condition, (path,) + self._prefix_range(path + '/')
+
     def _get_recursive_condition(self, doc_pair):
-        res = (" WHERE (local_parent_path LIKE '" + self._escape(doc_pair.local_path) + "/%'"
-                    + " OR local_parent_path = '" + self._escape(doc_pair.local_path) + "')")
+        condition, args = self._get_descendants_condition('local_parent_path', doc_pair.local_path)
+        condition = " WHERE" + condition
         if doc_pair.remote_ref is not None:
-            res += " AND remote_parent_path LIKE '" + self._escape(doc_pair.remote_parent_path +
-                    '/' + doc_pair.remote_ref) + "%'"
-        return res
+            condition += " AND remote_parent_path >= ? AND remote_parent_path < ?"
+            args += self._prefix_range(doc_pair.remote_parent_path + '/' + doc_pair.remote_ref)
+        return condition, args
 
     def _get_recursive_remote_condition(self, doc_pair):
-        remote_path = (self._escape(doc_pair.remote_parent_path)
-                       + '/' + self._escape(doc_pair.remote_name))
-        return (" WHERE remote_parent_path LIKE '" + remote_path + "/%'"
-                " OR remote_parent_path = '" + remote_path + "'")
+        remote_path = doc_pair.remote_parent_path + '/' + doc_pair.remote_name
+        condition, args = self._get_descendants_condition('remote_parent_path', remote_path)
+        return " WHERE" + condition, args
 
     def update_remote_parent_path(self, doc_pair, new_path):
         self._lock.acquire()
@@ -993,11 +2463,11 @@ class EngineDAO(ConfigurationDAO):
             c = con.cursor()
             if doc_pair.folderish:
                 remote_path = doc_pair.remote_parent_path + "/" + doc_pair.remote_ref
-                query = "UPDATE States SET remote_parent_path='%s/%s' || substr(remote_parent_path,%d)" % (
-                    self._escape(new_path), self._escape(doc_pair.remote_ref), len(remote_path) + 1)
-                query = query + self._get_recursive_remote_condition(doc_pair)
-                log.trace("Update remote_parent_path: " + query)
-                c.execute(query)
+                query = "UPDATE States SET remote_parent_path = ? || substr(remote_parent_path, ?)"
+                condition, args = self._get_recursive_remote_condition(doc_pair)
+                log.trace("Update remote_parent_path: " + query + condition)
+                c.execute(query + condition,
+                          (new_path + '/' + doc_pair.remote_ref, len(remote_path) + 1) + args)
             c.execute("UPDATE States SET remote_parent_path=? WHERE id=?", (new_path, doc_pair.id))
             if self.auto_commit:
                 con.commit()
@@ -1023,13 +2493,12 @@ class EngineDAO(ConfigurationDAO):
             if doc_pair.folderish:
                 if new_path == '/':
                     new_path = ''
-                escaped_new_path = self._escape(new_path)
-                escaped_new_name = self._escape(new_name)
-                query = ("UPDATE States SET local_parent_path='%s/%s' || substr(local_parent_path,%d), local_path='%s/%s' || substr(local_path,%d)" %
-                         (escaped_new_path, escaped_new_name, len(doc_pair.local_path) + 1,
-                          escaped_new_path, escaped_new_name, len(doc_pair.local_path)+1))
-                query = query + self._get_recursive_condition(doc_pair)
-                c.execute(query)
+                new_local_path = new_path + '/' + new_name
+                start = len(doc_pair.local_path) + 1
+                query = ("UPDATE States SET local_parent_path = ? || substr(local_parent_path, ?),"
+                         "                  local_path = ? || substr(local_path, ?)")
+                condition, args = self._get_recursive_condition(doc_pair)
+                c.execute(query + condition, (new_local_path, start, new_local_path, start) + args)
             # Dont need to update the path as it is refresh later
             c.execute("UPDATE States SET local_parent_path=? WHERE id=?", (new_path, doc_pair.id))
             if self.auto_commit:
@@ -1045,10 +2514,11 @@ class EngineDAO(ConfigurationDAO):
             update = "UPDATE States SET local_digest=NULL, last_local_updated=NULL, local_name=NULL, remote_state='deleted', pair_state='remotely_deleted'"
             c.execute(update + " WHERE id=?", (doc_pair.id,))
             if doc_pair.folderish:
-                c.execute(update + self._get_recursive_condition(doc_pair))
+                condition, args = self._get_recursive_condition(doc_pair)
+                c.execute(update + condition, args)
             if self.auto_commit:
                 con.commit()
-            self._queue_pair_state(doc_pair.id, doc_pair.folderish, doc_pair.pair_state)
+            self._queue_pair_state(doc_pair.id, doc_pair.folderish, doc_pair.pair_state, pair=doc_pair)
         finally:
             self._lock.release()
 
@@ -1060,10 +2530,11 @@ class EngineDAO(ConfigurationDAO):
             update = "UPDATE States SET local_digest=NULL, last_local_updated=NULL, local_name=NULL, remote_state='created', pair_state='remotely_created'"
             c.execute(update + " WHERE id=" + str(doc_pair.id))
             if doc_pair.folderish:
-                c.execute(update + self._get_recursive_condition(doc_pair))
+                condition, args = self._get_recursive_condition(doc_pair)
+                c.execute(update + condition, args)
             if self.auto_commit:
                 con.commit()
-            self._queue_pair_state(doc_pair.id, doc_pair.folderish, doc_pair.pair_state)
+            self._queue_pair_state(doc_pair.id, doc_pair.folderish, doc_pair.pair_state, pair=doc_pair)
         finally:
             self._lock.release()
 
@@ -1075,10 +2546,11 @@ class EngineDAO(ConfigurationDAO):
             update = "UPDATE States SET remote_digest=NULL, remote_ref=NULL, remote_parent_ref=NULL, remote_parent_path=NULL, last_remote_updated=NULL, remote_name=NULL, remote_state='unknown', local_state='created', pair_state='locally_created'"
             c.execute(update + " WHERE id=" + str(doc_pair.id))
             if doc_pair.folderish:
-                c.execute(update + self._get_recursive_condition(doc_pair))
+                condition, args = self._get_recursive_condition(doc_pair)
+                c.execute(update + condition, args)
             if self.auto_commit:
                 con.commit()
-            self._queue_pair_state(doc_pair.id, doc_pair.folderish, doc_pair.pair_state)
+            self._queue_pair_state(doc_pair.id, doc_pair.folderish, doc_pair.pair_state, pair=doc_pair)
         finally:
             self._lock.release()
 
@@ -1090,9 +2562,10 @@ class EngineDAO(ConfigurationDAO):
             c.execute("DELETE FROM States WHERE id=?", (doc_pair.id,))
             if doc_pair.folderish:
                 if remote_recursion:
-                    c.execute("DELETE FROM States" + self._get_recursive_remote_condition(doc_pair))
+                    condition, args = self._get_recursive_remote_condition(doc_pair)
                 else:
-                    c.execute("DELETE FROM States" + self._get_recursive_condition(doc_pair))
+                    condition, args = self._get_recursive_condition(doc_pair)
+                c.execute("DELETE FROM States" + condition, args)
             if self.auto_commit:
                 con.commit()
         finally:
@@ -1121,11 +2594,9 @@ class EngineDAO(ConfigurationDAO):
             row_id = c.lastrowid
             if self.auto_commit:
                 con.commit()
-            # Check if parent is not in creation
-            parent = c.execute("SELECT * FROM States WHERE remote_ref=?", (info.parent_uid,)).fetchone()
-            if (parent is None and local_parent_path == '') or (parent is not None and parent.pair_state != "remotely_created"):
-                self._queue_pair_state(row_id, info.folderish, pair_state)
-            self._items_count = self._items_count + 1
+            # Held by the QueueManager while its parent is in creation
+            row = c.execute("SELECT * FROM States WHERE id=?", (row_id,)).fetchone()
+            self._queue_pair_state(row_id, info.folderish, pair_state, pair=row)
         finally:
             self._lock.release()
         return row_id
@@ -1139,7 +2610,7 @@ class EngineDAO(ConfigurationDAO):
                                     self._get_to_sync_condition(), (row.remote_ref, row.local_path)).fetchall()
             log.debug("Queuing %d children of '%r'", len(children), row)
             for child in children:
-                self._queue_pair_state(child.id, child.folderish, child.pair_state)
+                self._queue_pair_state(child.id, child.folderish, child.pair_state, pair=child)
         finally:
             self._lock.release()
 
@@ -1173,8 +2644,7 @@ class EngineDAO(ConfigurationDAO):
                       (last_error, row.id))
             if self.auto_commit:
                 con.commit()
-            self._queue_pair_state(row.id, row.folderish, row.pair_state)
-            self._items_count = self._items_count + 1
+            self._queue_pair_state(row.id, row.folderish, row.pair_state, pair=row)
         finally:
             self._lock.release()
         row.last_error = None
@@ -1188,13 +2658,12 @@ class EngineDAO(ConfigurationDAO):
             c = con.cursor()
             c.execute("UPDATE States SET local_state='synchronized', remote_state='modified', pair_state='remotely_modified', last_error=NULL, last_sync_error_date=NULL, error_count = 0" +
                       " WHERE id=? AND version=?", (row.id, row.version))
-            self._queue_pair_state(row.id, row.folderish, "remotely_modified")
+            self._queue_pair_state(row.id, row.folderish, "remotely_modified", pair=row)
             if self.auto_commit:
                 con.commit()
         finally:
             self._lock.release()
         if c.rowcount == 1:
-            self._items_count = self._items_count + 1
             return True
         return False
 
@@ -1206,13 +2675,12 @@ class EngineDAO(ConfigurationDAO):
             c = con.cursor()
             c.execute("UPDATE States SET local_state='resolved', remote_state='unknown', pair_state=?, last_error=NULL, last_sync_error_date=NULL, error_count = 0" +
                       " WHERE id=? AND version=?", (pair_state, row.id, row.version))
-            self._queue_pair_state(row.id, row.folderish, pair_state)
+            self._queue_pair_state(row.id, row.folderish, pair_state, pair=row)
             if self.auto_commit:
                 con.commit()
         finally:
             self._lock.release()
         if c.rowcount == 1:
-            self._items_count = self._items_count + 1
             return True
         return False
 
@@ -1229,7 +2697,6 @@ class EngineDAO(ConfigurationDAO):
         finally:
             self._lock.release()
         if c.rowcount == 1:
-            self._items_count = self._items_count - 1
             return True
         return False
 
@@ -1238,13 +2705,14 @@ class EngineDAO(ConfigurationDAO):
         try:
             con = self._get_write_connection()
             c = con.cursor()
-            c.execute("UPDATE States SET pair_state='unsynchronized', last_sync_date=?, processor = 0," +
+            c.execute("UPDATE States SET pair_state='unsynchronized', last_sync_date=?," +
                       "last_error=?, error_count=0, last_sync_error_date=NULL WHERE id=?",
                       (datetime.utcnow(), last_error, row.id))
             if self.auto_commit:
                 con.commit()
         finally:
             self._lock.release()
+        self._leases.release_row(row.id)
 
     def synchronize_state(self, row, version=None, dynamic_states=False):
         if version is None:
@@ -1270,7 +2738,6 @@ class EngineDAO(ConfigurationDAO):
                       '       pair_state = ?,'
                       '       local_digest = ?,'
                       '       last_sync_date = ?,'
-                      '       processor = 0,'
                       '       last_error = NULL,'
                       '       error_count = 0,'
                       '       last_sync_error_date = NULL'
@@ -1303,7 +2770,6 @@ class EngineDAO(ConfigurationDAO):
                           '       remote_state = ?,'
                           '       pair_state = ?,'
                           '       last_sync_date = ?,'
-                          '       processor = 0,'
                           '       last_error = NULL,'
                           '       error_count = 0,'
                           '       last_sync_error_date = NULL'
@@ -1333,8 +2799,10 @@ class EngineDAO(ConfigurationDAO):
             else:
                 log.trace('Current row=%r (version=%r)', row2, row2.version)
             log.trace('Previous row=%r (version=%r)', row, row.version)
-        elif row.folderish:
-            self.queue_children(row)
+        else:
+            self._leases.release_row(row.id)
+            if row.folderish:
+                self.queue_children(row)
 
         return result
 
@@ -1402,11 +2870,8 @@ class EngineDAO(ConfigurationDAO):
             if self.auto_commit:
                 con.commit()
             if queue:
-                # Check if parent is not in creation
-                parent = c.execute("SELECT * FROM States WHERE remote_ref=?", (info.parent_uid,)).fetchone()
-                # Parent can be None if the parent is filtered
-                if (parent is not None and parent.pair_state != "remotely_created") or parent is None:
-                    self._queue_pair_state(row.id, info.folderish, row.pair_state)
+                # Held by the QueueManager while its parent is in creation
+                self._queue_pair_state(row.id, info.folderish, row.pair_state, pair=row)
         finally:
             self._lock.release()
 
@@ -1417,16 +2882,20 @@ class EngineDAO(ConfigurationDAO):
 
     def add_path_to_scan(self, path):
         path = self._clean_filter_path(path)
+        # Even below a scheduled ancestor: that scan can be in progress and
+        # already past the path, its request must outlive the ancestor one
         self._lock.acquire()
         try:
             con = self._get_write_connection()
             c = con.cursor()
             # Remove any subchilds as it is gonna be scanned anyway
-            c.execute("DELETE FROM ToRemoteScan WHERE path LIKE ?", (path+'%',))
+            c.execute("DELETE FROM ToRemoteScan WHERE path >= ? AND path < ?", self._prefix_range(path))
             # ADD IT
             c.execute("INSERT INTO ToRemoteScan(path) VALUES(?)", (path,))
             if self.auto_commit:
                 con.commit()
+            self._paths_to_scan.discard_subtree(path)
+            self._paths_to_scan.add(path)
         except sqlite3.IntegrityError:
             pass
         finally:
@@ -1438,10 +2907,10 @@ class EngineDAO(ConfigurationDAO):
         try:
             con = self._get_write_connection()
             c = con.cursor()
-            # ADD IT
             c.execute("DELETE FROM ToRemoteScan WHERE path=?", (path,))
             if self.auto_commit:
                 con.commit()
+            self._paths_to_scan.discard(path)
         except sqlite3.IntegrityError:
             pass
         finally:
@@ -1451,6 +2920,63 @@ class EngineDAO(ConfigurationDAO):
         c = self._get_read_connection().cursor()
         return c.execute(u"SELECT * FROM ToRemoteScan").fetchall()
 
+    def get_download(self, path):
+        """ Progress record of the interrupted download to the `path` temporary file. """
+        c = self._get_read_connection().cursor()
+        return c.execute(u"SELECT * FROM Downloads WHERE path=?", (path,)).fetchone()
+
+    def save_download(self, path, remote_ref, digest, downloaded=0):
+        self._lock.acquire()
+        try:
+            con = self._get_write_connection()
+            c = con.cursor()
+            c.execute("INSERT OR REPLACE INTO Downloads(path, remote_ref, digest, downloaded, last_update)"
+                      " VALUES(?, ?, ?, ?, datetime('now'))", (path, remote_ref, digest, downloaded))
+            if self.auto_commit:
+                con.commit()
+        finally:
+            self._lock.release()
+
+    def remove_download(self, path):
+        self._lock.acquire()
+        try:
+            con = self._get_write_connection()
+            c = con.cursor()
+            c.execute("DELETE FROM Downloads WHERE path=?", (path,))
+            if self.auto_commit:
+                con.commit()
+        finally:
+            self._lock.release()
+
+    def get_upload(self, path):
+        """ Batch and uploaded chunks bitmap of the interrupted chunked upload of `path`. """
+        c = self._get_read_connection().cursor()
+        return c.execute(u"SELECT * FROM Uploads WHERE path=?", (path,)).fetchone()
+
+    def save_upload(self, path, batch_id, file_size, mtime, chunk_size, chunks):
+        self._lock.acquire()
+        try:
+            con = self._get_write_connection()
+            c = con.cursor()
+            c.execute("INSERT OR REPLACE INTO Uploads(path, batch_id, file_size, mtime, chunk_size, chunks,"
+                      " last_update) VALUES(?, ?, ?, ?, ?, ?, datetime('now'))",
+                      (path, batch_id, file_size, mtime, chunk_size, sqlite3.Binary(chunks)))
+            if self.auto_commit:
+                con.commit()
+        finally:
+            self._lock.release()
+
+    def remove_upload(self, path):
+        self._lock.acquire()
+        try:
+            con = self._get_write_connection()
+            c = con.cursor()
+            c.execute("DELETE FROM Uploads WHERE path=?", (path,))
+            if self.auto_commit:
+                con.commit()
+        finally:
+            self._lock.release()
+
     def add_path_scanned(self, path):
         path = self._clean_filter_path(path)
         self._lock.acquire()
@@ -1461,6 +2987,7 @@ class EngineDAO(ConfigurationDAO):
             c.execute("INSERT INTO RemoteScan(path) VALUES(?)", (path,))
             if self.auto_commit:
                 con.commit()
+            self._scanned_paths.add(path)
         except sqlite3.IntegrityError:
             pass
         finally:
@@ -1474,14 +3001,12 @@ class EngineDAO(ConfigurationDAO):
             c.execute("DELETE FROM RemoteScan")
             if self.auto_commit:
                 con.commit()
+            self._scanned_paths.clear()
         finally:
             self._lock.release()
 
     def is_path_scanned(self, path):
-        path = self._clean_filter_path(path)
-        c = self._get_read_connection().cursor()
-        row = c.execute("SELECT COUNT(path) FROM RemoteScan WHERE path=? LIMIT 1", (path,)).fetchone()
-        return row[0] > 0
+        return self._clean_filter_path(path) in self._scanned_paths
 
     def get_previous_sync_file(self, ref, sync_mode=None):
         mode_condition = ""
@@ -1518,10 +3043,7 @@ class EngineDAO(ConfigurationDAO):
         return c.execute("SELECT * FROM States WHERE remote_parent_ref=? AND remote_name < ? AND folderish=0 ORDER BY remote_name DESC LIMIT 1", (state.remote_parent_ref,state.remote_name)).fetchone()
 
     def is_filter(self, path):
-        path = self._clean_filter_path(path)
-        if any([path.startswith(filter_obj.path) for filter_obj in self._filters]):
-            return True
-        return False
+        return self._filters.has_ancestor(self._clean_filter_path(path))
 
     def get_filters(self):
         c = self._get_read_connection().cursor()
@@ -1536,16 +3058,17 @@ class EngineDAO(ConfigurationDAO):
             con = self._get_write_connection()
             c = con.cursor()
             # DELETE ANY SUBFILTERS
-            c.execute("DELETE FROM Filters WHERE path LIKE ?", (path + '%',))
+            c.execute("DELETE FROM Filters WHERE path >= ? AND path < ?", self._prefix_range(path))
             # PREVENT ANY RESCAN
-            c.execute("DELETE FROM ToRemoteScan WHERE path LIKE ?", (path+'%',))
+            c.execute("DELETE FROM ToRemoteScan WHERE path >= ? AND path < ?", self._prefix_range(path))
             # ADD IT
             c.execute("INSERT INTO Filters(path) VALUES(?)", (path,))
             # TODO ADD THIS path AS remotely_deleted
             if self.auto_commit:
                 con.commit()
-            self._filters = self.get_filters()
-            self._items_count = self.get_syncing_count()
+            self._filters.discard_subtree(path)
+            self._filters.add(path)
+            self._paths_to_scan.discard_subtree(path)
         finally:
             self._lock.release()
 
@@ -1555,11 +3078,10 @@ class EngineDAO(ConfigurationDAO):
         try:
             con = self._get_write_connection()
             c = con.cursor()
-            c.execute("DELETE FROM Filters WHERE path LIKE ?", (path + '%',))
+            c.execute("DELETE FROM Filters WHERE path >= ? AND path < ?", self._prefix_range(path))
             if self.auto_commit:
                 con.commit()
-            self._filters = self.get_filters()
-            self._items_count = self.get_syncing_count()
+            self._filters.discard_subtree(path)
         finally:
             self._lock.release()
 
@@ -10,6 +10,7 @@ from PyQt4.QtCore import QCoreApplication, QObject, pyqtSignal, pyqtSlot
 
 from nxdrive.client import LocalClient, RemoteDocumentClient, \
     RemoteFileSystemClient, RemoteFilteredFileSystemClient
+from nxdrive.client.bandwidth import RateLimiter
 from nxdrive.client.base_automation_client import Unauthorized
 from nxdrive.client.common import BaseClient, NotFound, safe_filename
 from nxdrive.client.rest_api_client import RestAPIClient
@@ -25,7 +26,7 @@ from nxdrive.logging_config import get_logger
 from nxdrive.manager import ServerBindingSettings
 from nxdrive.options import Options
 from nxdrive.osi import AbstractOSIntegration
-from nxdrive.utils import normalized_path
+from nxdrive.utils import guess_digest_algorithm, normalized_path
 
 log = get_logger(__name__)
 
@@ -167,6 +168,12 @@ class Engine(QObject):
         if binder is not None:
             self.bind(binder)
         self._load_configuration()
+        # Bandwidth limits of the engine, within the global ones
+        self._limiters = {
+            'upload': RateLimiter(parent=manager.upload_limiter),
+            'download': RateLimiter(parent=manager.download_limiter),
+        }
+        self._load_rate_limits()
         self._local_watcher = self._create_local_watcher()
         self.create_thread(worker=self._local_watcher)
         self._remote_watcher = self._create_remote_watcher(Options.delay)
@@ -181,6 +188,8 @@ class Engine(QObject):
         self._remote_watcher.remoteWatcherStopped.connect(self._queue_manager.shutdown_processors)
         # Connect last_sync checked
         self._remote_watcher.updated.connect(self._check_last_sync)
+        # Apply the limits set meanwhile by the 'bandwidth' command
+        self._remote_watcher.updated.connect(self._load_rate_limits)
         # Connect for sync start
         self.newQueueItem.connect(self._check_sync_start)
         self._queue_manager.newItem.connect(self._check_sync_start)
@@ -669,11 +678,102 @@ class Engine(QObject):
         metrics["unsynchronized_files"] = self._dao.get_unsynchronized_count()
         metrics["files_size"] = self._dao.get_global_size()
         metrics["invalid_credentials"] = self._invalid_credentials
+        metrics.update(self._dao.get_metrics())
+        for direction, limiter in self._limiters.items():
+            metrics.update(limiter.get_metrics(direction))
         return metrics
 
+    @pyqtSlot()
+    def _load_rate_limits(self):
+        for direction, limiter in self._limiters.items():
+            rate, schedule = self.get_rate_limit(direction)
+            try:
+                limiter.configure(rate * 1024, schedule)
+            except ValueError:
+                log.exception('Invalid %s limits of %r', direction, self.uid)
+
+    def get_rate_limit(self, direction):
+        """ Return the rate in KiB/s and the schedule of the 'upload' or 'download' limit. """
+        rate = int(self._dao.get_config(direction + '_rate', 0))
+        schedule = self._dao.get_config(direction + '_schedule')
+        return rate, schedule.split(',') if schedule else []
+
+    def set_rate_limit(self, direction, rate=0, schedule=None):
+        """
+        Limit the 'upload' or 'download' rate of the engine in KiB/s, 0 for
+        unlimited, and by time of day with a schedule like
+        ['08:00-18:00=128', '18:00-08:00=0'].
+        """
+
+        self._limiters[direction].configure(rate * 1024, schedule)
+        self._dao.update_config(direction + '_rate', rate)
+        self._dao.update_config(direction + '_schedule', ','.join(schedule or []))
+
+    def _set_limiters(self, remote_client):
+        remote_client.upload_limiter = self._limiters['upload']
+        remote_client.download_limiter = self._limiters['download']
+
     def get_conflicts(self):
         return self._dao.get_conflicts()
 
+    def export_states(self, path):
+        """ Write a snapshot of the states to seed another binding, see import_states(). """
+        return self._dao.export_states(path, local_folder=self.local_folder)
+
+    def import_states(self, path, rebase=None):
+        """
+        Seed a new binding with the snapshot exported by an engine bound to
+        the same server and user, then check the local files instead of
+        downloading them all again.
+        """
+
+        if self.is_started():
+            raise RuntimeError('Cannot import states into a started engine')
+        info = self._dao.import_states(path, rebase=rebase)
+        log.debug('Imported states of %r into %r', info.get('local_folder'),
+                  self.local_folder)
+        info.update(self.verify_local_states())
+        return info
+
+    def verify_local_states(self):
+        """
+        Check the local files of the synchronized states, typically just
+        imported: files with the same size and modification time are trusted,
+        the digest of the others is compared. Missing and modified files are
+        downloaded again by the next synchronization.
+        """
+
+        local_client = self.get_local_client()
+        result = {'verified': 0, 'missing': 0, 'modified': 0}
+        self._dao.begin_batch()
+        try:
+            for row in self._dao.iter_states():
+                if (row.pair_state != 'synchronized' or row.local_path is None
+                        or row.local_path == '/'):
+                    continue
+                info = local_client.get_info(row.local_path, raise_if_missing=False)
+                if info is None or info.folderish != bool(row.folderish):
+                    self._dao.update_imported_state(row, None)
+                    result['missing'] += 1
+                    continue
+                digest = None
+                last_mtime = info.last_modification_time.strftime('%Y-%m-%d %H:%M:%S')
+                if not info.folderish and (
+                        info.size != row.size or row.last_local_updated is None
+                        or last_mtime != row.last_local_updated.split('.')[0]):
+                    algorithm = guess_digest_algorithm(row.remote_digest)
+                    local_digest = info.get_digest(digest_func=algorithm)
+                    if local_digest != row.remote_digest:
+                        digest = local_digest
+                if info.remote_ref != row.remote_ref:
+                    local_client.set_remote_id(row.local_path, row.remote_ref)
+                self._dao.update_imported_state(row, info, digest=digest)
+                result['modified' if digest else 'verified'] += 1
+        finally:
+            self._dao.end_batch()
+        log.debug('Verified local states of %r: %r', self.local_folder, result)
+        return result
+
     def conflict_resolver(self, row_id, emit=True):
         pair = self._dao.get_state_from_id(row_id)
         if not pair:
@@ -885,6 +985,7 @@ class Engine(QObject):
         client = LocalClient(
             self.local_folder,
             case_sensitive=self._case_sensitive,
+            digest_cache=self._dao,
         )
         if self._case_sensitive is None and os.path.exists(self.local_folder):
             self._case_sensitive = client.is_case_sensitive()
@@ -995,6 +1096,9 @@ class Engine(QObject):
                         timeout=self.timeout, cookie_jar=self.cookie_jar,
                         token=self._remote_token,
                         check_suspended=self.suspend_client)
+            self._set_limiters(remote_client)
+            # Keep the chunked uploads to resume them, even after a restart
+            remote_client.upload_store = self._dao
             cache[cache_key] = remote_client
         return remote_client
 
@@ -1014,6 +1118,7 @@ class Engine(QObject):
                 repository=repository, base_folder=base_folder,
                 timeout=self._handshake_timeout, cookie_jar=self.cookie_jar,
                 check_suspended=self.suspend_client)
+            self._set_limiters(remote_client)
             cache[cache_key] = remote_client
         return remote_client
 
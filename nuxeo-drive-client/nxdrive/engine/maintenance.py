@@ -0,0 +1,83 @@
+# coding: utf-8
+""" Maintenance of the manager and engines databases. """
+
+from threading import current_thread
+from time import time
+
+from PyQt4.QtCore import QThread
+
+from nxdrive.engine.workers import PollWorker
+from nxdrive.logging_config import get_logger
+from nxdrive.options import Options
+
+log = get_logger(__name__)
+
+# Seconds between two maintenances of a database with nothing to reclaim,
+# to keep the statistics of the query planner up to date
+ANALYZE_INTERVAL = 24 * 3600
+
+
+class DatabaseMaintenance(PollWorker):
+    """
+    Low priority worker running the maintenance of the databases.
+
+    The statistics of every database are refreshed on each poll, but the
+    maintenance of an engine database only runs while its queue is empty,
+    so that it never delays the synchronization.
+    """
+
+    def __init__(self, manager, check_interval=Options.db_maintenance_interval):
+        super(DatabaseMaintenance, self).__init__(check_interval)
+        self._manager = manager
+        self._metrics['maintenances'] = 0
+        self._metrics['skipped_maintenances'] = 0
+
+    def _execute(self):
+        self._thread.setPriority(QThread.LowestPriority)
+        super(DatabaseMaintenance, self)._execute()
+
+    def _get_daos(self):
+        yield 'manager', self._manager.get_dao(), None
+        for uid, engine in self._manager.get_engines().items():
+            yield uid, engine.get_dao(), engine
+
+    @staticmethod
+    def _is_idle(engine):
+        return (engine is None or engine.is_stopped()
+                or not engine.get_queue_manager().is_active())
+
+    @staticmethod
+    def _needs_maintenance(dao, stats):
+        return (stats['db_freelist'] > 0 or stats['db_wal_size'] > 0
+                or time() - dao.get_last_maintenance() > ANALYZE_INTERVAL)
+
+    def maintain(self, full=False):
+        """
+        Run the maintenance of the idle databases needing it, or of all the
+        idle databases if `full`.
+        Return the statistics of each database by name, 'manager' or the
+        engine uid.
+        """
+
+        result = dict()
+        for name, dao, engine in self._get_daos():
+            if current_thread().ident == self._thread_id:
+                self._interact()
+            try:
+                stats = dao.get_db_stats()
+                if full or self._needs_maintenance(dao, stats):
+                    if self._is_idle(engine):
+                        stats = dao.run_maintenance(full=full)
+                        self._metrics['maintenances'] += 1
+                    else:
+                        log.trace('Engine %s is busy, delaying its maintenance', name)
+                        self._metrics['skipped_maintenances'] += 1
+            except Exception:
+                log.exception('Maintenance of the %s database failed', name)
+                continue
+            result[name] = stats
+        return result
+
+    def _poll(self):
+        self.maintain()
+        return True
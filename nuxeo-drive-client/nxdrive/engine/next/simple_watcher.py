@@ -2,7 +2,7 @@
 import copy
 import os
 from Queue import Queue
-from time import sleep, time
+from time import time
 
 from watchdog.events import DirModifiedEvent
 
@@ -107,7 +107,7 @@ class SimpleWatcher(LocalWatcher):
         if not os.path.exists(src_path):
             log.warning("Event on a disappeared file: %r %s %s", evt, rel_path, file_name)
             return
-        if doc_pair is not None and doc_pair.processor > 0:
+        if doc_pair is not None and self._dao.is_processing(doc_pair.id):
             log.warning("Don't update as in process %r", doc_pair)
             return
         if isinstance(evt, DirModifiedEvent):
@@ -138,23 +138,22 @@ class SimpleWatcher(LocalWatcher):
             self._action = Action("Full local scan")
             self._scan()
             self._end_action()
-            # Check windows dequeue and folder scan only every 100 loops ( every 1s )
+            # Check windows dequeue and folder scan only every second
             current_time_millis = int(round(time() * 1000))
             self._win_delete_interval = current_time_millis
             self._win_folder_scan_interval = current_time_millis
-            i = 0
+            next_scan = time() + 1
             while (1):
                 self._interact()
-                sleep(0.01)
+                self._wait(next_scan - time())
                 while (not self._watchdog_queue.empty()):
                     # Dont retest if already local scan
                     evt = self._watchdog_queue.get()
                     self.handle_watchdog_event(evt)
                 # Check to scan
-                i += 1
-                if i % 100 != 0:
+                if time() < next_scan:
                     continue
-                i = 0
+                next_scan = time() + 1
                 threshold_time = current_milli_time() - 1000 * self._scan_delay
                 # Need to create a list of to scan as the dictionary cannot grow while iterating
                 local_scan = []
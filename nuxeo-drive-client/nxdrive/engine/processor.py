@@ -4,18 +4,19 @@ import shutil
 import sqlite3
 import socket
 from threading import Lock
-from time import sleep
+from time import sleep, time
 from urllib2 import HTTPError, URLError
 
 from PyQt4.QtCore import pyqtSignal
 
 from nxdrive.client.base_automation_client import DOWNLOAD_TMP_FILE_PREFIX, \
-    DOWNLOAD_TMP_FILE_SUFFIX
+    DOWNLOAD_TMP_FILE_SUFFIX, NewUploadAPINotAvailable
 from nxdrive.client.common import DuplicationDisabledError, NotFound, \
     UNACCESSIBLE_HASH, safe_filename
 from nxdrive.engine.activity import Action
 from nxdrive.engine.workers import EngineWorker, PairInterrupt, ThreadInterrupt
 from nxdrive.logging_config import get_logger
+from nxdrive.options import Options
 from nxdrive.osi import AbstractOSIntegration
 from nxdrive.utils import current_milli_time, is_generated_tmp_file
 
@@ -284,6 +285,8 @@ class Processor(EngineWorker):
                             log.debug('Delaying conflicted document: %r', doc_pair)
                             self._postpone_pair(doc_pair, 'Conflict')
                         else:
+                            if exc.code >= 500:
+                                self._engine.get_queue_manager().record_failure()
                             self._handle_pair_handler_exception(
                                 doc_pair, handler_name, exc)
                         del exc  # Fix reference leak
@@ -292,6 +295,8 @@ class Processor(EngineWorker):
                         # socket.error for SSLError
                         log.debug('%s on %r, wait 1s and requeue',
                                   type(exc).__name__, doc_pair)
+                        if not isinstance(exc, PairInterrupt):
+                            self._engine.get_queue_manager().record_failure()
                         sleep(1)
                         self._engine.get_queue_manager().push(doc_pair)
                         del exc  # Fix reference leak
@@ -351,6 +356,8 @@ class Processor(EngineWorker):
             speed = (action.size / duration) * 1000
             log.trace("Transfer speed %d ko/s", speed / 1024)
             self._current_metrics["speed"] = speed
+            self._engine.get_queue_manager().record_transfer(
+                action.size, duration / 1000.0)
 
     def _synchronize_if_not_remotely_dirty(
         self,
@@ -584,7 +591,6 @@ class Processor(EngineWorker):
                           name, parent_pair.remote_name)
                 fs_item_info = remote_client.make_folder(parent_ref, name,
                                                          overwrite=overwrite)
-                remote_ref = fs_item_info.uid
             else:
                 # TODO Check if the file is already on the server with the
                 # TODO good digest
@@ -606,42 +612,21 @@ class Processor(EngineWorker):
                     if doc_pair.local_digest == UNACCESSIBLE_HASH:
                         self._postpone_pair(doc_pair, 'Unaccessible hash')
                         return
-                fs_item_info = remote_client.stream_file(
-                    parent_ref, local_client.abspath(doc_pair.local_path),
-                    filename=name, overwrite=overwrite)
-                remote_ref = fs_item_info.uid
+                fs_item_info = None
+                if (not overwrite and Options.batch_upload_files > 1
+                        and info.size <= Options.batch_upload_size
+                        and remote_client.is_new_upload_api_available()):
+                    fs_item_info = self._upload_batch(
+                        doc_pair, parent_pair, local_client, remote_client)
+                if fs_item_info is None:
+                    fs_item_info = remote_client.stream_file(
+                        parent_ref, local_client.abspath(doc_pair.local_path),
+                        filename=name, overwrite=overwrite)
+                    self._update_speed_metrics()
                 self._dao.update_last_transfer(doc_pair.id, "upload")
-                self._update_speed_metrics()
-            self._dao.acquire_lock()
-            try:
-                remote_id_done = False
-                # NXDRIVE-599: set as soon as possible the remote_id as
-                # update_remote_state can crash with InterfaceError
-                try:
-                    local_client.set_remote_id(doc_pair.local_path, remote_ref)
-                    remote_id_done = True
-                except (NotFound, IOError, OSError):
-                    pass
-                self._dao.update_remote_state(doc_pair, fs_item_info,
-                                              remote_parent_path=remote_parent_path,
-                                              versionned=False, queue=False)
-            finally:
-                self._dao.release_lock()
-            log.trace("Put remote_ref in %s", remote_ref)
-            try:
-                if not remote_id_done:
-                    local_client.set_remote_id(doc_pair.local_path, remote_ref)
-            except (NotFound, IOError, OSError):
-                new_pair = self._dao.get_state_from_id(doc_pair.id)
-                # File has been moved during creation
-                if new_pair.local_path != doc_pair.local_path:
-                    local_client.set_remote_id(new_pair.local_path, remote_ref)
-                    self._synchronize_locally_moved(new_pair, local_client,
-                                                    remote_client, update=False)
-                    return
-            self._synchronize_if_not_remotely_dirty(doc_pair, local_client,
-                                                    remote_client,
-                                                    remote_info=fs_item_info)
+            self._set_remotely_created(doc_pair, fs_item_info,
+                                       remote_parent_path, local_client,
+                                       remote_client)
         else:
             child_type = 'folder' if doc_pair.folderish else 'file'
             log.warning('Will not synchronize %s %r created in'
@@ -659,6 +644,168 @@ class Processor(EngineWorker):
                                               parent_pair.remote_name)
                 self._handle_unsynchronized(local_client, doc_pair)
 
+    def _set_remotely_created(self, doc_pair, fs_item_info, remote_parent_path,
+                              local_client, remote_client, remote_id_done=None):
+        """
+        Bind a locally created pair to the document created on the server.
+        `remote_id_done` is the result of a previous _link_remotely_created().
+        """
+
+        remote_ref = fs_item_info.uid
+        if remote_id_done is None:
+            remote_id_done = self._link_remotely_created(
+                doc_pair, fs_item_info, remote_parent_path, local_client)
+        log.trace("Put remote_ref in %s", remote_ref)
+        try:
+            if not remote_id_done:
+                local_client.set_remote_id(doc_pair.local_path, remote_ref)
+        except (NotFound, IOError, OSError):
+            new_pair = self._dao.get_state_from_id(doc_pair.id)
+            # File has been moved during creation
+            if new_pair.local_path != doc_pair.local_path:
+                local_client.set_remote_id(new_pair.local_path, remote_ref)
+                self._synchronize_locally_moved(new_pair, local_client,
+                                                remote_client, update=False)
+                return
+        self._synchronize_if_not_remotely_dirty(doc_pair, local_client,
+                                                remote_client,
+                                                remote_info=fs_item_info)
+
+    def _link_remotely_created(self, doc_pair, fs_item_info, remote_parent_path,
+                               local_client):
+        """
+        Record the document created on the server on the pair, without any
+        interruption point. Return True if its remote id was set on the file.
+        """
+
+        self._dao.acquire_lock()
+        try:
+            remote_id_done = False
+            # NXDRIVE-599: set as soon as possible the remote_id as
+            # update_remote_state can crash with InterfaceError
+            try:
+                local_client.set_remote_id(doc_pair.local_path, fs_item_info.uid)
+                remote_id_done = True
+            except (NotFound, IOError, OSError):
+                pass
+            self._dao.update_remote_state(doc_pair, fs_item_info,
+                                          remote_parent_path=remote_parent_path,
+                                          versionned=False, queue=False)
+        finally:
+            self._dao.release_lock()
+        return remote_id_done
+
+    def _upload_batch(self, doc_pair, parent_pair, local_client, remote_client):
+        """
+        Upload the file of the pair in a single batch with the other small
+        files created in the same folder and waiting in the queue.
+        Return the info of the document created for the pair, None if it
+        has to be uploaded on its own.
+        The other files failing in the batch are queued again to be
+        uploaded on their own.
+        """
+
+        queue_manager = self._engine.get_queue_manager()
+        pairs = []
+        # Queuing time of the batched pairs, to queue them again at their place
+        queued = dict()
+        for item, queued_at in queue_manager.get_batch(
+                doc_pair, Options.batch_upload_files - 1):
+            pair = self._acquire_batch_pair(item, doc_pair, local_client)
+            if pair is None:
+                queue_manager.restore_batch_item(item, queued_at)
+            else:
+                pairs.append(pair)
+                queued[pair.id] = queued_at
+        if not pairs:
+            return None
+
+        pairs.insert(0, doc_pair)
+        files = [(local_client.abspath(batch_pair.local_path),
+                  os.path.basename(batch_pair.local_path))
+                 for batch_pair in pairs]
+        log.debug('Creating %d remote documents in folder %r in a batch',
+                  len(pairs), parent_pair.remote_name)
+        tick = time()
+        try:
+            results = remote_client.stream_files(parent_pair.remote_ref, files)
+        except NewUploadAPINotAvailable:
+            results = [None] * len(pairs)
+        except Exception:
+            for pair in pairs[1:]:
+                self._dao.release_state(self._thread_id, row_id=pair.id)
+                queue_manager.restore_batch_item(pair, queued[pair.id])
+            raise
+        duration = time() - tick
+        if duration > 0:
+            queue_manager.record_transfer(
+                sum(pair.size or 0 for pair in pairs), duration)
+
+        remote_parent_path = (parent_pair.remote_parent_path + '/'
+                              + parent_pair.remote_ref)
+        # Record all the created documents on their rows before anything
+        # that can be interrupted, so that none is uploaded again
+        created = []
+        for pair, result in zip(pairs, results):
+            if result is None or isinstance(result, Exception):
+                if pair is not doc_pair:
+                    log.debug('Batch upload failed for %r: %r', pair, result)
+                    self._dao.release_state(self._thread_id, row_id=pair.id)
+                    queue_manager.push_batch_failure(pair)
+                continue
+            remote_id_done = self._link_remotely_created(
+                pair, result, remote_parent_path, local_client)
+            self._dao.update_last_transfer(pair.id, 'upload')
+            if pair is not doc_pair:
+                created.append((pair, result, remote_id_done))
+        for i, (pair, result, remote_id_done) in enumerate(created):
+            try:
+                self._set_remotely_created(pair, result, remote_parent_path,
+                                           local_client, remote_client,
+                                           remote_id_done=remote_id_done)
+            except ThreadInterrupt:
+                # Bound to their document, the next processing of the
+                # remaining pairs only checks them
+                for remaining, _, _ in created[i:]:
+                    self._dao.release_state(self._thread_id, row_id=remaining.id)
+                    queue_manager.restore_batch_item(remaining, queued[remaining.id])
+                raise
+            except Exception as e:
+                log.exception('Batch creation error')
+                self.increase_error(pair, 'SYNC_HANDLER_locally_created',
+                                    exception=e)
+        if isinstance(results[0], Exception):
+            log.debug('Batch upload failed for %r, upload it alone: %r',
+                      doc_pair, results[0])
+            return None
+        return results[0]
+
+    def _acquire_batch_pair(self, item, doc_pair, local_client):
+        """
+        Acquire the pair of a queued item to upload it in the batch of
+        `doc_pair`, None if it has to be processed on its own.
+        """
+
+        try:
+            pair = self._dao.acquire_state(self._thread_id, item.id)
+        except sqlite3.OperationalError:
+            return None
+        if (pair.pair_state == 'locally_created'
+                and not pair.folderish
+                and not pair.error_count
+                and pair.local_digest != UNACCESSIBLE_HASH
+                and pair.local_parent_path == doc_pair.local_parent_path
+                and not is_generated_tmp_file(
+                    os.path.basename(pair.local_path))[0]):
+            try:
+                if (local_client.get_remote_id(pair.local_path) is None
+                        and local_client.get_info(pair.local_path).size == pair.size):
+                    return pair
+            except (NotFound, IOError, OSError):
+                pass
+        self._dao.release_state(self._thread_id, row_id=pair.id)
+        return None
+
     def _synchronize_locally_deleted(self, doc_pair, local_client, remote_client):
         if not doc_pair.remote_ref:
             self._dao.remove_state(doc_pair)
@@ -773,20 +920,40 @@ class Processor(EngineWorker):
                              + DOWNLOAD_TMP_FILE_SUFFIX))
 
     def _download_content(self, local_client, remote_client, doc_pair, file_path):
+        file_out = self._get_temporary_file(file_path)
+        ref = local_client.get_path(file_out)
         # Check if the file is already on the HD
         pair = self._dao.get_valid_duplicate_file(doc_pair.remote_digest)
         if pair:
-            file_out = self._get_temporary_file(file_path)
             locker = local_client.unlock_path(file_out)
             try:
                 shutil.copy(local_client.abspath(pair.local_path), file_out)
             finally:
                 local_client.lock_path(file_out, locker)
+            self._dao.remove_download(ref)
             return file_out
 
-        tmp_file = remote_client.stream_content(
-                                doc_pair.remote_ref, file_path,
-                                parent_fs_item_id=doc_pair.remote_parent_ref)
+        # Resume an interrupted download only if it was of the same content
+        partial = self._dao.get_download(ref)
+        if os.path.exists(file_out) and (partial is None
+                                         or partial.remote_ref != doc_pair.remote_ref
+                                         or partial.digest != doc_pair.remote_digest):
+            log.debug('Discarding the outdated partial download %r', file_out)
+            os.remove(file_out)
+        self._dao.save_download(ref, doc_pair.remote_ref, doc_pair.remote_digest)
+        try:
+            tmp_file = remote_client.stream_content(
+                                    doc_pair.remote_ref, file_path,
+                                    parent_fs_item_id=doc_pair.remote_parent_ref,
+                                    file_out=file_out, resume=True)
+        except Exception:
+            if os.path.exists(file_out):
+                self._dao.save_download(ref, doc_pair.remote_ref, doc_pair.remote_digest,
+                                        downloaded=os.path.getsize(file_out))
+            else:
+                self._dao.remove_download(ref)
+            raise
+        self._dao.remove_download(ref)
         self._update_speed_metrics()
         return tmp_file
 
@@ -1031,6 +1198,7 @@ class Processor(EngineWorker):
                     file_out = self._get_temporary_file(local_client.abspath(doc_pair.local_path))
                     if os.path.exists(file_out):
                         os.remove(file_out)
+                    self._dao.remove_download(local_client.get_path(file_out))
                 if self._engine.use_trash():
                     local_client.delete(doc_pair.local_path)
                 else:
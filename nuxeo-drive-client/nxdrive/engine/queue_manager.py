@@ -1,23 +1,130 @@
 # coding: utf-8
+import calendar
+import math
 import time
 from Queue import Empty, Queue
+from collections import OrderedDict
 from copy import deepcopy
-from threading import Lock, local
+from datetime import datetime
+from functools import partial
+from heapq import heapify, heappop, heappush
+from itertools import count
+from threading import Lock, current_thread, local
 
 from PyQt4.QtCore import QObject, QTimer, pyqtSignal, pyqtSlot
 
+from nxdrive.engine.blacklist_queue import RetryScheduler, backoff
 from nxdrive.engine.processor import Processor
 from nxdrive.logging_config import get_logger
+from nxdrive.options import Options
 
 log = get_logger(__name__)
 WINERROR_CODE_PROCESS_CANNOT_ACCESS_FILE = 32
 
+# Advance in seconds given by the scheduling policies, see QueueScheduler
+PIN_ADVANCE = 24 * 3600
+DIRECT_EDIT_ADVANCE = 3600
+RECENCY_ADVANCE = 600
+SIZE_ADVANCE = 300
+# Files of this size or bigger get no advance from the size policy
+SIZE_ADVANCE_LIMIT = 1024 ** 3
+
+# States of the rows creating their document, see DependencyGraph
+CREATION_STATES = ('locally_created', 'remotely_created')
+
+# Seconds between two resizings of the processors pool
+POOL_ADJUST_INTERVAL = 10
+# Ratio of failed transfers halving the processors pool
+POOL_ERROR_RATE = 0.2
+# Relative throughput drop cancelling the last growth of the processors pool
+POOL_THROUGHPUT_TOLERANCE = 0.1
+
+
+def get_timestamp(value):
+    """ Timestamp of a UTC datetime or of its SQLite representation. """
+    if value is None:
+        return None
+    if not isinstance(value, datetime):
+        try:
+            value = datetime.strptime(value.split('.')[0], '%Y-%m-%d %H:%M:%S')
+        except ValueError:
+            return None
+    return calendar.timegm(value.utctimetuple())
+
+
+def pin_policy(scheduler, item, now):
+    """ Items pinned by the user. """
+    return PIN_ADVANCE if scheduler.is_boosted(item.id, 'pin') else 0
+
+
+def direct_edit_policy(scheduler, item, now):
+    """ Synchronized copies of the documents just saved with Direct Edit. """
+    return DIRECT_EDIT_ADVANCE if scheduler.is_boosted(item.id, 'direct_edit') else 0
+
+
+def recency_policy(scheduler, item, now):
+    """ Local changes of the last minutes, the most recent first. """
+    if not item.pair_state.startswith('locally'):
+        return 0
+    updated = get_timestamp(getattr(item, 'last_local_updated', None))
+    if updated is None:
+        return 0
+    return max(0, RECENCY_ADVANCE - max(0, now - updated))
+
+
+def size_policy(scheduler, item, now):
+    """ Smallest files first. """
+    size = getattr(item, 'size', None)
+    if item.folderish or size is None:
+        return 0
+    ratio = math.log(size + 1) / math.log(SIZE_ADVANCE_LIMIT)
+    return SIZE_ADVANCE * (1 - min(ratio, 1))
+
+
+# Available scheduling policies, enabled by Options.queue_policies
+QUEUE_POLICIES = {
+    'direct_edit': direct_edit_policy,
+    'pin': pin_policy,
+    'recency': recency_policy,
+    'size': size_policy,
+}
+
+
+def get_parent_path(path):
+    """ Local parent path of a local path, '' for the root. """
+    if not path or path == '/':
+        return ''
+    return path.rsplit('/', 1)[0] or '/'
+
+
+def get_pair_field(pair, *names):
+    """ Value of the first of the `names` fields a pair or a FileInfo has, else None. """
+    for name in names:
+        try:
+            return getattr(pair, name)
+        except (AttributeError, IndexError):
+            # StateRow raises an IndexError for the unknown fields
+            continue
+    return None
+
+
+def is_creation(item):
+    return item.pair_state in CREATION_STATES
+
 
 class QueueItem(object):
-    def __init__(self, row_id, folderish, pair_state):
+    def __init__(self, row_id, folderish, pair_state, size=None,
+                 last_local_updated=None, local_path=None,
+                 local_parent_path=None):
         self.id = row_id
         self.folderish = folderish
         self.pair_state = pair_state
+        # Used by the scheduling policies
+        self.size = size
+        self.last_local_updated = last_local_updated
+        # Used by the DependencyGraph
+        self.local_path = local_path
+        self.local_parent_path = local_parent_path
 
     def __repr__(self):
         return "%s[%s](Folderish:%s, State: %s)" % (
@@ -25,6 +132,452 @@ class QueueItem(object):
                         self.folderish, self.pair_state)
 
 
+class QueueScheduler(object):
+    """
+    Scheduling of the items of the QueueManager queues.
+
+    Each policy gives an advance in seconds to an item, the items are then
+    served by their queuing time minus the sum of their advances.
+    This ages the items: an item can only be overtaken by the ones queued
+    less than their advance after it, so none of them starves.
+    The priority of an item is the policy giving it the largest advance,
+    used for the depth and wait time metrics.
+    """
+
+    def __init__(self, policies=None):
+        if policies is None:
+            policies = Options.queue_policies
+        self._policies = []
+        for name in policies:
+            if name not in QUEUE_POLICIES:
+                log.warning('Unknown queue policy %r', name)
+                continue
+            self._policies.append((name, QUEUE_POLICIES[name]))
+        self.priorities = [name for name, _ in self._policies] + ['default']
+        self._lock = Lock()
+        self._boosts = dict()
+        self._depths = dict((name, 0) for name in self.priorities)
+        self._waits = dict((name, [0, 0]) for name in self.priorities)
+
+    def boost(self, row_id, policy):
+        with self._lock:
+            self._boosts.setdefault(row_id, set()).add(policy)
+
+    def unboost(self, row_id, policy=None):
+        with self._lock:
+            policies = self._boosts.get(row_id)
+            if policies is None:
+                return
+            policies.discard(policy)
+            if policy is None or not policies:
+                del self._boosts[row_id]
+
+    def is_boosted(self, row_id, policy):
+        return policy in self._boosts.get(row_id, ())
+
+    def schedule(self, item, queued_at):
+        """ Return the scheduling time and the priority of the item. """
+        advance, best, priority = 0, 0, 'default'
+        for name, policy in self._policies:
+            value = policy(self, item, queued_at)
+            advance += value
+            if value > best:
+                best, priority = value, name
+        return queued_at - advance, priority
+
+    def queued(self, priority, previous=None):
+        with self._lock:
+            if previous is not None:
+                self._depths[previous] -= 1
+            self._depths[priority] += 1
+
+    def removed(self, priority):
+        with self._lock:
+            self._depths[priority] -= 1
+
+    def dequeued(self, item, priority, wait):
+        with self._lock:
+            self._depths[priority] -= 1
+            self._waits[priority][0] += 1
+            self._waits[priority][1] += wait
+            # Only pins outlive the processing of the item
+            policies = self._boosts.get(item.id)
+            if policies is not None:
+                policies &= {'pin'}
+                if not policies:
+                    del self._boosts[item.id]
+
+    def get_metrics(self):
+        metrics = dict()
+        with self._lock:
+            for name in self.priorities:
+                served, wait = self._waits[name]
+                metrics['queue_%s_depth' % name] = self._depths[name]
+                metrics['queue_%s_wait' % name] = int(wait * 1000 / served) if served else 0
+        return metrics
+
+
+class ProcessorPool(object):
+    """
+    Adaptive size of the pool of GenericProcessor threads.
+
+    The size is adjusted every `interval` seconds from the transfers of the
+    elapsed period, AIMD style:
+      - halved when too many transfers failed (timeouts, network errors);
+      - decreased by one when the last growth lowered the throughput;
+      - increased by one while more files are waiting than processors,
+        and the throughput did not drop.
+    """
+
+    # Values of the processors_decision metric
+    DECREASE, HOLD, INCREASE = -1, 0, 1
+
+    def __init__(self, minimum, maximum, size, interval=POOL_ADJUST_INTERVAL):
+        self.minimum = max(0, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.size = min(max(size, self.minimum), self.maximum)
+        self._interval = interval
+        self._lock = Lock()
+        self._start = time.time()
+        self._transfers = self._failures = self._bytes = 0
+        self._transfer_time = 0
+        self._throughput = None
+        self._last_decision = self.HOLD
+        self._metrics = {
+            'processors_increases': 0,
+            'processors_decreases': 0,
+            'processors_throughput': 0,
+            'processors_transfer_speed': 0,
+            'processors_error_rate': 0,
+        }
+
+    def is_adaptive(self):
+        return self.minimum < self.maximum
+
+    def record_transfer(self, size, duration):
+        """ Record a transfer of `size` bytes lasting `duration` seconds. """
+        with self._lock:
+            self._transfers += 1
+            self._bytes += size
+            self._transfer_time += duration
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+
+    def adjust(self, pending, now=None):
+        """
+        Resize the pool if the period is elapsed, `pending` being the number
+        of files waiting. Return True if the pool has grown.
+        """
+
+        now = time.time() if now is None else now
+        with self._lock:
+            elapsed = now - self._start
+            if elapsed < self._interval:
+                return False
+            transfers, failures = self._transfers, self._failures
+            throughput = self._bytes / elapsed
+            speed = self._bytes / self._transfer_time if self._transfer_time else 0
+            self._start = now
+            self._transfers = self._failures = self._bytes = 0
+            self._transfer_time = 0
+
+            error_rate = float(failures) / (transfers + failures) if failures else 0
+            dropped = (self._throughput is not None and transfers
+                       and throughput < self._throughput * (1 - POOL_THROUGHPUT_TOLERANCE))
+            size = self.size
+            if error_rate > POOL_ERROR_RATE:
+                size = size // 2
+            elif dropped and self._last_decision == self.INCREASE:
+                size -= 1
+            elif pending > size and not dropped:
+                size += 1
+            size = min(max(size, self.minimum), self.maximum)
+
+            if size > self.size:
+                decision, key = self.INCREASE, 'processors_increases'
+            elif size < self.size:
+                decision, key = self.DECREASE, 'processors_decreases'
+            else:
+                decision, key = self.HOLD, None
+            if key:
+                self._metrics[key] += 1
+                log.debug('Resizing the processors pool from %d to %d:'
+                          ' throughput=%d B/s, error_rate=%.2f, pending=%d',
+                          self.size, size, throughput, error_rate, pending)
+            self.size = size
+            self._last_decision = decision
+            if transfers:
+                self._throughput = throughput
+            self._metrics['processors_throughput'] = int(throughput)
+            self._metrics['processors_transfer_speed'] = int(speed)
+            self._metrics['processors_error_rate'] = int(error_rate * 100)
+            return decision == self.INCREASE
+
+    def get_metrics(self):
+        with self._lock:
+            metrics = dict(self._metrics)
+            metrics['processors_limit'] = self.size
+            metrics['processors_decision'] = self._last_decision
+        return metrics
+
+
+class SchedulingQueue(Queue):
+    """
+    Queue serving its items in the order given by a QueueScheduler.
+
+    A row is queued at most once: pushing a row already queued replaces its
+    item in place, the row keeping its queuing time.
+    Replaced entries are only flagged as removed in the heap and skipped
+    when reaching its head.
+    """
+
+    # Rebuild the heap when it holds more removed entries than this
+    COMPACT_THRESHOLD = 64
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.coalesced = 0
+        Queue.__init__(self)
+
+    def _init(self, maxsize):
+        # Entries are [scheduling time, sequence, item, queuing time, priority],
+        # item is None for removed entries
+        self.queue = []
+        self._entries = dict()
+        self._sequence = count()
+
+    def _qsize(self, len=len):
+        return len(self._entries)
+
+    def _put(self, item):
+        """ Queue the item, return False if it replaced a queued one. """
+        previous = self._entries.get(item.id)
+        if previous is None:
+            self._schedule(item, time.time(), next(self._sequence))
+            return True
+        self.coalesced += 1
+        self._replace(previous, item)
+        return False
+
+    def _schedule(self, item, queued_at, sequence, previous=None):
+        scheduled, priority = self.scheduler.schedule(item, queued_at)
+        entry = [scheduled, sequence, item, queued_at, priority]
+        heappush(self.queue, entry)
+        self._entries[item.id] = entry
+        self.scheduler.queued(priority, previous=previous)
+
+    def _replace(self, entry, item):
+        entry[2] = None
+        self._schedule(item, entry[3], entry[1], previous=entry[4])
+        self._compact()
+
+    def _get(self):
+        while True:
+            _, _, item, queued_at, priority = heappop(self.queue)
+            if item is not None:
+                break
+        del self._entries[item.id]
+        self.scheduler.dequeued(item, priority, time.time() - queued_at)
+        return item
+
+    def _compact(self):
+        if len(self.queue) - len(self._entries) > self.COMPACT_THRESHOLD:
+            self.queue = [entry for entry in self.queue if entry[2] is not None]
+            heapify(self.queue)
+
+    def put(self, item, block=True, timeout=None):
+        # Unbounded, never blocks
+        self.push(item)
+
+    def push(self, item):
+        """ Queue the item, return False if the row was already queued. """
+        with self.mutex:
+            queued = self._put(item)
+            if queued:
+                # A replaced item is still the one task of its row
+                self.unfinished_tasks += 1
+            self.not_empty.notify()
+        return queued
+
+    def remove(self, row_id):
+        """ Remove the queued item of a row, return True if there was one. """
+        with self.mutex:
+            entry = self._entries.pop(row_id, None)
+            if entry is None:
+                return False
+            entry[2] = None
+            self.scheduler.removed(entry[4])
+            self._compact()
+            # A removed item will never be marked as done
+            self.unfinished_tasks -= 1
+            if not self.unfinished_tasks:
+                self.all_tasks_done.notify_all()
+            return True
+
+    def __contains__(self, row_id):
+        return row_id in self._entries
+
+    def peek(self):
+        """ Scheduling time of the next item, None if empty. """
+        with self.mutex:
+            while self.queue and self.queue[0][2] is None:
+                heappop(self.queue)
+            return self.queue[0][0] if self.queue else None
+
+    def get_items(self):
+        """ Items in the order they will be served. """
+        with self.mutex:
+            return [entry[2] for entry in sorted(self._entries.itervalues())]
+
+    def reschedule(self, row_id):
+        """ Schedule again the queued item of a row, after a boost change. """
+        with self.mutex:
+            entry = self._entries.get(row_id)
+            if entry is not None:
+                self._replace(entry, entry[2])
+
+    def pop(self, predicate=None):
+        """
+        Return the next item without waiting, None if the queue is empty
+        or if the item does not match the predicate.
+        """
+
+        with self.mutex:
+            while self.queue and self.queue[0][2] is None:
+                heappop(self.queue)
+            if not self.queue:
+                return None
+            if predicate is not None and not predicate(self.queue[0][2]):
+                return None
+            item = self._get()
+            self.not_full.notify()
+            return item
+
+    def take(self, predicate, limit):
+        """
+        Remove up to `limit` items matching the predicate, in the order they
+        would have been served, and return them with their queuing time.
+        """
+
+        with self.mutex:
+            entries = sorted(entry for entry in self._entries.itervalues()
+                             if predicate(entry[2]))[:limit]
+            now = time.time()
+            items = []
+            for entry in entries:
+                item = entry[2]
+                entry[2] = None
+                del self._entries[item.id]
+                self.scheduler.dequeued(item, entry[4], now - entry[3])
+                items.append((item, entry[3]))
+            self._compact()
+            return items
+
+    def restore(self, item, queued_at):
+        """
+        Queue again an item taken out of the queue at its former place, with
+        its queuing time. Return False if the row was queued again meanwhile.
+        """
+
+        with self.mutex:
+            if item.id in self._entries:
+                return False
+            self._schedule(item, queued_at, next(self._sequence))
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+            return True
+
+
+class DependencyGraph(object):
+    """
+    Dependencies of the queued rows on the creation of their parent folder.
+
+    A folder creation is a node of the graph from its push until it leaves
+    the processors. The rows pushed below a node are held by it instead of
+    being queued, and released once it completes: the children of a folder
+    run only once it is created, while the independent folders can be
+    created in parallel.
+    Rows are linked by their local path, the ones pushed without it are
+    never held.
+    Not thread-safe, the QueueManager serializes the calls.
+    """
+
+    def __init__(self):
+        # Local path of each folder creation and the reverse mapping
+        self._nodes = dict()
+        self._paths = dict()
+        # Row id of each node and the items it holds, by row id
+        self._held = dict()
+        # Row id of each held item and its node
+        self._holders = dict()
+
+    def __contains__(self, row_id):
+        return row_id in self._nodes
+
+    def is_held(self, row_id):
+        return row_id in self._holders
+
+    def get_blocker(self, item):
+        """ Row id of the closest folder creation above the item, if any. """
+        path = item.local_parent_path
+        if path is None:
+            path = get_parent_path(item.local_path)
+        while path:
+            row_id = self._paths.get(path)
+            if row_id is not None and row_id != item.id:
+                return row_id
+            path = get_parent_path(path)
+        return None
+
+    def add(self, item):
+        """
+        Register a pushed item, holding it if a folder creation above it is
+        pending. Return the row id of that creation, None if it is runnable.
+        """
+
+        self._unhold(item.id)
+        if item.folderish and is_creation(item) and item.local_path:
+            previous = self._nodes.get(item.id)
+            if previous is not None and self._paths.get(previous) == item.id:
+                del self._paths[previous]
+            self._nodes[item.id] = item.local_path
+            self._paths[item.local_path] = item.id
+        blocker = self.get_blocker(item)
+        if blocker is not None:
+            self._held.setdefault(blocker, OrderedDict())[item.id] = item
+            self._holders[item.id] = blocker
+        return blocker
+
+    def _unhold(self, row_id):
+        blocker = self._holders.pop(row_id, None)
+        if blocker is not None:
+            held = self._held[blocker]
+            del held[row_id]
+            if not held:
+                del self._held[blocker]
+
+    def done(self, row_id):
+        """ Remove a completed row from the graph, return the items it held. """
+        self._unhold(row_id)
+        path = self._nodes.pop(row_id, None)
+        if path is not None and self._paths.get(path) == row_id:
+            del self._paths[path]
+        held = self._held.pop(row_id, None)
+        if not held:
+            return []
+        for held_id in held:
+            del self._holders[held_id]
+        return held.values()
+
+    def get_metrics(self):
+        return {
+            'dependency_nodes': len(self._nodes),
+            'dependency_held': len(self._holders),
+        }
+
+
 class QueueManager(QObject):
     # Always create thread from the main thread
     newItem = pyqtSignal(object)
@@ -36,14 +589,24 @@ class QueueManager(QObject):
     # Only used by Unit Test
     _disable = False
 
-    def __init__(self, engine, dao, max_file_processors=5):
+    def __init__(self, engine, dao, max_file_processors=None):
         super(QueueManager, self).__init__()
         self._dao = dao
         self._engine = engine
-        self._local_folder_queue = Queue()
-        self._local_file_queue = Queue()
-        self._remote_file_queue = Queue()
-        self._remote_folder_queue = Queue()
+        self._scheduler = QueueScheduler()
+        self._local_folder_queue = SchedulingQueue(self._scheduler)
+        self._local_file_queue = SchedulingQueue(self._scheduler)
+        self._remote_file_queue = SchedulingQueue(self._scheduler)
+        self._remote_folder_queue = SchedulingQueue(self._scheduler)
+        # Pushes of a queued row moved to the queue of its new state
+        self._coalesced = 0
+        # Rows waiting for the creation of their parent folder
+        self._dependencies = DependencyGraph()
+        self._dependencies_lock = Lock()
+        # Row in process by each processor thread
+        self._processing = dict()
+        # Rows to upload on their own after a failed batch upload
+        self._batch_failures = set()
         self._connected = local()
         self._local_folder_enable = True
         self._local_file_enable = True
@@ -55,9 +618,16 @@ class QueueManager(QObject):
         self._remote_file_thread = None
         self._error_threshold = 3
         self._error_interval = 60
-        self.set_max_processors(max_file_processors)
+        # Adaptive between Options.min_processors and Options.max_processors,
+        # unless a fixed number of file processors is given
+        self._pool = ProcessorPool(Options.min_processors - 2,
+                                   Options.max_processors - 2, 3)
+        if max_file_processors is not None:
+            self.set_max_processors(max_file_processors)
         self._threads_pool = list()
         self._processors_pool = list()
+        # Thread ids of the processors leaving the pool after a shrink
+        self._retired_processors = set()
         self._get_file_lock = Lock()
         # Should not operate on thread while we are inspecting them
         '''
@@ -77,13 +647,22 @@ class QueueManager(QObject):
 
         # ERROR HANDLING
         self._error_lock = Lock()
-        self._on_error_queue = dict()
+        self._on_error_queue = RetryScheduler()
+        # Armed for the next retry only
         self._error_timer = QTimer()
+        self._error_timer.setSingleShot(True)
         self._error_timer.timeout.connect(self._on_error_timer)
         self.newError.connect(self._on_new_error)
         self.queueProcessing.connect(self.launch_processors)
+        # PERSISTED QUEUE
+        # Rows queued before the start are loaded by pages, up to the last
+        # one known at that time, the next ones are pushed as they come
+        self._backlog_lock = Lock()
+        self._backlog_after = None
         # LAST ACTION
         self._dao.register_queue_manager(self)
+        self._backlog_last = self._dao.get_queue_last_id()
+        self._load_backlog()
 
     def init_processors(self):
         log.trace("Init processors")
@@ -105,14 +684,22 @@ class QueueManager(QObject):
 
     @staticmethod
     def _copy_queue(queue):
-        result = deepcopy(queue.queue)
+        result = deepcopy(queue.get_items())
         result.reverse()
         return result
 
     def set_max_processors(self, max_file_processors):
+        """ Use a fixed number of file processors. """
         if max_file_processors < 2:
             max_file_processors = 2
-        self._max_processors = max_file_processors - 2
+        size = max_file_processors - 2
+        self._pool = ProcessorPool(size, size, size)
+
+    def record_transfer(self, size, duration):
+        self._pool.record_transfer(size, duration)
+
+    def record_failure(self):
+        self._pool.record_failure()
 
     def resume(self):
         log.debug("Resuming queue")
@@ -175,61 +762,236 @@ class QueueManager(QObject):
     def get_remote_folder_queue(self):
         return self._copy_queue(self._remote_folder_queue)
 
-    def push_ref(self, row_id, folderish, pair_state):
-        self.push(QueueItem(row_id, folderish, pair_state))
+    def push_ref(self, row_id, folderish, pair_state, pair=None):
+        item = QueueItem(row_id, folderish, pair_state)
+        if pair is not None:
+            # A pair or the FileInfo of a local change
+            item.size = get_pair_field(pair, 'size')
+            item.last_local_updated = get_pair_field(
+                pair, 'last_local_updated', 'last_modification_time')
+            item.local_path = get_pair_field(pair, 'local_path', 'path')
+            item.local_parent_path = get_pair_field(pair, 'local_parent_path')
+        self.push(item)
+
+    def boost(self, row_id, policy='pin'):
+        """
+        Favor a row with a policy based on boosts, 'pin' or 'direct_edit'.
+        Pins last until unboost(), the other boosts until the row is processed.
+        """
+
+        self._scheduler.boost(row_id, policy)
+        self._reschedule(row_id)
+
+    def unboost(self, row_id, policy='pin'):
+        self._scheduler.unboost(row_id, policy)
+        self._reschedule(row_id)
+
+    def _reschedule(self, row_id):
+        for queue in self._get_queues():
+            queue.reschedule(row_id)
+
+    def _get_queues(self):
+        return (self._local_folder_queue, self._local_file_queue,
+                self._remote_folder_queue, self._remote_file_queue)
+
+    def _load_backlog(self):
+        """
+        Push the next page of rows from the persisted queue, once the
+        in-memory queues are running low.
+        Rows still waiting for a retry go back to the error queue.
+        """
+
+        if self._backlog_last is None:
+            return
+        page_size = Options.queue_page_size
+        if self.get_overall_size() > page_size // 2:
+            return
+        if not self._backlog_lock.acquire(False):
+            # Already loading from another thread
+            return
+        try:
+            items = self._dao.get_queue_items(after=self._backlog_after,
+                                              last_id=self._backlog_last,
+                                              limit=page_size)
+            if len(items) < page_size:
+                self._backlog_last = None
+            if items:
+                self._backlog_after = self._dao.get_queue_key(items[-1])
+            log.trace('Loading %d items from the persisted queue', len(items))
+            cur_time = int(time.time())
+            pushed = False
+            # Folder creations first, parents before children, so that the
+            # rows below them in the page wait for them
+            items.sort(key=lambda item: (
+                not (item.folderish and is_creation(item)),
+                len(item.local_path or '')))
+            for item in items:
+                queue_item = QueueItem(item.id, item.folderish, item.pair_state,
+                                       size=item.size,
+                                       last_local_updated=item.last_local_updated,
+                                       local_path=item.local_path,
+                                       local_parent_path=item.local_parent_path)
+                if item.not_before > cur_time:
+                    self._push_on_error(queue_item, item.not_before)
+                elif self._put(queue_item):
+                    pushed = True
+            if pushed:
+                self.newItem.emit(None)
+        finally:
+            self._backlog_lock.release()
 
     def push(self, state):
+        if self._put(state):
+            self.newItem.emit(state.id)
+
+    def _put(self, state):
+        """
+        Put the state in its queue, return True if it has been queued and
+        False if it is not processable or replaced the queued item of the row.
+        """
         if state.pair_state is None:
             log.trace("Don't push an empty pair_state: %r", state)
-            return
+            return False
         log.trace("Pushing %r", state)
-        row_id = state.id
         if state.pair_state.startswith('locally'):
-            if state.folderish:
-                self._local_folder_queue.put(state)
-                log.trace('Pushed to _local_folder_queue, now of size: %d', self._local_folder_queue.qsize())
-            else:
-                if "deleted" in state.pair_state:
-                    self._engine.cancel_action_on(state.id)
-                self._local_file_queue.put(state)
-                log.trace('Pushed to _local_file_queue, now of size: %d', self._local_file_queue.qsize())
-            self.newItem.emit(row_id)
+            name = 'local'
         elif state.pair_state.startswith('remotely'):
-            if state.folderish:
-                self._remote_folder_queue.put(state)
-                log.trace('Pushed to _remote_folder_queue, now of size: %d', self._remote_folder_queue.qsize())
-            else:
-                if "deleted" in state.pair_state:
-                    self._engine.cancel_action_on(state.id)
-                self._remote_file_queue.put(state)
-                log.trace('Pushed to _remote_file_queue, now of size: %d', self._remote_file_queue.qsize())
-            self.newItem.emit(row_id)
+            name = 'remote'
         else:
             # deleted and conflicted
             log.debug("Not processable state: %r", state)
+            return False
+        name += '_folder_queue' if state.folderish else '_file_queue'
+        if not state.folderish and "deleted" in state.pair_state:
+            self._engine.cancel_action_on(state.id)
+        queue = getattr(self, '_' + name)
+        with self._dependencies_lock:
+            blocker = self._dependencies.add(state)
+            if blocker is not None:
+                # Queued once its parent folder is created
+                for other in self._get_queues():
+                    other.remove(state.id)
+                log.trace('Holding %r until the end of row %d', state, blocker)
+                return False
+            # A row is queued once, in the queue of its last state
+            moved = False
+            for other in self._get_queues():
+                if other is not queue and other.remove(state.id):
+                    moved = True
+            queued = queue.push(state)
+        if moved:
+            self._coalesced += 1
+        log.trace('Pushed to _%s, now of size: %d', name, queue.qsize())
+        return queued
+
+    def get_batch(self, doc_pair, limit):
+        """
+        Take from the local file queue up to `limit` small files created in
+        the same folder as the pair, to upload them along with it.
+        Return (item, queuing time) tuples, see restore_batch_item().
+        """
+
+        if doc_pair.id in self._batch_failures:
+            # Failed in a batch, upload it on its own
+            self._batch_failures.discard(doc_pair.id)
+            return []
+        parent_path = doc_pair.local_parent_path
+        max_size = Options.batch_upload_size
+
+        def match(item):
+            return (item.pair_state == 'locally_created'
+                    and not item.folderish
+                    and item.size is not None and item.size <= max_size
+                    and (item.local_parent_path
+                         or get_parent_path(item.local_path)) == parent_path
+                    and item.id != doc_pair.id
+                    and item.id not in self._batch_failures
+                    and not self._is_on_error(item.id))
+
+        return self._local_file_queue.take(match, limit)
+
+    def restore_batch_item(self, item, queued_at):
+        """
+        Queue again an item of get_batch() left out of the batch, at its
+        former place unless the row was pushed again meanwhile.
+        """
+
+        with self._dependencies_lock:
+            if any(item.id in queue for queue in self._get_queues()):
+                return
+            restored = self._local_file_queue.restore(item, queued_at)
+        if restored:
+            self.newItem.emit(item.id)
+
+    def push_batch_failure(self, doc_pair):
+        """ Queue again a pair that failed in a batch, to upload it alone. """
+        self._batch_failures.add(doc_pair.id)
+        self.push(doc_pair)
+
+    def _dispatch(self, item_getter):
+        """
+        Item getter of the processors: the previous row of the calling
+        processor is over, the next one is in process.
+        """
+
+        thread_id = current_thread().ident
+        previous = self._processing.pop(thread_id, None)
+        if previous is not None:
+            self._release(previous)
+        item = item_getter()
+        if item is not None:
+            self._processing[thread_id] = item.id
+        return item
+
+    def _release(self, row_id):
+        """ Queue the rows held by a row leaving the processors. """
+        with self._dependencies_lock:
+            # Still pending if queued again, after an error for instance
+            if (self._is_on_error(row_id)
+                    or row_id in self._processing.values()
+                    or any(row_id in queue for queue in self._get_queues())):
+                return
+            held = self._dependencies.done(row_id)
+        if not held:
+            return
+        log.trace('Releasing %d rows held by row %d', len(held), row_id)
+        pushed = False
+        for item in held:
+            if self._put(item):
+                pushed = True
+        if pushed:
+            self.newItem.emit(None)
 
     @pyqtSlot()
     def _on_error_timer(self):
-        cur_time = int(time.time())
         self._error_lock.acquire()
         try:
-            for doc_pair in self._on_error_queue.values():
-                if doc_pair.error_next_try < cur_time:
-                    queue_item = QueueItem(doc_pair.id, doc_pair.folderish, doc_pair.pair_state)
-                    del self._on_error_queue[doc_pair.id]
-                    log.debug('End of blacklist period, pushing doc_pair: %r', doc_pair)
-                    self.push(queue_item)
-            if len(self._on_error_queue) == 0:
-                self._error_timer.stop()
+            for doc_pair in self._on_error_queue.pop_all():
+                queue_item = QueueItem(
+                    doc_pair.id, doc_pair.folderish, doc_pair.pair_state,
+                    size=doc_pair.size,
+                    last_local_updated=doc_pair.last_local_updated,
+                    local_path=doc_pair.local_path,
+                    local_parent_path=doc_pair.local_parent_path)
+                log.debug('End of blacklist period, pushing doc_pair: %r', doc_pair)
+                self.push(queue_item)
         finally:
             self._error_lock.release()
+        self._arm_error_timer()
 
     def _is_on_error(self, row_id):
         return row_id in self._on_error_queue
 
     @pyqtSlot()
     def _on_new_error(self):
-        self._error_timer.start(1000)
+        self._arm_error_timer()
+
+    def _arm_error_timer(self):
+        next_try = self._on_error_queue.get_next_try()
+        if next_try is None:
+            self._error_timer.stop()
+            return
+        self._error_timer.start(max(0, int((next_try - time.time()) * 1000)))
 
     def get_errors_count(self):
         return len(self._on_error_queue)
@@ -249,18 +1011,26 @@ class QueueManager(QObject):
         if error_count > self._error_threshold:
             self.newErrorGiveUp.emit(doc_pair.id)
             log.debug("Giving up on pair : %r", doc_pair)
+            with self._dependencies_lock:
+                # The rows below stay in the persisted queue until restart
+                held = self._dependencies.done(doc_pair.id)
+            if held:
+                log.debug('Dropping %d rows held by %r', len(held), doc_pair)
             return
         if interval is None:
-            interval = self._error_interval * error_count
-        doc_pair.error_next_try = interval + int(time.time())
+            interval = int(round(backoff(error_count, self._error_interval)))
         log.debug("Blacklisting pair for %ds: %r", interval, doc_pair)
+        next_try = interval + int(time.time())
+        # Keep the retry state across restarts
+        self._dao.submit(self._dao.update_queue_retry, doc_pair.id, next_try, error_count)
+        self._push_on_error(doc_pair, next_try)
+
+    def _push_on_error(self, doc_pair, next_try):
+        doc_pair.error_next_try = next_try
         self._error_lock.acquire()
         try:
-            emit_sig = False
-            if doc_pair.id not in self._on_error_queue:
-                emit_sig = True
-            self._on_error_queue[doc_pair.id] = doc_pair
-            if emit_sig:
+            # Arm the timer again only if this pair is the next to retry
+            if self._on_error_queue.push(doc_pair.id, doc_pair, next_try):
                 self.newError.emit(doc_pair.id)
         finally:
             self._error_lock.release()
@@ -268,10 +1038,12 @@ class QueueManager(QObject):
     def requeue_errors(self):
         self._error_lock.acquire()
         try:
-            for doc_pair in self._on_error_queue.values():
-                doc_pair.error_next_try = 0
+            self._on_error_queue.retry_all()
+            if len(self._on_error_queue):
+                self.newError.emit(None)
         finally:
             self._error_lock.release()
+        self._dao.reset_queue_retries()
 
     def _get_local_folder(self):
         if self._local_folder_queue.empty():
@@ -319,10 +1091,27 @@ class QueueManager(QObject):
 
     def _get_file(self):
         self._get_file_lock.acquire()
-        if self._remote_file_queue.empty() and self._local_file_queue.empty():
+        if self._pool.is_adaptive():
+            if self._pool.adjust(self._local_file_queue.qsize()
+                                 + self._remote_file_queue.qsize()):
+                # Grow the pool from the main thread
+                self.newItem.emit(None)
+            active = len(self._processors_pool) - len(self._retired_processors)
+            if active > self._pool.size:
+                # The pool has shrunk, stop this processor
+                self._retired_processors.add(current_thread().ident)
+                self._get_file_lock.release()
+                return None
+        remote = self._remote_file_queue.peek()
+        local = self._local_file_queue.peek()
+        if remote is None and local is None:
+            state = self._get_folder_creation()
             self._get_file_lock.release()
-            return None
-        if self._remote_file_queue.qsize() > self._local_file_queue.qsize():
+            if state is not None and self._is_on_error(state.id):
+                return self._get_file()
+            return state
+        # The file scheduled first, from either queue
+        if local is None or (remote is not None and remote < local):
             state = self._get_remote_file()
         else:
             state = self._get_local_file()
@@ -331,30 +1120,62 @@ class QueueManager(QObject):
             return self._get_file()
         return state
 
+    def _get_folder_creation(self):
+        """
+        Next folder creation for the generic processors, when there is no
+        file to process: the independent folders are created in parallel,
+        the folder processors still handle the other folder changes.
+        """
+
+        queues = []
+        if self._remote_folder_enable:
+            queues.append(self._remote_folder_queue)
+        if self._local_folder_enable:
+            queues.append(self._local_folder_queue)
+        queues = sorted((queue for queue in queues if queue.peek() is not None),
+                        key=lambda queue: queue.peek())
+        for queue in queues:
+            state = queue.pop(predicate=is_creation)
+            if state is not None:
+                return state
+        return None
+
     @pyqtSlot()
     def _thread_finished(self):
         self._thread_inspection.acquire()
         try:
-            for thread in self._processors_pool:
+            for thread in self._processors_pool[:]:
                 if thread.isFinished():
                     self._processors_pool.remove(thread)
+                    self._retired_processors.discard(thread.worker.get_thread_id())
+                    self._processor_finished(thread)
             if (self._local_folder_thread is not None and
                     self._local_folder_thread.isFinished()):
+                self._processor_finished(self._local_folder_thread)
                 self._local_folder_thread = None
             if (self._local_file_thread is not None and
                     self._local_file_thread.isFinished()):
+                self._processor_finished(self._local_file_thread)
                 self._local_file_thread = None
             if (self._remote_folder_thread is not None and
                     self._remote_folder_thread.isFinished()):
+                self._processor_finished(self._remote_folder_thread)
                 self._remote_folder_thread = None
             if (self._remote_file_thread is not None and
                     self._remote_file_thread.isFinished()):
+                self._processor_finished(self._remote_file_thread)
                 self._remote_file_thread = None
             if not self._engine.is_paused() and not self._engine.is_stopped():
                 self.newItem.emit(None)
         finally:
             self._thread_inspection.release()
 
+    def _processor_finished(self, thread):
+        # The last row of an interrupted processor is over too
+        row_id = self._processing.pop(thread.worker.get_thread_id(), None)
+        if row_id is not None:
+            self._release(row_id)
+
     def active(self):
         # Recheck threads
         self._thread_finished()
@@ -369,7 +1190,8 @@ class QueueManager(QObject):
 
     def _create_thread(self, item_getter, **kwargs):
         log.debug('Creating %s', kwargs.get('name'))
-        processor = self._engine.create_processor(item_getter, **kwargs)
+        processor = self._engine.create_processor(
+            partial(self._dispatch, item_getter), **kwargs)
         thread = self._engine.create_thread(worker=processor)
         thread.finished.connect(self._thread_finished)
         thread.terminated.connect(self._thread_finished)
@@ -389,6 +1211,12 @@ class QueueManager(QObject):
             'error_queue': self.get_errors_count(),
             'additional_processors': len(self._processors_pool),
         }
+        metrics.update(self._pool.get_metrics())
+        metrics.update(self._scheduler.get_metrics())
+        with self._dependencies_lock:
+            metrics.update(self._dependencies.get_metrics())
+        metrics['coalesced_pushes'] = self._coalesced + sum(
+            queue.coalesced for queue in self._get_queues())
         metrics['total_queue'] = (metrics['local_folder_queue']
                                   + metrics['local_file_queue']
                                   + metrics['remote_folder_queue']
@@ -468,6 +1296,8 @@ class QueueManager(QObject):
 
     @pyqtSlot()
     def launch_processors(self):
+        if not self._disable and not self.is_paused():
+            self._load_backlog()
         if (self._disable or self.is_paused()
             or (self._local_folder_queue.empty()
                 and self._local_file_queue.empty()
@@ -503,9 +1333,12 @@ class QueueManager(QObject):
                 self._get_remote_file, name='RemoteFileProcessor')
 
         if (self._remote_file_queue.qsize() == 0
-                and self._local_file_queue.qsize() == 0):
+                and self._local_file_queue.qsize() == 0
+                and self._remote_folder_queue.qsize() <= 1
+                and self._local_folder_queue.qsize() <= 1):
+            # Nothing left for the generic processors
             return
 
-        while len(self._processors_pool) < self._max_processors:
+        while len(self._processors_pool) < self._pool.size:
             self._processors_pool.append(self._create_thread(
                 self._get_file, name='GenericProcessor'))
@@ -4,7 +4,7 @@ import re
 import sqlite3
 from Queue import Queue
 from threading import Lock
-from time import mktime, sleep, time
+from time import mktime, time
 
 from PyQt4.QtCore import pyqtSignal, pyqtSlot
 from watchdog.events import PatternMatchingEventHandler
@@ -93,13 +93,14 @@ class LocalWatcher(EngineWorker):
             self._action = Action("Full local scan")
             self._scan()
             self._end_action()
-            # Check Windows dequeue and folder scan only every 100 loops (1s)
+            # Check Windows dequeue and folder scan at most every second
             current_time_millis = int(round(time() * 1000))
             self._win_delete_interval = current_time_millis
             self._win_folder_scan_interval = current_time_millis
             while True:
                 self._interact()
-                sleep(0.01)
+                # Woken up by the watchdog events
+                self._wait()
                 while not self._watchdog_queue.empty():
                     evt = self._watchdog_queue.get()
                     self.handle_watchdog_event(evt)
@@ -356,7 +357,7 @@ class LocalWatcher(EngineWorker):
                             self._metrics['new_files'] += 1
                             self._dao.insert_local_state(child_info, info.path)
                             self._protected_files[remote_id] = True
-                        elif doc_pair.processor > 0:
+                        elif self._dao.is_processing(doc_pair.id):
                             log.debug('Skip pair as it is being processed: %r', doc_pair)
                             continue
                         elif doc_pair.local_path == child_info.path:
@@ -414,7 +415,7 @@ class LocalWatcher(EngineWorker):
                 try:
                     last_mtime = unicode(child_info.last_modification_time.strftime(
                         "%Y-%m-%d %H:%M:%S"))
-                    if (child_pair.processor == 0
+                    if (not self._dao.is_processing(child_pair.id)
                             and child_pair.last_local_updated is not None
                             and last_mtime != child_pair.last_local_updated.split('.')[0]):
                         log.trace('Update file %r', child_info.path)
@@ -743,7 +744,7 @@ class LocalWatcher(EngineWorker):
             # Unchanged folder
             if doc_pair.folderish:
                 # Unchanged folder, only update last_local_updated
-                self._dao.update_local_modification_time(doc_pair, local_info)
+                self._dao.submit(self._dao.update_local_modification_time, doc_pair, local_info)
                 return
 
             if doc_pair.local_state == 'synchronized':
@@ -755,7 +756,7 @@ class LocalWatcher(EngineWorker):
                               rel_path, evt.event_type)
                     if local_info.remote_ref is None:
                         self.client.set_remote_id(rel_path, doc_pair.remote_ref)
-                    self._dao.update_local_modification_time(doc_pair, local_info)
+                    self._dao.submit(self._dao.update_local_modification_time, doc_pair, local_info)
                     return
 
                 doc_pair.local_digest = digest
@@ -897,7 +898,7 @@ class LocalWatcher(EngineWorker):
                 moved = False
                 from_pair = self._dao.get_normal_state_from_remote(local_info.remote_ref)
                 if from_pair is not None:
-                    if from_pair.processor > 0 or from_pair.local_path == rel_path:
+                    if self._dao.is_processing(from_pair.id) or from_pair.local_path == rel_path:
                         # First condition is in process
                         # Second condition is a race condition
                         log.trace("Ignore creation or modification as the coming pair is being processed: %r",
@@ -1025,6 +1026,7 @@ class DriveFSEventHandler(PatternMatchingEventHandler):
         self.counter += 1
         log.trace('Queueing watchdog: %r', event)
         self.watcher._watchdog_queue.put(event)
+        self.watcher.wake()
 
 
 class DriveFSRootEventHandler(PatternMatchingEventHandler):
@@ -3,7 +3,6 @@ import os
 import socket
 from datetime import datetime
 from httplib import BadStatusLine
-from time import sleep
 from urllib2 import HTTPError, URLError
 
 from PyQt4.QtCore import pyqtSignal, pyqtSlot
@@ -67,6 +66,21 @@ class RemoteWatcher(EngineWorker):
     def _reset_clients(self):
         self._client = None
 
+    def _interact(self):
+        if self._pause:
+            # Do not block the other writers while paused
+            self._without_batch(super(RemoteWatcher, self)._interact)
+        else:
+            super(RemoteWatcher, self)._interact()
+
+    def _without_batch(self, func, *args, **kwargs):
+        """ Call func with the current DAO batch committed, even if nested, and go on with it after. """
+        depth = self._dao.suspend_batch()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self._dao.resume_batch(depth)
+
     def _execute(self):
         first_pass = True
         try:
@@ -78,7 +92,7 @@ class RemoteWatcher(EngineWorker):
                     self._next_check = now + self.server_interval * 1000
                     if self._handle_changes(first_pass):
                         first_pass = False
-                sleep(0.01)
+                self._wait((self._next_check - current_milli_time()) / 1000.0)
         except ThreadInterrupt:
             self.remoteWatcherStopped.emit()
             raise
@@ -115,6 +129,7 @@ class RemoteWatcher(EngineWorker):
     def scan_pair(self, remote_path):
         self._dao.add_path_to_scan(str(remote_path))
         self._next_check = 0
+        self.wake()
 
     def _scan_pair(self, remote_path):
         if remote_path is None:
@@ -188,12 +203,12 @@ class RemoteWatcher(EngineWorker):
         if remote_parent_path is None:
             return
 
-        # Detect recently deleted children
+        # Detect recently deleted children, only keep the row ids
+        # as big trees would not fit in memory as a whole
         if moved:
-            db_descendants = self._dao.get_remote_descendants_from_ref(doc_pair.remote_ref)
+            descendants = self._dao.get_remote_descendant_refs(ref=doc_pair.remote_ref)
         else:
-            db_descendants = self._dao.get_remote_descendants(remote_parent_path)
-        descendants = {desc.remote_ref: desc for desc in db_descendants}
+            descendants = self._dao.get_remote_descendant_refs(path=remote_parent_path)
 
         to_process = []
         scroll_id = None
@@ -225,26 +240,34 @@ class RemoteWatcher(EngineWorker):
             # Results are not necessarily sorted
             descendants_info = sorted(descendants_info, key=lambda x: x.path)
 
-            # Handle descendants
-            for descendant_info in descendants_info:
-                if self.filtered(descendant_info):
-                    log.debug('Ignoring banned file: %r', descendant_info)
-                    continue
-
-                log.trace('Handling remote descendant: %r', descendant_info)
-                if descendant_info.uid in descendants:
-                    descendant_pair = descendants.pop(descendant_info.uid)
-                    if self._check_modified(descendant_pair, descendant_info):
-                        descendant_pair.remote_state = 'modified'
-                    self._dao.update_remote_state(descendant_pair, descendant_info)
-                else:
-                    parent_pair = self._dao.get_normal_state_from_remote(descendant_info.parent_uid)
-                    if parent_pair is None:
-                        log.trace('Cannot find parent pair of remote descendant, postponing processing of %r',
-                                  descendant_info)
-                        to_process.append(descendant_info)
+            # Handle descendants, the whole batch is committed at once
+            self._dao.begin_batch()
+            try:
+                # Read the known descendants of the page at once
+                refs = [info.uid.encode('utf-8') for info in descendants_info if not self.filtered(info)]
+                known = self._dao.iter_states_from_ids(descendants.pop(ref) for ref in refs if ref in descendants)
+                known = {pair.remote_ref: pair for pair in known}
+                for descendant_info in descendants_info:
+                    if self.filtered(descendant_info):
+                        log.debug('Ignoring banned file: %r', descendant_info)
                         continue
-                    descendant_pair, _ = self._find_remote_child_match_or_create(parent_pair, descendant_info)
+
+                    log.trace('Handling remote descendant: %r', descendant_info)
+                    descendant_pair = known.get(descendant_info.uid)
+                    if descendant_pair is not None:
+                        if self._check_modified(descendant_pair, descendant_info):
+                            descendant_pair.remote_state = 'modified'
+                        self._dao.update_remote_state(descendant_pair, descendant_info)
+                    else:
+                        parent_pair = self._dao.get_normal_state_from_remote(descendant_info.parent_uid)
+                        if parent_pair is None:
+                            log.trace('Cannot find parent pair of remote descendant, postponing processing of %r',
+                                      descendant_info)
+                            to_process.append(descendant_info)
+                            continue
+                        descendant_pair, _ = self._find_remote_child_match_or_create(parent_pair, descendant_info)
+            finally:
+                self._dao.end_batch()
 
             # Check if synchronization thread was suspended
             self._interact()
@@ -254,18 +277,27 @@ class RemoteWatcher(EngineWorker):
             to_process = sorted(to_process, key=lambda x: x.path)
             log.trace('Processing [%d] postponed descendants of %r (%s)', len(to_process), remote_info.name,
                       remote_info.uid)
-            for descendant_info in to_process:
-                parent_pair = self._dao.get_normal_state_from_remote(descendant_info.parent_uid)
-                if parent_pair is None:
-                    log.error("Cannot find parent pair of postponed remote descendant, ignoring %s", descendant_info)
-                    continue
-                descendant_pair, _ = self._find_remote_child_match_or_create(parent_pair, descendant_info)
+            self._dao.begin_batch()
+            try:
+                for descendant_info in to_process:
+                    parent_pair = self._dao.get_normal_state_from_remote(descendant_info.parent_uid)
+                    if parent_pair is None:
+                        log.error("Cannot find parent pair of postponed remote descendant, ignoring %s",
+                                  descendant_info)
+                        continue
+                    descendant_pair, _ = self._find_remote_child_match_or_create(parent_pair, descendant_info)
+            finally:
+                self._dao.end_batch()
             t1 = datetime.now()
             log.trace('Postponed descendants processing took %s ms', self._get_elapsed_time_milliseconds(t0, t1))
 
         # Delete remaining
-        for deleted in descendants.values():
-            self._dao.delete_remote_state(deleted)
+        self._dao.begin_batch()
+        try:
+            for deleted in self._dao.iter_states_from_ids(descendants.itervalues()):
+                self._dao.delete_remote_state(deleted)
+        finally:
+            self._dao.end_batch()
 
     @staticmethod
     def _get_elapsed_time_milliseconds(t0, t1):
@@ -293,29 +325,34 @@ class RemoteWatcher(EngineWorker):
         children_info = self._client.get_children_info(remote_info.uid)
 
         to_scan = []
-        for child_info in children_info:
-            if self.filtered(child_info):
-                log.debug('Ignoring banned file: %r', child_info)
-                continue
+        # Children are committed at once
+        self._dao.begin_batch()
+        try:
+            for child_info in children_info:
+                if self.filtered(child_info):
+                    log.debug('Ignoring banned file: %r', child_info)
+                    continue
 
-            log.trace('Scanning remote child: %r', child_info)
-            new_pair = False
-            if child_info.uid in children:
-                child_pair = children.pop(child_info.uid)
-                if self._check_modified(child_pair, child_info):
-                    child_pair.remote_state = 'modified'
-                self._dao.update_remote_state(child_pair, child_info, remote_parent_path=remote_parent_path)
-            else:
-                child_pair, new_pair = self._find_remote_child_match_or_create(doc_pair, child_info)
+                log.trace('Scanning remote child: %r', child_info)
+                new_pair = False
+                if child_info.uid in children:
+                    child_pair = children.pop(child_info.uid)
+                    if self._check_modified(child_pair, child_info):
+                        child_pair.remote_state = 'modified'
+                    self._dao.update_remote_state(child_pair, child_info, remote_parent_path=remote_parent_path)
+                else:
+                    child_pair, new_pair = self._find_remote_child_match_or_create(doc_pair, child_info)
 
-            if (new_pair or force_recursion) and child_info.folderish:
-                    to_scan.append((child_pair, child_info))
+                if (new_pair or force_recursion) and child_info.folderish:
+                        to_scan.append((child_pair, child_info))
 
-        # Delete remaining
-        for deleted in children.values():
-            # TODO Should be DAO
-            # self._dao.mark_descendants_remotely_deleted(deleted)
-            self._dao.delete_remote_state(deleted)
+            # Delete remaining
+            for deleted in children.values():
+                # TODO Should be DAO
+                # self._dao.mark_descendants_remotely_deleted(deleted)
+                self._dao.delete_remote_state(deleted)
+        finally:
+            self._dao.end_batch()
 
         for folder in to_scan:
             # TODO Optimize by multithreading this too ?
@@ -346,60 +383,68 @@ class RemoteWatcher(EngineWorker):
         child_pair = self._dao.get_state_from_local(local_path)
         # Case of duplication (the file can exists in with a __x) or local rename
         if child_pair is None and parent_pair is not None and self._local_client.exists(parent_pair.local_path):
-            for child in self._local_client.get_children_info(parent_pair.local_path):
-                if self._local_client.get_remote_id(child.path) == child_info.uid:
-                    if '__' in child.name:
-                        log.debug('Found a deduplication case: %r on %r', child_info, child.path)
-                    else:
-                        log.debug('Found a local rename case: %r on %r', child_info, child.path)
-                    child_pair = self._dao.get_state_from_local(child.path)
-                    break
+            # Out of the batch as the local listing can be long
+            child_pair = self._without_batch(self._find_local_child_match, parent_pair, child_info)
         if child_pair is not None:
             if child_pair.remote_ref is not None and child_pair.remote_ref != child_info.uid:
                 log.debug("Got an existing pair with different id: %r | %r", child_pair, child_info)
             else:
-                if (child_pair.folderish == child_info.folderish
-                        and self._local_client.is_equal_digests(child_pair.local_digest, child_info.digest,
-                                child_pair.local_path, remote_digest_algorithm=child_info.digest_algorithm)):
-                    # Local rename
-                    if child_pair.local_path != local_path:
-                        child_pair.local_state = 'moved'
-                        child_pair.remote_state = 'unknown'
-                        local_info = self._local_client.get_info(child_pair.local_path)
-                        self._dao.update_local_state(child_pair, local_info)
-                        self._dao.update_remote_state(child_pair, child_info, remote_parent_path=remote_parent_path)
-                    else:
-                        self._dao.update_remote_state(child_pair, child_info, remote_parent_path=remote_parent_path)
-                        # Use version+1 as we just update the remote info
-                        synced = self._dao.synchronize_state(child_pair, version=child_pair.version + 1)
-                        if not synced:
-                            # Try again, might happen that it has been modified locally and remotely
-                            child_pair = self._dao.get_state_from_id(child_pair.id)
-                            if (child_pair.folderish == child_info.folderish
-                                    and self._local_client.is_equal_digests(
-                                        child_pair.local_digest, child_info.digest,
-                                        child_pair.local_path,
-                                        remote_digest_algorithm=child_info.digest_algorithm)):
-                                self._dao.synchronize_state(child_pair)
-                                child_pair = self._dao.get_state_from_id(child_pair.id)
-                                synced = child_pair.pair_state == 'synchronized'
-                        # Can be updated in previous call
-                        if synced:
-                            self._engine.stop_processor_on(child_pair.local_path)
-                        # Push the remote_Id
-                        log.debug('Set remote ID on %r / %r == %r', child_pair, child_pair.local_path, child_pair.local_path)
-                        self._local_client.set_remote_id(child_pair.local_path, child_info.uid)
-                        if child_pair.folderish:
-                            self._dao.queue_children(child_pair)
-                else:
-                    child_pair.remote_state = 'modified'
-                    self._dao.update_remote_state(child_pair, child_info, remote_parent_path=remote_parent_path)
-                child_pair = self._dao.get_state_from_id(child_pair.id, from_write=True)
-                return child_pair, False
+                # Out of the batch as the digests can be computed
+                return self._without_batch(self._update_remote_child_match, child_pair, child_info, local_path,
+                                           remote_parent_path), False
         row_id = self._dao.insert_remote_state(child_info, remote_parent_path, local_path, parent_pair.local_path)
         child_pair = self._dao.get_state_from_id(row_id, from_write=True)
         return child_pair, True
 
+    def _find_local_child_match(self, parent_pair, child_info):
+        for child in self._local_client.get_children_info(parent_pair.local_path):
+            if self._local_client.get_remote_id(child.path) == child_info.uid:
+                if '__' in child.name:
+                    log.debug('Found a deduplication case: %r on %r', child_info, child.path)
+                else:
+                    log.debug('Found a local rename case: %r on %r', child_info, child.path)
+                return self._dao.get_state_from_local(child.path)
+        return None
+
+    def _update_remote_child_match(self, child_pair, child_info, local_path, remote_parent_path):
+        if (child_pair.folderish == child_info.folderish
+                and self._local_client.is_equal_digests(child_pair.local_digest, child_info.digest,
+                        child_pair.local_path, remote_digest_algorithm=child_info.digest_algorithm)):
+            # Local rename
+            if child_pair.local_path != local_path:
+                child_pair.local_state = 'moved'
+                child_pair.remote_state = 'unknown'
+                local_info = self._local_client.get_info(child_pair.local_path)
+                self._dao.update_local_state(child_pair, local_info)
+                self._dao.update_remote_state(child_pair, child_info, remote_parent_path=remote_parent_path)
+            else:
+                self._dao.update_remote_state(child_pair, child_info, remote_parent_path=remote_parent_path)
+                # Use version+1 as we just update the remote info
+                synced = self._dao.synchronize_state(child_pair, version=child_pair.version + 1)
+                if not synced:
+                    # Try again, might happen that it has been modified locally and remotely
+                    child_pair = self._dao.get_state_from_id(child_pair.id)
+                    if (child_pair.folderish == child_info.folderish
+                            and self._local_client.is_equal_digests(
+                                child_pair.local_digest, child_info.digest,
+                                child_pair.local_path,
+                                remote_digest_algorithm=child_info.digest_algorithm)):
+                        self._dao.synchronize_state(child_pair)
+                        child_pair = self._dao.get_state_from_id(child_pair.id)
+                        synced = child_pair.pair_state == 'synchronized'
+                # Can be updated in previous call
+                if synced:
+                    self._engine.stop_processor_on(child_pair.local_path)
+                # Push the remote_Id
+                log.debug('Set remote ID on %r / %r == %r', child_pair, child_pair.local_path, child_pair.local_path)
+                self._local_client.set_remote_id(child_pair.local_path, child_info.uid)
+                if child_pair.folderish:
+                    self._dao.queue_children(child_pair)
+        else:
+            child_pair.remote_state = 'modified'
+            self._dao.update_remote_state(child_pair, child_info, remote_parent_path=remote_parent_path)
+        return self._dao.get_state_from_id(child_pair.id, from_write=True)
+
     @staticmethod
     def _handle_readonly(local_client, doc_pair):
         # Don't use readonly on folder for win32 and on Locally Edited
@@ -511,9 +556,10 @@ class RemoteWatcher(EngineWorker):
 
     def _save_changes_state(self):
         self._last_event_log_id = self._next_last_event_log_id
-        self._dao.update_config('remote_last_sync_date', self._last_sync_date)
-        self._dao.update_config('remote_last_event_log_id', self._last_event_log_id)
-        self._dao.update_config('remote_last_root_definitions', self._last_root_definitions)
+        # Only read back at the next start, no need to wait for the commit
+        self._dao.submit(self._dao.update_config, 'remote_last_sync_date', self._last_sync_date)
+        self._dao.submit(self._dao.update_config, 'remote_last_event_log_id', self._last_event_log_id)
+        self._dao.submit(self._dao.update_config, 'remote_last_root_definitions', self._last_root_definitions)
 
     def _get_changes(self):
         """Fetch incremental change summary from the server"""
@@ -536,7 +582,10 @@ class RemoteWatcher(EngineWorker):
         if force_recursion:
             self._dao.add_path_to_scan(remote_path)
         else:
-            self._do_scan_remote(doc_pair, remote_info, force_recursion=force_recursion, moved=moved)
+            # Called from the change summary batch: commit it before
+            # querying the server, the scan uses its own batches
+            self._without_batch(self._do_scan_remote, doc_pair, remote_info, force_recursion=force_recursion,
+                                moved=moved)
 
     def _update_remote_states(self):
         """Incrementally update the state of documents from a change summary"""
@@ -567,173 +616,178 @@ class RemoteWatcher(EngineWorker):
         # Scan events and update the related pair states
         refreshed = set()
         delete_queue = []
-        for change in sorted_changes:
-            # Check if synchronization thread was suspended
-            # TODO In case of pause or stop: save the last event id
-            self._interact()
+        # Changes are committed at once, queue pushes wait for the commit
+        self._dao.begin_batch()
+        try:
+            for change in sorted_changes:
+                # Check if synchronization thread was suspended
+                # TODO In case of pause or stop: save the last event id
+                self._interact()
 
-            event_id = change.get('eventId')
-            remote_ref = change['fileSystemItemId']
-            processed = False
-            for refreshed_ref in refreshed:
-                if refreshed_ref.endswith(remote_ref):
-                    processed = True
-                    break
+                event_id = change.get('eventId')
+                remote_ref = change['fileSystemItemId']
+                processed = False
+                for refreshed_ref in refreshed:
+                    if refreshed_ref.endswith(remote_ref):
+                        processed = True
+                        break
 
-            if processed:
-                # A more recent version was already processed
-                continue
+                if processed:
+                    # A more recent version was already processed
+                    continue
 
-            fs_item = change.get('fileSystemItem')
-            new_info = self._client.file_to_info(fs_item) if fs_item else None
+                fs_item = change.get('fileSystemItem')
+                new_info = self._client.file_to_info(fs_item) if fs_item else None
 
-            if self.filtered(new_info):
-                log.debug('Ignoring banned file: %r', new_info)
-                continue
+                if self.filtered(new_info):
+                    log.debug('Ignoring banned file: %r', new_info)
+                    continue
 
-            log.trace("Processing event: %r", change)
-            # Possibly fetch multiple doc pairs as the same doc can be synchronized at 2 places,
-            # typically if under a sync root and locally edited.
-            # See https://jira.nuxeo.com/browse/NXDRIVE-125
-            doc_pairs = self._dao.get_states_from_remote(remote_ref)
-            if not doc_pairs:
-                # Relax constraint on factory name in FileSystemItem id to
-                # match 'deleted' or 'securityUpdated' events.
-                # See https://jira.nuxeo.com/browse/NXDRIVE-167
-                doc_pair = self._dao.get_first_state_from_partial_remote(remote_ref)
-                if doc_pair is not None:
-                    doc_pairs = [doc_pair]
-
-            updated = False
-            doc_pairs = doc_pairs or []
-            for doc_pair in doc_pairs:
-                doc_pair_repr = doc_pair.local_path if doc_pair.local_path is not None else doc_pair.remote_name
-                if event_id == 'deleted':
-                    if fs_item is None:
-                        if doc_pair.local_path == '':
-                            log.debug("Delete pair from duplicate: %r", doc_pair)
-                            self._dao.remove_state(doc_pair, remote_recursion=True)
-                            continue
-                        log.debug('Push doc_pair %r in delete queue', doc_pair_repr)
-                        delete_queue.append(doc_pair)
-                    else:
-                        log.debug('Ignore delete on doc_pair %r as a fsItem is attached', doc_pair_repr)
-                        # To ignore completely put updated to true
-                        updated = True
-                        break
-                elif fs_item is None:
-                    if event_id == 'securityUpdated':
-                        log.debug('Security has been updated for'
-                                  ' doc_pair %r denying Read access,'
-                                  ' marking it as deleted',
-                                  doc_pair_repr)
-                        self._dao.delete_remote_state(doc_pair)
-                    else:
-                        log.debug('Unknown event: %r', event_id)
-                else:
-                    remote_parent_factory = doc_pair.remote_parent_ref.split('#', 1)[0]
-                    new_info_parent_factory = new_info.parent_uid.split('#', 1)[0]
-                    # Specific cases of a move on a locally edited doc
-                    if event_id == 'documentMoved' and remote_parent_factory == COLLECTION_SYNC_ROOT_FACTORY_NAME:
-                        # If moved from a non sync root to a sync root,
-                        # break to creation case (updated is False).
-                        # If moved from a sync root to a non sync root,
-                        # break to noop (updated is True).
-                        break
-                    elif (event_id == 'documentMoved'
-                          and new_info_parent_factory == COLLECTION_SYNC_ROOT_FACTORY_NAME):
-                        # If moved from a sync root to a non sync root, delete from local sync root
-                        log.debug('Marking doc_pair %r as deleted', doc_pair_repr)
-                        self._dao.delete_remote_state(doc_pair)
+                log.trace("Processing event: %r", change)
+                # Possibly fetch multiple doc pairs as the same doc can be synchronized at 2 places,
+                # typically if under a sync root and locally edited.
+                # See https://jira.nuxeo.com/browse/NXDRIVE-125
+                doc_pairs = self._dao.get_states_from_remote(remote_ref)
+                if not doc_pairs:
+                    # Relax constraint on factory name in FileSystemItem id to
+                    # match 'deleted' or 'securityUpdated' events.
+                    # See https://jira.nuxeo.com/browse/NXDRIVE-167
+                    doc_pair = self._dao.get_first_state_from_partial_remote(remote_ref)
+                    if doc_pair is not None:
+                        doc_pairs = [doc_pair]
+
+                updated = False
+                doc_pairs = doc_pairs or []
+                for doc_pair in doc_pairs:
+                    doc_pair_repr = doc_pair.local_path if doc_pair.local_path is not None else doc_pair.remote_name
+                    if event_id == 'deleted':
+                        if fs_item is None:
+                            if doc_pair.local_path == '':
+                                log.debug("Delete pair from duplicate: %r", doc_pair)
+                                self._dao.remove_state(doc_pair, remote_recursion=True)
+                                continue
+                            log.debug('Push doc_pair %r in delete queue', doc_pair_repr)
+                            delete_queue.append(doc_pair)
+                        else:
+                            log.debug('Ignore delete on doc_pair %r as a fsItem is attached', doc_pair_repr)
+                            # To ignore completely put updated to true
+                            updated = True
+                            break
+                    elif fs_item is None:
+                        if event_id == 'securityUpdated':
+                            log.debug('Security has been updated for'
+                                      ' doc_pair %r denying Read access,'
+                                      ' marking it as deleted',
+                                      doc_pair_repr)
+                            self._dao.delete_remote_state(doc_pair)
+                        else:
+                            log.debug('Unknown event: %r', event_id)
                     else:
-                        # Make new_info consistent with actual doc pair parent path for a doc member of a
-                        # collection (typically the Locally Edited one) that is also under a sync root.
-                        # Indeed, in this case, when adapted as a FileSystemItem, its parent path will be the one
-                        # of the sync root because it takes precedence over the collection,
-                        # see AbstractDocumentBackedFileSystemItem constructor.
-                        consistent_new_info = new_info
-                        if remote_parent_factory == COLLECTION_SYNC_ROOT_FACTORY_NAME:
-                            new_info_parent_uid = doc_pair.remote_parent_ref
-                            new_info_path = doc_pair.remote_parent_path + '/' + remote_ref
-                            consistent_new_info = RemoteFileInfo(
-                                new_info.name,
-                                new_info.uid,
-                                new_info_parent_uid,
-                                new_info_path,
-                                new_info.folderish,
-                                new_info.last_modification_time,
-                                new_info.last_contributor,
-                                new_info.digest,
-                                new_info.digest_algorithm,
-                                new_info.download_url,
-                                new_info.can_rename,
-                                new_info.can_delete,
-                                new_info.can_update,
-                                new_info.can_create_child,
-                                new_info.lock_owner,
-                                new_info.lock_created,
-                                new_info.can_scroll_descendants,
-                            )
-                        # Perform a regular document update on a document
-                        # that has been updated, renamed or moved
-                        log.debug('Refreshing remote state info for '
-                                  'doc_pair=%r, event_id=%r, new_info=%r '
-                                  '(force_recursion=%d)', doc_pair_repr,
-                                  event_id, new_info, event_id == 'securityUpdated')
-
-                        # Force remote state update in case of a locked / unlocked event since lock info is not
-                        # persisted, so not part of the dirty check
-                        lock_update = event_id in ('documentLocked',
-                                                   'documentUnlocked')
-                        if doc_pair.remote_state != 'created':
-                            if (new_info.digest != doc_pair.remote_digest
-                                    or safe_filename(new_info.name) != doc_pair.remote_name
-                                    or new_info.parent_uid != doc_pair.remote_parent_ref
-                                    or event_id == 'securityUpdated'
-                                    or lock_update):
-                                doc_pair.remote_state = 'modified'
-                        remote_parent_path = os.path.dirname(new_info.path)
-                        # TODO Add modify local_path and local_parent_path if needed
-                        self._dao.update_remote_state(doc_pair, new_info, remote_parent_path=remote_parent_path,
-                                                      force_update=lock_update)
-                        if doc_pair.folderish:
-                            log.trace('Force scan recursive on %r : %d', doc_pair, event_id == 'securityUpdated')
-                            self._force_remote_scan(doc_pair, consistent_new_info, remote_path=new_info.path,
-                                                    force_recursion=event_id == 'securityUpdated',
-                                                    moved=event_id == 'documentMoved')
-                        if lock_update:
-                            doc_pair = self._dao.get_state_from_id(doc_pair.id)
-                            try:
-                                self._handle_readonly(self._local_client, doc_pair)
-                            except (OSError, IOError) as exc:
-                                log.trace('Cannot handle readonly for %r (%r)', doc_pair, exc)
-                                del exc  # Fix reference leak
-                updated = True
-                refreshed.add(remote_ref)
-
-            if new_info and not updated:
-                # Handle new document creations
-                created = False
-                parent_pairs = self._dao.get_states_from_remote(new_info.parent_uid)
-                for parent_pair in parent_pairs:
-
-                    child_pair, new_pair = self._find_remote_child_match_or_create(parent_pair, new_info)
-                    if new_pair:
-                        log.debug('Marked doc_pair %r as remote creation',
-                                  child_pair.remote_name)
-
-                    if child_pair.folderish and new_pair:
-                        log.debug('Remote recursive scan of the content of %r',
-                                  child_pair.remote_name)
-                        remote_path = child_pair.remote_parent_path + "/" + new_info.uid
-                        self._force_remote_scan(child_pair, new_info, remote_path)
-
-                    created = True
+                        remote_parent_factory = doc_pair.remote_parent_ref.split('#', 1)[0]
+                        new_info_parent_factory = new_info.parent_uid.split('#', 1)[0]
+                        # Specific cases of a move on a locally edited doc
+                        if event_id == 'documentMoved' and remote_parent_factory == COLLECTION_SYNC_ROOT_FACTORY_NAME:
+                            # If moved from a non sync root to a sync root,
+                            # break to creation case (updated is False).
+                            # If moved from a sync root to a non sync root,
+                            # break to noop (updated is True).
+                            break
+                        elif (event_id == 'documentMoved'
+                              and new_info_parent_factory == COLLECTION_SYNC_ROOT_FACTORY_NAME):
+                            # If moved from a sync root to a non sync root, delete from local sync root
+                            log.debug('Marking doc_pair %r as deleted', doc_pair_repr)
+                            self._dao.delete_remote_state(doc_pair)
+                        else:
+                            # Make new_info consistent with actual doc pair parent path for a doc member of a
+                            # collection (typically the Locally Edited one) that is also under a sync root.
+                            # Indeed, in this case, when adapted as a FileSystemItem, its parent path will be the one
+                            # of the sync root because it takes precedence over the collection,
+                            # see AbstractDocumentBackedFileSystemItem constructor.
+                            consistent_new_info = new_info
+                            if remote_parent_factory == COLLECTION_SYNC_ROOT_FACTORY_NAME:
+                                new_info_parent_uid = doc_pair.remote_parent_ref
+                                new_info_path = doc_pair.remote_parent_path + '/' + remote_ref
+                                consistent_new_info = RemoteFileInfo(
+                                    new_info.name,
+                                    new_info.uid,
+                                    new_info_parent_uid,
+                                    new_info_path,
+                                    new_info.folderish,
+                                    new_info.last_modification_time,
+                                    new_info.last_contributor,
+                                    new_info.digest,
+                                    new_info.digest_algorithm,
+                                    new_info.download_url,
+                                    new_info.can_rename,
+                                    new_info.can_delete,
+                                    new_info.can_update,
+                                    new_info.can_create_child,
+                                    new_info.lock_owner,
+                                    new_info.lock_created,
+                                    new_info.can_scroll_descendants,
+                                )
+                            # Perform a regular document update on a document
+                            # that has been updated, renamed or moved
+                            log.debug('Refreshing remote state info for '
+                                      'doc_pair=%r, event_id=%r, new_info=%r '
+                                      '(force_recursion=%d)', doc_pair_repr,
+                                      event_id, new_info, event_id == 'securityUpdated')
+
+                            # Force remote state update in case of a locked / unlocked event since lock info is not
+                            # persisted, so not part of the dirty check
+                            lock_update = event_id in ('documentLocked',
+                                                       'documentUnlocked')
+                            if doc_pair.remote_state != 'created':
+                                if (new_info.digest != doc_pair.remote_digest
+                                        or safe_filename(new_info.name) != doc_pair.remote_name
+                                        or new_info.parent_uid != doc_pair.remote_parent_ref
+                                        or event_id == 'securityUpdated'
+                                        or lock_update):
+                                    doc_pair.remote_state = 'modified'
+                            remote_parent_path = os.path.dirname(new_info.path)
+                            # TODO Add modify local_path and local_parent_path if needed
+                            self._dao.update_remote_state(doc_pair, new_info, remote_parent_path=remote_parent_path,
+                                                          force_update=lock_update)
+                            if doc_pair.folderish:
+                                log.trace('Force scan recursive on %r : %d', doc_pair, event_id == 'securityUpdated')
+                                self._force_remote_scan(doc_pair, consistent_new_info, remote_path=new_info.path,
+                                                        force_recursion=event_id == 'securityUpdated',
+                                                        moved=event_id == 'documentMoved')
+                            if lock_update:
+                                doc_pair = self._dao.get_state_from_id(doc_pair.id)
+                                try:
+                                    self._without_batch(self._handle_readonly, self._local_client, doc_pair)
+                                except (OSError, IOError) as exc:
+                                    log.trace('Cannot handle readonly for %r (%r)', doc_pair, exc)
+                                    del exc  # Fix reference leak
+                    updated = True
                     refreshed.add(remote_ref)
-                    break
 
-                if not created:
-                    log.debug("Could not match changed document to a bound local folder: %r", new_info)
+                if new_info and not updated:
+                    # Handle new document creations
+                    created = False
+                    parent_pairs = self._dao.get_states_from_remote(new_info.parent_uid)
+                    for parent_pair in parent_pairs:
+
+                        child_pair, new_pair = self._find_remote_child_match_or_create(parent_pair, new_info)
+                        if new_pair:
+                            log.debug('Marked doc_pair %r as remote creation',
+                                      child_pair.remote_name)
+
+                        if child_pair.folderish and new_pair:
+                            log.debug('Remote recursive scan of the content of %r',
+                                      child_pair.remote_name)
+                            remote_path = child_pair.remote_parent_path + "/" + new_info.uid
+                            self._force_remote_scan(child_pair, new_info, remote_path)
+
+                        created = True
+                        refreshed.add(remote_ref)
+                        break
+
+                    if not created:
+                        log.debug("Could not match changed document to a bound local folder: %r", new_info)
+        finally:
+            self._dao.end_batch()
 
         # Sort by path the deletion to only mark parent
         sorted_deleted = sorted(delete_queue, key=lambda x: x.local_path)
@@ -1,7 +1,8 @@
 '''
 @author: Remi Cattiau
 '''
-from PyQt4.QtCore import QThread, QObject, pyqtSignal, pyqtSlot, QCoreApplication
+from PyQt4.QtCore import QThread, QObject, pyqtSignal, pyqtSlot, QCoreApplication, \
+    QMutex, QWaitCondition
 from threading import current_thread
 from time import sleep, time
 from nxdrive.engine.activity import Action, IdleAction
@@ -10,6 +11,9 @@ from urllib2 import HTTPError
 
 log = get_logger(__name__)
 
+# Seconds an idle worker waits at most between two processings of its Qt events
+EVENTS_INTERVAL = 1
+
 
 class ThreadInterrupt(Exception):
     pass
@@ -41,6 +45,10 @@ class Worker(QObject, object):
         self._name = kwargs.get('name', type(self).__name__)
         self._running = False
         self._thread.terminated.connect(self._terminated)
+        # Set by wake() to end the current or next _wait()
+        self._woken = False
+        self._wakeup_mutex = QMutex()
+        self._wakeup = QWaitCondition()
 
     def __repr__(self):
         return '<{} ID={}>'.format(type(self).__name__, self._thread_id)
@@ -65,6 +73,7 @@ class Worker(QObject, object):
         """
 
         self._continue = False
+        self.wake()
         if not self._thread.wait(5000):
             log.exception('Thread %d is not responding - terminate it',
                           self._thread_id)
@@ -76,6 +85,7 @@ class Worker(QObject, object):
         """ Resume the thread. """
 
         self._pause = False
+        self.wake()
 
     def suspend(self):
         """
@@ -84,6 +94,34 @@ class Worker(QObject, object):
         """
 
         self._pause = True
+        self.wake()
+
+    def wake(self):
+        """ End the current or next _wait() of the thread, from any thread. """
+
+        self._wakeup_mutex.lock()
+        try:
+            self._woken = True
+            self._wakeup.wakeAll()
+        finally:
+            self._wakeup_mutex.unlock()
+
+    def _wait(self, timeout=None):
+        """
+        Block the thread until wake() is called, or for `timeout` seconds.
+        Never wait for more than EVENTS_INTERVAL so that the Qt events are
+        processed by the next _interact().
+        """
+
+        if timeout is None or timeout > EVENTS_INTERVAL:
+            timeout = EVENTS_INTERVAL
+        self._wakeup_mutex.lock()
+        try:
+            if not self._woken and timeout > 0:
+                self._wakeup.wait(self._wakeup_mutex, int(timeout * 1000))
+            self._woken = False
+        finally:
+            self._wakeup_mutex.unlock()
 
     def _end_action(self):
         Action.finish_action()
@@ -98,6 +136,7 @@ class Worker(QObject, object):
         """ Order the stop of the thread. Return before thread is stopped. """
 
         self._continue = False
+        self.wake()
 
     def get_thread_id(self):
         """ Get the thread ID. """
@@ -117,7 +156,7 @@ class Worker(QObject, object):
         # Handle thread pause
         while self._pause and self._continue:
             QCoreApplication.processEvents()
-            sleep(0.01)
+            self._wait()
         # Handle thread interruption
         if not self._continue:
             raise ThreadInterrupt()
@@ -129,7 +168,7 @@ class Worker(QObject, object):
 
         while True:
             self._interact()
-            sleep(0.01)
+            self._wait()
 
     def _terminated(self):
         log.debug("Thread %s(%r) terminated", self._name, self._thread_id)
@@ -262,6 +301,7 @@ class PollWorker(Worker):
     @pyqtSlot()
     def force_poll(self):
         self._next_check = 0
+        self.wake()
 
     def _execute(self):
         while self._enable:
@@ -270,7 +310,7 @@ class PollWorker(Worker):
                 if self._poll():
                     self._metrics['last_poll'] = int(time())
                 self._next_check = int(time()) + self._check_interval
-            sleep(0.01)
+            self._wait(self._next_check - time())
 
     def _poll(self):
         return True
@@ -282,7 +322,7 @@ class DummyWorker(Worker):
     def _execute(self):
         while True:
             self._interact()
-            sleep(0.01)
+            self._wait()
 
 
 class CrazyWorker(Worker):
@@ -23,6 +23,8 @@ _logging_context = dict()
 
 is_logging_configured = False
 MAX_LOG_DISPLAYED = 50000
+# Logger of the slow database queries, written to their own file
+SLOW_QUERIES_LOGGER = 'nxdrive.engine.dao.slow_queries'
 
 
 class CustomMemoryHandler(BufferingHandler):
@@ -143,6 +145,18 @@ def configure(use_file_handler=False, log_filename=None, file_level='TRACE',
             FILE_HANDLER = file_handler
             root_logger.addHandler(file_handler)
 
+            # Slow queries go to their own file, see Options.db_profiling
+            slow_logger = logging.getLogger(SLOW_QUERIES_LOGGER)
+            slow_handler = get_handler(slow_logger, 'slow_queries')
+            if not slow_handler:
+                slow_handler = RotatingFileHandler(
+                    os.path.join(log_folder, 'slow_queries.log'),
+                    maxBytes=1024 ** 2, backupCount=3)
+                slow_handler.set_name('slow_queries')
+                slow_handler.setFormatter(formatter)
+                slow_logger.addHandler(slow_handler)
+            slow_logger.propagate = False
+
         # Add memory logger to allow instant report
         memory_handler = CustomMemoryHandler()
         memory_handler.setLevel(TRACE)
@@ -16,6 +16,7 @@ from PyQt4.QtWebKit import qWebKitVersion
 
 from nxdrive import __version__
 from nxdrive.client import LocalClient
+from nxdrive.client.bandwidth import RateLimiter
 from nxdrive.client.base_automation_client import get_proxies_for_handler
 from nxdrive.logging_config import FILE_HANDLER, get_logger
 from nxdrive.options import Options
@@ -311,6 +312,7 @@ class Manager(QtCore.QObject):
         self.proxies = dict()
         self.proxy_exceptions = None
         self._app_updater = None
+        self._db_maintenance = None
         self._dao = None
         self._create_dao()
         if Options.proxy_server is not None:
@@ -329,6 +331,12 @@ class Manager(QtCore.QObject):
 
         self.refresh_proxies()
 
+        # Global bandwidth limits, each engine having its own within them
+        self.upload_limiter = RateLimiter(Options.upload_rate * 1024,
+                                          schedule=Options.upload_schedule)
+        self.download_limiter = RateLimiter(Options.download_rate * 1024,
+                                            schedule=Options.download_schedule)
+
         # Create DirectEdit
         self._create_autolock_service()
         self._create_direct_edit(Options.protocol_url)
@@ -350,6 +358,9 @@ class Manager(QtCore.QObject):
         # Create the application update verification thread
         self._create_updater(Options.update_check_delay)
 
+        # Create the databases maintenance thread
+        self._create_db_maintenance(Options.db_maintenance_interval)
+
         # Force language
         if Options.force_locale is not None:
             self.set_config('locale', Options.force_locale)
@@ -383,7 +394,7 @@ class Manager(QtCore.QObject):
             ssl._create_default_https_context = _context
 
     def get_metrics(self):
-        return {
+        metrics = {
             'version': self.get_version(),
             'auto_start': self.get_auto_start(),
             'auto_update': self.get_auto_update(),
@@ -399,6 +410,9 @@ class Manager(QtCore.QObject):
             'platform': platform.system(),
             'appname': self.app_name,
         }
+        metrics.update(self.upload_limiter.get_metrics('upload'))
+        metrics.update(self.download_limiter.get_metrics('download'))
+        return metrics
 
     def open_help(self):
         self.open_local_file('https://doc.nuxeo.com/nxdoc/nuxeo-drive/')
@@ -519,6 +533,19 @@ class Manager(QtCore.QObject):
         self.started.connect(self.server_config_updater._thread.start)
         return self.server_config_updater
 
+    def _create_db_maintenance(self, check_interval):
+        if check_interval == 0:
+            log.info('Database maintenance interval is 0, disabling it')
+            return None
+        from nxdrive.engine.maintenance import DatabaseMaintenance
+        self._db_maintenance = DatabaseMaintenance(
+            self, check_interval=check_interval)
+        self.started.connect(self._db_maintenance._thread.start)
+        return self._db_maintenance
+
+    def get_db_maintenance(self):
+        return self._db_maintenance
+
     def _create_updater(self, update_check_delay):
         if update_check_delay == 0:
             log.info("Update check delay is 0, disabling autoupdate")
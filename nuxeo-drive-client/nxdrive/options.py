@@ -115,13 +115,33 @@ class MetaOptions(type):
 
     # Default options
     options = {
+        'batch_upload_files': (20, 'default'),
+        'batch_upload_size': (1024 ** 2, 'default'),
         'beta_channel': (False, 'default'),
         'beta_update_site_url': (
             'http://community.nuxeo.com/static/drive-test/', 'default'),
+        'chunk_upload_limit': (20 * 1024 ** 2, 'default'),
+        'chunk_upload_size': (5 * 1024 ** 2, 'default'),
+        'chunk_upload_threads': (2, 'default'),
         'consider_ssl_errors': (False, 'default'),
+        'db_cache_size': (None, 'default'),
+        'db_fetch_size': (500, 'default'),
+        'db_journal_mode': ('MEMORY', 'default'),
+        'db_maintenance_interval': (600, 'default'),
+        'db_mmap_size': (None, 'default'),
+        'db_profiling': (False, 'default'),
+        'db_read_pool_max': (32, 'default'),
+        'db_read_pool_size': (4, 'default'),
+        'db_slow_query_threshold': (100, 'default'),
+        'db_synchronous': (None, 'default'),
+        'db_writer_batch_size': (100, 'default'),
+        'db_writer_thread': (False, 'default'),
         'debug': (False, 'default'),
         'debug_pydev': (False, 'default'),
         'delay': (30, 'default'),
+        'digest_cache_size': (100000, 'default'),
+        'download_rate': (0, 'default'),
+        'download_schedule': ((), 'default'),
         'force_locale': (None, 'default'),
         'handshake_timeout': (60, 'default'),
         'ignored_files': (__files, 'default'),
@@ -132,13 +152,17 @@ class MetaOptions(type):
         'log_level_console': ('INFO', 'default'),
         'log_level_file': ('DEBUG', 'default'),
         'max_errors': (3, 'default'),
+        'max_processors': (20, 'default'),
         'max_sync_step': (10, 'default'),
+        'min_processors': (2, 'default'),
         'nxdrive_home': (os.path.join('~', '.nuxeo-drive'), 'default'),
         'nofscheck': (False, 'default'),
         'protocol_url': (None, 'default'),
         'proxy_exceptions': (None, 'default'),
         'proxy_server': (None, 'default'),
         'proxy_type': (None, 'default'),
+        'queue_page_size': (1000, 'default'),
+        'queue_policies': (('direct_edit', 'pin', 'recency', 'size'), 'default'),
         'quit_timeout': (-1, 'default'),
         'remote_repo': ('default', 'default'),
         'theme': ('ui5', 'default'),
@@ -149,6 +173,8 @@ class MetaOptions(type):
         'update_check_delay': (3600, 'default'),
         'update_site_url': (
             'http://community.nuxeo.com/static/drive/', 'default'),
+        'upload_rate': (0, 'default'),
+        'upload_schedule': ((), 'default'),
     }  # type: Dict[unicode, Tuple[Any, unicode]]
 
     # Callbacks for any option change.
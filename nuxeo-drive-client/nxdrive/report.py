@@ -54,7 +54,7 @@ class Report(object):
             path = os.path.join(folder, fname)
             if not os.path.isfile(path):
                 continue
-            if (fname not in ('nxdrive.log', 'segfault.log')
+            if (fname not in ('nxdrive.log', 'segfault.log', 'slow_queries.log')
                     and not fname.endswith('.zip')):
                 continue
 
@@ -115,6 +115,7 @@ class Report(object):
             self.copy_db(zip_, dao)
             for engine in self._manager.get_engines().values():
                 log.debug('Engine metrics: %r', engine.get_metrics())
+                log.debug('Engine queries: %r', engine.get_dao().get_query_stats())
                 self.copy_db(zip_, engine.get_dao())
 
             # Logs
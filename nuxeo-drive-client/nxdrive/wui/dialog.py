@@ -114,6 +114,7 @@ class WebDriveApi(QtCore.QObject):
             'paused': engine.is_paused(),
             'local_folder': engine.local_folder,
             'queue': engine.get_queue_manager().get_metrics(),
+            'queries': self._export_queries(engine),
             'web_authentication': bind.web_authentication,
             'server_url': bind.server_url,
             'username': bind.username,
@@ -123,6 +124,16 @@ class WebDriveApi(QtCore.QObject):
             'threads': self._get_threads(engine),
         }
 
+    @staticmethod
+    def _export_queries(engine):
+        return {
+            stats['query']: ('calls: {calls}, total: {total_time} ms,'
+                             ' p50: {p50} ms, p95: {p95} ms, p99: {p99} ms,'
+                             ' retries: {retries}, lock wait: {lock_wait} ms'
+                             ).format(**stats)
+            for stats in engine.get_dao().get_query_stats()
+        }
+
     def get_date_from_sqlite(self, d):
         format_date = '%Y-%m-%d %H:%M:%S'
         try:
@@ -0,0 +1,109 @@
+# coding: utf-8
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from datetime import datetime
+
+from nxdrive.client.bandwidth import RateLimiter, THROUGHPUT_WINDOW, \
+    parse_schedule
+from nxdrive.engine.dao.sqlite import EngineDAO
+from nxdrive.engine.engine import Engine
+
+
+class RateLimiterTest(unittest.TestCase):
+
+    def test_unlimited(self):
+        limiter = RateLimiter()
+        self.assertIsNone(limiter.get_rate())
+        self.assertEqual(limiter.reserve(1024 ** 3), 0)
+
+    def test_rate(self):
+        limiter = RateLimiter(1024)
+        now = limiter._last
+        # The bucket starts empty and may go into debt
+        self.assertAlmostEqual(limiter.reserve(512, now=now), 0.5)
+        self.assertAlmostEqual(limiter.reserve(1024, now=now), 1.5)
+        # Paid back after 1.5s, then up to one second of burst
+        self.assertEqual(limiter.reserve(0, now=now + 1.5), 0)
+        self.assertEqual(limiter.reserve(1024, now=now + 10), 0)
+        self.assertAlmostEqual(limiter.reserve(1024, now=now + 10), 1)
+
+    def test_parent(self):
+        parent = RateLimiter(1024)
+        limiter = RateLimiter(2048, parent=parent)
+        other = RateLimiter(parent=parent)
+        now = max(parent._last, limiter._last, other._last)
+        parent._last = limiter._last = other._last = now
+        self.assertAlmostEqual(limiter.reserve(1024, now=now), 1)
+        # The global limit is shared
+        self.assertAlmostEqual(other.reserve(1024, now=now), 2)
+
+    def test_schedule(self):
+        self.assertEqual(parse_schedule(['08:00-18:30=128', '22:00-6:00=0']),
+                         [(480, 1110, 128 * 1024), (1320, 360, 0)])
+        for spec in ('8-18=128', '08:00-18:00', '25:00-26:00=1', '08:00-18:00=-1'):
+            self.assertRaises(ValueError, parse_schedule, [spec])
+
+        limiter = RateLimiter(1024, schedule=['08:00-18:00=128', '22:00-06:00=0'])
+        self.assertEqual(limiter.get_rate(datetime(2017, 1, 1, 12, 0)), 128 * 1024)
+        self.assertEqual(limiter.get_rate(datetime(2017, 1, 1, 18, 0)), 1024)
+        self.assertIsNone(limiter.get_rate(datetime(2017, 1, 1, 23, 0)))
+        self.assertIsNone(limiter.get_rate(datetime(2017, 1, 1, 5, 59)))
+        limiter.configure(0)
+        self.assertIsNone(limiter.get_rate(datetime(2017, 1, 1, 12, 0)))
+
+    def test_consume(self):
+        limiter = RateLimiter(10 * 1024)
+        checks = []
+        start = time.time()
+        limiter.consume(10 * 1024, check=lambda: checks.append(1))
+        self.assertGreaterEqual(time.time() - start, 0.9)
+        self.assertEqual(len(checks), 2)
+
+    def test_metrics(self):
+        limiter = RateLimiter(1024)
+        start = limiter._window_start
+        limiter.reserve(5000, now=start + 1)
+        limiter.reserve(5000, now=start + 2)
+        self.assertEqual(limiter.get_throughput(now=start + 2), 0)
+        self.assertEqual(limiter.get_throughput(now=start + THROUGHPUT_WINDOW),
+                         10000 / THROUGHPUT_WINDOW)
+        limiter.reserve(1000, now=start + THROUGHPUT_WINDOW)
+        self.assertEqual(limiter.get_throughput(now=start + THROUGHPUT_WINDOW + 1),
+                         10000 / THROUGHPUT_WINDOW)
+        self.assertEqual(limiter.get_throughput(now=start + 3 * THROUGHPUT_WINDOW), 0)
+        metrics = limiter.get_metrics('upload')
+        self.assertEqual(metrics['upload_rate'], 1024)
+        self.assertEqual(metrics['upload_bytes'], 11000)
+
+
+class EngineRateLimitTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(u'-nxdrive-tests')
+        db = os.path.join(self.folder, u'engine.db')
+        self.engine = Engine.__new__(Engine)
+        self.engine.uid = 'engine'
+        self.engine._dao = EngineDAO(db)
+        self.engine._limiters = {'upload': RateLimiter(), 'download': RateLimiter()}
+        # The 'bandwidth' command runs in another process
+        self.command = Engine.__new__(Engine)
+        self.command._dao = EngineDAO(db)
+        self.command._limiters = {'upload': RateLimiter(), 'download': RateLimiter()}
+
+    def tearDown(self):
+        self.engine._dao.dispose()
+        self.command._dao.dispose()
+        shutil.rmtree(self.folder)
+
+    def test_reload(self):
+        self.engine._load_rate_limits()
+        self.assertIsNone(self.engine._limiters['upload'].get_rate())
+        self.command.set_rate_limit('upload', rate=64)
+        self.command.set_rate_limit('download', schedule=['00:00-00:00=32'])
+        # Applied by the running engine after its next remote poll
+        self.engine._load_rate_limits()
+        self.assertEqual(self.engine._limiters['upload'].get_rate(), 64 * 1024)
+        self.assertEqual(self.engine._limiters['download'].get_rate(), 32 * 1024)
@@ -2,7 +2,8 @@
 import unittest
 from time import sleep
 
-from nxdrive.engine.blacklist_queue import BlacklistQueue
+from nxdrive.engine.blacklist_queue import BACKOFF_MAX, BlacklistQueue, \
+    RetryScheduler, backoff
 from tests.common_unit_test import RandomBug
 
 
@@ -58,3 +59,49 @@ class BlacklistQueueTest(unittest.TestCase):
         self.assertEqual(item._count, 3)
         item = queue.get()
         self.assertIsNone(item)
+
+
+class RetrySchedulerTest(unittest.TestCase):
+
+    def test_order(self):
+        scheduler = RetryScheduler()
+        self.assertIsNone(scheduler.get_next_try())
+        self.assertTrue(scheduler.push(1, 'Item1', 30))
+        self.assertTrue(scheduler.push(2, 'Item2', 10))
+        self.assertFalse(scheduler.push(3, 'Item3', 20))
+        self.assertEqual(scheduler.get_next_try(), 10)
+        self.assertIsNone(scheduler.pop(cur_time=5))
+        self.assertEqual(scheduler.pop(cur_time=10), 'Item2')
+        self.assertEqual(scheduler.pop_all(cur_time=100), ['Item3', 'Item1'])
+        self.assertEqual(len(scheduler), 0)
+
+    def test_replace(self):
+        scheduler = RetryScheduler()
+        scheduler.push(1, 'Item1', 10)
+        scheduler.push(2, 'Item2', 20)
+        for next_try in range(100):
+            scheduler.push(1, 'Item1-%d' % next_try, 30 + next_try)
+        self.assertEqual(len(scheduler), 2)
+        self.assertLessEqual(len(scheduler._heap),
+                             2 + RetryScheduler.COMPACT_THRESHOLD + 1)
+        self.assertEqual(scheduler.get_next_try(), 20)
+        self.assertEqual(scheduler.values(), ['Item2', 'Item1-99'])
+        self.assertTrue(scheduler.remove(2))
+        self.assertFalse(scheduler.remove(2))
+        self.assertNotIn(2, scheduler)
+        self.assertEqual(scheduler.get_next_try(), 129)
+
+    def test_retry_all(self):
+        scheduler = RetryScheduler()
+        scheduler.push(1, 'Item1', 30)
+        scheduler.push(2, 'Item2', 10)
+        scheduler.retry_all(next_try=20)
+        self.assertEqual(scheduler.pop_all(cur_time=20), ['Item2', 'Item1'])
+
+    def test_backoff(self):
+        for attempt, delay in ((1, 60), (2, 120), (3, 240)):
+            value = backoff(attempt, 60)
+            self.assertGreaterEqual(value, delay * 0.9)
+            self.assertLessEqual(value, delay * 1.1)
+        self.assertLessEqual(backoff(30, 60), BACKOFF_MAX * 1.1)
+        self.assertEqual(backoff(2, 60, jitter=0), 120)
@@ -0,0 +1,200 @@
+# coding: utf-8
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import urllib2
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from threading import Lock, Thread, current_thread, enumerate as threads
+
+from nxdrive.client.bandwidth import RateLimiter
+from nxdrive.client.base_automation_client import BaseAutomationClient, \
+    decode_chunks, encode_chunks
+from nxdrive.engine.dao.sqlite import EngineDAO
+from nxdrive.engine.workers import ThreadInterrupt
+from nxdrive.options import Options
+
+CHUNK_SIZE = 1024
+CONTENT = ''.join(chr(i % 251) for i in xrange(10 * CHUNK_SIZE + 100))
+
+
+class BatchUploadHandler(BaseHTTPRequestHandler):
+    """ Minimal batch upload API accepting chunked uploads. """
+
+    lock = Lock()
+    batches = dict()
+    chunk_requests = []
+    failing_chunks = set()
+
+    def send_json(self, code, data):
+        body = json.dumps(data)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        data = self.rfile.read(int(self.headers.getheader('Content-Length', 0)))
+        path = self.path.split('/')[4:]
+        if not path:
+            with self.lock:
+                batch_id = 'batch-%d' % len(self.batches)
+                self.batches[batch_id] = dict()
+            return self.send_json(201, {'batchId': batch_id})
+        batch_id = path[0]
+        if batch_id not in self.batches:
+            return self.send_json(404, {'error': 'Unable to find batch ' + batch_id})
+        chunks = self.batches[batch_id]
+        if len(path) > 2:
+            # Batch execution, answer the digest of the uploaded content
+            content = ''.join(chunks[index] for index in sorted(chunks))
+            return self.send_json(200, {'digest': hashlib.md5(content).hexdigest()})
+        if self.headers.getheader('X-Upload-Type') != 'chunked':
+            chunks[0] = data
+            return self.send_json(201, {'batchId': batch_id, 'fileIdx': path[1],
+                                        'uploadType': 'normal', 'uploaded': 'true'})
+        index = int(self.headers.getheader('X-Upload-Chunk-Index'))
+        count = int(self.headers.getheader('X-Upload-Chunk-Count'))
+        with self.lock:
+            self.chunk_requests.append(index)
+            if index in self.failing_chunks:
+                self.failing_chunks.discard(index)
+                return self.send_json(500, {'message': 'Chunk failure'})
+            chunks[index] = data
+            complete = len(chunks) == count
+        self.send_json(201 if complete else 308, {
+            'batchId': batch_id,
+            'fileIdx': path[1],
+            'uploadType': 'chunked',
+            'uploadedChunkIds': sorted(chunks),
+            'chunkCount': count,
+        })
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class NoAccessCheckClient(BaseAutomationClient):
+
+    def check_access(self):
+        pass
+
+
+class ChunkedUploadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), BatchUploadHandler)
+        self.server_thread = Thread(target=self.server.serve_forever)
+        self.server_thread.start()
+        BatchUploadHandler.batches = dict()
+        BatchUploadHandler.chunk_requests = []
+        BatchUploadHandler.failing_chunks = set()
+        url = 'http://127.0.0.1:%d/' % self.server.server_port
+        self.client = NoAccessCheckClient(url, 'Administrator', 'device', '1.0',
+                                          password='Administrator', proxies={})
+        self.folder = tempfile.mkdtemp(u'-nxdrive-tests')
+        self.file_path = os.path.join(self.folder, u'file.bin')
+        with open(self.file_path, 'wb') as f:
+            f.write(CONTENT)
+        self.dao = EngineDAO(os.path.join(self.folder, u'engine.db'))
+        self.client.upload_store = self.dao
+        self.digest = hashlib.md5(CONTENT).hexdigest()
+
+    def tearDown(self):
+        self.dao.dispose()
+        self.server.shutdown()
+        self.server.server_close()
+        self.server_thread.join()
+        shutil.rmtree(self.folder)
+
+    def upload(self):
+        return self.client.execute_with_blob_streaming('NuxeoDrive.CreateFile',
+                                                       self.file_path)
+
+    @Options.mock()
+    def test_chunked_upload(self):
+        Options.chunk_upload_limit = 2 * CHUNK_SIZE
+        Options.chunk_upload_size = CHUNK_SIZE
+        Options.chunk_upload_threads = 3
+        self.assertEqual(self.upload(), {'digest': self.digest})
+        self.assertEqual(sorted(BatchUploadHandler.chunk_requests), range(11))
+        self.assertIsNone(self.dao.get_upload(self.file_path))
+
+    @Options.mock()
+    def test_resume_upload(self):
+        Options.chunk_upload_limit = 2 * CHUNK_SIZE
+        Options.chunk_upload_size = CHUNK_SIZE
+        Options.chunk_upload_threads = 1
+        BatchUploadHandler.failing_chunks = {5}
+        self.assertRaises(urllib2.HTTPError, self.upload)
+        upload = self.dao.get_upload(self.file_path)
+        self.assertEqual(upload.batch_id, 'batch-0')
+        self.assertEqual(decode_chunks(upload.chunks), set(range(5)))
+
+        # The upload goes on in the same batch, with the missing chunks only
+        BatchUploadHandler.chunk_requests = []
+        self.assertEqual(self.upload(), {'digest': self.digest})
+        self.assertEqual(BatchUploadHandler.chunk_requests, range(5, 11))
+        self.assertEqual(len(BatchUploadHandler.batches), 1)
+        self.assertIsNone(self.dao.get_upload(self.file_path))
+
+    @Options.mock()
+    def test_interrupted_upload(self):
+        Options.chunk_upload_limit = 2 * CHUNK_SIZE
+        Options.chunk_upload_size = CHUNK_SIZE
+        Options.chunk_upload_threads = 3
+        # Slow enough for the upload to be stopped in the middle
+        self.client.upload_limiter = RateLimiter(CHUNK_SIZE)
+        owner = current_thread()
+        stop = time.time() + 1
+
+        def check_suspended(_):
+            # Like the engine, only the synchronization thread is known
+            if current_thread() is owner and time.time() > stop:
+                raise ThreadInterrupt()
+
+        self.client.check_suspended = check_suspended
+        self.assertRaises(ThreadInterrupt, self.upload)
+        self.assertLess(time.time() - stop, 1)
+        # The chunk threads stop at their next buffer
+        time.sleep(1)
+        self.assertFalse([thread for thread in threads()
+                          if thread.name.startswith('ChunkUpload-')])
+        upload = self.dao.get_upload(self.file_path)
+        self.assertLess(len(decode_chunks(upload.chunks)), 11)
+
+    @Options.mock()
+    def test_outdated_upload(self):
+        Options.chunk_upload_limit = 2 * CHUNK_SIZE
+        Options.chunk_upload_size = CHUNK_SIZE
+        Options.chunk_upload_threads = 1
+        BatchUploadHandler.failing_chunks = {5}
+        self.assertRaises(urllib2.HTTPError, self.upload)
+        # The chunks cannot be reused with another chunk size
+        Options.chunk_upload_size = 2 * CHUNK_SIZE
+        BatchUploadHandler.chunk_requests = []
+        self.assertEqual(self.upload(), {'digest': self.digest})
+        self.assertEqual(BatchUploadHandler.chunk_requests, range(6))
+        self.assertEqual(len(BatchUploadHandler.batches), 2)
+
+    @Options.mock()
+    def test_small_file(self):
+        Options.chunk_upload_limit = len(CONTENT)
+        self.assertEqual(self.upload(), {'digest': self.digest})
+        self.assertEqual(BatchUploadHandler.chunk_requests, [])
+
+    def test_chunks_bitmap(self):
+        chunks = {0, 3, 8, 20}
+        bitmap = encode_chunks(chunks, 21)
+        self.assertEqual(len(bitmap), 3)
+        self.assertEqual(decode_chunks(bitmap), chunks)
+        self.assertEqual(decode_chunks(None), set())
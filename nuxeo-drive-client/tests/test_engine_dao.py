@@ -1,11 +1,21 @@
 # coding: utf-8
 import os
+import sqlite3
 import sys
 import tempfile
+import time
 import unittest
+from copy import copy, deepcopy
+from datetime import datetime
+from threading import Thread
 
-from nxdrive.engine.dao.sqlite import EngineDAO
+from nxdrive.client.common import FILE_BUFFER_SIZE
+from nxdrive.client.local_client import FileInfo
+from nxdrive.engine.dao import sqlite
+from nxdrive.engine.dao.sqlite import ConnectionPool, EngineDAO, PathTrie, \
+    QueryProfiler, STATE_INDEXES, StateRow
 from nxdrive.engine.engine import Engine
+from nxdrive.options import Options
 from tests.common import clean_dir
 
 
@@ -39,6 +49,27 @@ class EngineDAOTest(unittest.TestCase):
         self._dao = EngineDAO(self.tmp_db.name)
         self.addCleanup(self._clean_dao, self._dao)
 
+    def _get_query_plan(self, query, args=()):
+        c = self._dao._get_read_connection().cursor()
+        plan = c.execute('EXPLAIN QUERY PLAN ' + query, args).fetchall()
+        return ' '.join(row[-1] for row in plan)
+
+    def _get_state_indexes(self, dao):
+        c = dao._get_read_connection().cursor()
+        rows = c.execute("SELECT name FROM sqlite_master"
+                         " WHERE type='index' AND tbl_name='States'")
+        return [row.name for row in rows.fetchall()]
+
+    def _get_queued_ids(self, dao):
+        return [item.id for item in dao.get_queue_items()]
+
+    def _get_to_sync_ids(self, dao):
+        c = dao._get_read_connection().cursor()
+        rows = c.execute("SELECT id FROM States WHERE pair_state NOT IN"
+                         " ('synchronized', 'unsynchronized')"
+                         " ORDER BY folderish DESC, IFNULL(local_path, ''), id")
+        return [row.id for row in rows]
+
     def test_init_db(self):
         init_db = self.get_db_temp_file()
         if sys.platform != 'win32':
@@ -52,8 +83,224 @@ class EngineDAOTest(unittest.TestCase):
         self.assertIsNone(dao.get_config("remote_user"))
         # Test RemoteScan table
         self.assertFalse(dao.is_path_scanned("/"))
+        # Test States indexes
+        indexes = self._get_state_indexes(dao)
+        for name, _ in STATE_INDEXES:
+            self.assertIn(name, indexes)
         self._clean_dao(dao)
 
+    @Options.mock()
+    def test_wal_mode(self):
+        Options.db_journal_mode = 'WAL'
+        Options.db_synchronous = 'NORMAL'
+        Options.db_cache_size = -4096
+        init_db = self.get_db_temp_file()
+        dao = EngineDAO(init_db.name)
+        self.addCleanup(self._clean_dao, dao)
+        c = dao._get_read_connection().cursor()
+        self.assertEqual(c.execute('PRAGMA journal_mode').fetchone()[0],
+                         'wal')
+        # NORMAL
+        self.assertEqual(c.execute('PRAGMA synchronous').fetchone()[0], 1)
+        self.assertEqual(c.execute('PRAGMA cache_size').fetchone()[0], -4096)
+        # Readers are not blocked by a pending write transaction
+        dao.begin_transaction()
+        dao.update_config('wal', 'pending')
+        reader = dao._pool._factory().cursor()
+        self.assertIsNone(reader.execute(
+            "SELECT value FROM Configuration WHERE name='wal'").fetchone())
+        dao.end_transaction()
+        self.assertEqual(dao.get_config('wal'), 'pending')
+
+    def test_read_connection_pool(self):
+        connections = []
+
+        def read():
+            connections.append(self._dao._get_read_connection())
+            self._dao.get_config('remote_user')
+            self._dao.dispose_thread()
+
+        for _ in range(3):
+            thread = Thread(target=read)
+            thread.start()
+            thread.join()
+        # Released connections are reused by the next threads
+        self.assertEqual(len(set(connections)), 1)
+        metrics = self._dao.get_metrics()
+        self.assertEqual(metrics['db_read_connections_leased'], 1)
+        self.assertGreaterEqual(metrics['db_read_connections_reused'], 2)
+        for key in ('db_lock_waits', 'db_lock_wait_time', 'db_retries'):
+            self.assertIn(key, metrics)
+
+    def test_read_connection_pool_bound(self):
+        pool = ConnectionPool(object, size=1, max_leases=1, timeout=0.2)
+        con = pool.acquire()
+        connections = []
+
+        def read():
+            connections.append(pool.acquire())
+            pool.release()
+
+        # The second thread waits for the lease of the first one
+        thread = Thread(target=read)
+        thread.start()
+        time.sleep(0.05)
+        self.assertEqual(connections, [])
+        self.assertIsNone(pool.release())
+        thread.join()
+        self.assertEqual(connections, [con])
+        self.assertEqual(pool.get_metrics()['db_read_connections_waits'], 1)
+        self.assertEqual(pool.get_metrics()['db_read_connections_created'], 1)
+
+        # It gets a new connection when no lease is released in time
+        self.assertIs(pool.acquire(), con)
+        thread = Thread(target=read)
+        thread.start()
+        thread.join()
+        self.assertIsNot(connections[-1], con)
+        metrics = pool.get_metrics()
+        self.assertEqual(metrics['db_read_connections_overflows'], 1)
+        self.assertEqual(metrics['db_read_connections_leased'], 1)
+
+    def test_batch(self):
+        pushed = []
+
+        class QueueRecorder(object):
+            def push_ref(self, row_id, folderish, pair_state, pair=None):
+                pushed.append((row_id, pair_state))
+
+        self._dao._queue_manager = QueueRecorder()
+        reader = self._dao._pool._factory().cursor()
+        query = 'SELECT last_transfer FROM States WHERE id=?'
+        row = self._dao.get_state_from_id(2)
+        self._dao.begin_batch()
+        try:
+            self._dao.update_last_transfer(row.id, 'batch')
+            self.assertTrue(self._dao.force_remote(row))
+            # Nested batches are committed by the outermost one
+            self._dao.begin_batch()
+            self._dao.update_last_transfer(row.id, 'nested')
+            self._dao.end_batch()
+            # Pending changes are visible from the batch thread only
+            self.assertEqual(
+                self._dao.get_state_from_id(row.id).last_transfer, 'nested')
+            self.assertEqual(reader.execute(query, (row.id,)).fetchone()[0],
+                             row.last_transfer)
+            # Pushes wait for the commit
+            self.assertEqual(pushed, [])
+        finally:
+            self._dao.end_batch()
+        self.assertEqual(reader.execute(query, (row.id,)).fetchone()[0],
+                         'nested')
+        self.assertEqual(pushed, [(row.id, 'remotely_modified')])
+        self.assertFalse(self._dao.in_batch())
+
+    def test_suspend_batch(self):
+        self.assertEqual(self._dao.suspend_batch(), 0)
+        reader = self._dao._pool._factory().cursor()
+        query = "SELECT value FROM Configuration WHERE name='suspended'"
+        self._dao.begin_batch()
+        self._dao.begin_batch()
+        try:
+            self._dao.update_config('suspended', 1)
+            # All the levels are committed, and the lock released
+            depth = self._dao.suspend_batch()
+            self.assertEqual(depth, 2)
+            self.assertFalse(self._dao.in_batch())
+            self.assertEqual(reader.execute(query).fetchone()[0], '1')
+            other = Thread(target=self._dao.update_config, args=('suspended', 2))
+            other.start()
+            other.join()
+            self.assertEqual(self._dao.get_config('suspended'), '2')
+            self._dao.resume_batch(depth)
+            self.assertTrue(self._dao.in_batch())
+            self._dao.end_batch()
+            self.assertTrue(self._dao.in_batch())
+        finally:
+            self._dao.end_batch()
+        self.assertFalse(self._dao.in_batch())
+
+    def test_synchronous_submit(self):
+        # Without the writer thread, the writes run and fail at once
+        self.assertIsNone(self._dao.submit(self._dao.update_config, 'sync', 1).result())
+        self.assertEqual(self._dao.get_config('sync'), '1')
+        with self.assertRaises(TypeError):
+            self._dao.submit(self._dao.get_state_from_id)
+
+    @Options.mock()
+    def test_writer_thread(self):
+        Options.db_writer_thread = True
+        Options.db_writer_batch_size = 10
+        init_db = self.get_db_temp_file()
+        dao = EngineDAO(init_db.name)
+        self.addCleanup(self._clean_dao, dao)
+
+        # Writes from a batch are not delayed, and raise their errors
+        dao.begin_batch()
+        self.assertTrue(dao.submit(dao.update_config, 'in_batch', 1).done())
+        with self.assertRaises(TypeError):
+            dao.submit(dao.get_state_from_id)
+        dao.end_batch()
+
+        dao.acquire_lock()
+        futures = [dao.submit(dao.update_config, 'async_%d' % i, i)
+                   for i in range(50)]
+        # The writer waits for the other writers
+        self.assertFalse(futures[0].done())
+        dao.release_lock()
+        dao.flush()
+        for future in futures:
+            self.assertTrue(future.done())
+            self.assertIsNone(future.result())
+        self.assertEqual(dao.get_config('async_49'), '49')
+
+        # Queued writes share transactions
+        metrics = dao.get_metrics()
+        self.assertEqual(metrics['db_writer_writes'], 51)
+        self.assertLessEqual(metrics['db_writer_transactions'], 51 // 10 + 2)
+        self.assertEqual(metrics['db_writer_queue_size'], 0)
+
+        # Errors are raised by the future, the other writes are committed
+        failed = dao.submit(dao.get_state_from_id)
+        done = dao.submit(dao.update_config, 'after_error', 'ok')
+        with self.assertRaises(TypeError):
+            failed.result(timeout=5)
+        self.assertIsNone(done.result(timeout=5))
+        self.assertEqual(dao.get_config('after_error'), 'ok')
+
+    def test_state_row(self):
+        row = self._dao.get_state_from_id(2)
+        self.assertIsInstance(row, StateRow)
+        self.assertEqual(row.local_path, '/SmallFolder')
+        self.assertEqual(row['local_path'], row.local_path)
+        self.assertEqual(row['LOCAL_PATH'], row.local_path)
+        self.assertEqual(row[0], row.id)
+        self.assertEqual(row[-1], row.last_transfer)
+        self.assertEqual(len(row), 30)
+        self.assertEqual(len(row.keys()), 30)
+        self.assertEqual(list(row)[:2], list(row[:2]))
+        with self.assertRaises(IndexError):
+            row.unknown_column
+        with self.assertRaises(IndexError):
+            row['unknown_column']
+
+        # Rows can be updated and get extra attributes
+        row.update_state(local_state='modified')
+        row.error_next_try = 42
+        self.assertEqual(row.local_state, 'modified')
+        for copied in (copy(row), deepcopy(row)):
+            self.assertEqual(copied, row)
+            self.assertEqual(copied.error_next_try, 42)
+        self.assertNotEqual(row, self._dao.get_state_from_id(2))
+
+        # Columns which are not valid attributes are available by key
+        c = self._dao._get_read_connection().cursor()
+        row = c.execute('SELECT COUNT(*), 1 AS keys, 2 AS Keys'
+                        ' FROM States').fetchone()
+        self.assertEqual(row[0], 63)
+        self.assertEqual(row['keys'], 1)
+        self.assertEqual(row.keys(), ['COUNT(*)', 'keys', 'Keys'])
+
     def test_migration_db_v1_with_duplicates(self):
         # Test a non empty db
         migrate_db = self.get_db_temp_file()
@@ -85,6 +332,13 @@ class EngineDAOTest(unittest.TestCase):
         self.assertEqual(len(cols), 30)
         cols = c.execute("SELECT * FROM States").fetchall()
         self.assertEqual(len(cols), 63)
+        self.assertEqual(self._dao.get_config('schema_version'), '11')
+        self.assertFalse(self._dao.check_state_counters())
+        self.assertEqual(self._get_queued_ids(self._dao),
+                         self._get_to_sync_ids(self._dao))
+        indexes = self._get_state_indexes(self._dao)
+        for name, _ in STATE_INDEXES:
+            self.assertIn(name, indexes)
         self.test_batch_folder_files()
         self.test_batch_upload_files()
         self.test_conflicts()
@@ -92,6 +346,383 @@ class EngineDAOTest(unittest.TestCase):
         self.test_acquire_processors()
         self.test_configuration()
 
+    def test_query_plans(self):
+        queries = (
+            ('SELECT * FROM States WHERE local_path=?',
+             'idx_states_local_path'),
+            ('SELECT * FROM States WHERE local_parent_path=?',
+             'idx_states_local_parent_path'),
+            ('SELECT * FROM States WHERE remote_parent_ref=?',
+             'idx_states_remote_parent_ref'),
+            ('SELECT * FROM States WHERE remote_digest=?',
+             'idx_states_remote_digest'),
+            ('SELECT * FROM States WHERE remote_parent_path >= ?'
+             ' AND remote_parent_path < ?',
+             'idx_states_remote_parent_path'),
+            ('SELECT * FROM States WHERE local_parent_path = ?'
+             ' OR (local_parent_path >= ? AND local_parent_path < ?)',
+             'idx_states_local_parent_path'),
+            ("SELECT COUNT(*) FROM States WHERE pair_state='conflicted'",
+             'idx_states_pair_state'),
+            ("SELECT COUNT(*) FROM States WHERE pair_state='synchronized'"
+             " AND folderish=0",
+             'idx_states_pair_state'),
+            ('SELECT COUNT(*) FROM States WHERE error_count > 3',
+             'idx_states_error_count'),
+        )
+        for query, index in queries:
+            args = ('value',) * query.count('?')
+            plan = self._get_query_plan(query, args)
+            self.assertIn(index, plan, msg='%s: %s' % (query, plan))
+            self.assertNotIn('SCAN', plan, msg='%s: %s' % (query, plan))
+
+    def test_descendants(self):
+        folder = self._dao.get_state_from_local('/SmallFolder/Test')
+        remote_path = folder.remote_parent_path + '/' + folder.remote_ref
+        # Sibling names sharing the prefix must not be returned
+        states = self._dao.get_remote_descendants(remote_path)
+        self.assertEqual(len(states), 22)
+        states = self._dao.get_remote_descendants_from_ref(folder.remote_ref)
+        self.assertEqual(len(states), 22)
+        states = self._dao.get_states_from_partial_local('/SmallFolder/Test/')
+        self.assertEqual(len(states), 22)
+        root = self._dao.get_state_from_local('/SmallFolder')
+        states = self._dao.get_remote_descendants_from_ref(root.remote_ref)
+        self.assertEqual(len(states), 61)
+
+        # Without recursive CTE, SQLite < 3.8.3, the tree is read by levels
+        self.addCleanup(setattr, sqlite, 'RECURSIVE_CTE', sqlite.RECURSIVE_CTE)
+        sqlite.RECURSIVE_CTE = False
+        self.assertEqual({state.id for state in self._dao.get_remote_descendants_from_ref(root.remote_ref)},
+                         {state.id for state in states})
+
+    def test_prefix_range(self):
+        prefix_range = EngineDAO._prefix_range
+        self.assertEqual(prefix_range('/a/b/'), (u'/a/b/', u'/a/b0'))
+        self.assertEqual(prefix_range(u'\u00e9'.encode('utf-8')), (u'\u00e9', u'\u00ea'))
+        # Characters beyond U+FFFF, surrogate pairs on the narrow builds
+        self.assertEqual(prefix_range(u'/\uffff')[1], u'/\U00010000')
+        self.assertEqual(prefix_range(u'/\U0001f600')[1], u'/\U0001f601')
+        self.assertEqual(prefix_range(u'/\ud7ff')[1], u'/\ue000')
+        self.assertEqual(prefix_range(u'/a\U0010ffff')[1], u'/b')
+        # No upper bound for an empty prefix
+        self.assertIsInstance(prefix_range(u'')[1], buffer)
+
+        c = self._dao._get_read_connection().cursor()
+        names = (u'/a/\uffff', u'/a/\U0001f600', u'/a/\U0010ffff/b', u'/a0', u'/b')
+        c.execute("CREATE TEMP TABLE Names(name VARCHAR)")
+        c.executemany("INSERT INTO Names VALUES (?)", [(name,) for name in names])
+        query = "SELECT name FROM Names WHERE name >= ? AND name < ? ORDER BY name"
+        self.assertEqual([row.name for row in c.execute(query, prefix_range(u'/a/'))], list(names[:3]))
+        self.assertEqual(len(c.execute(query, prefix_range(u'')).fetchall()), len(names))
+
+    @Options.mock()
+    def test_iter_descendants(self):
+        Options.db_fetch_size = 5
+        folder = self._dao.get_state_from_local('/SmallFolder/Test')
+        remote_path = folder.remote_parent_path + '/' + folder.remote_ref
+        states = self._dao.iter_remote_descendants(remote_path)
+        # Rows are fetched by batches of db_fetch_size
+        first = next(states)
+        self.assertIsInstance(first, StateRow)
+        ids = {first.id} | {state.id for state in states}
+        self.assertEqual(ids, {state.id for state in
+                               self._dao.get_remote_descendants(remote_path)})
+        self.assertEqual(len(ids), 22)
+        states = self._dao.iter_remote_descendants_from_ref(folder.remote_ref)
+        self.assertEqual(len(list(states)), 22)
+        states = self._dao.iter_states_from_partial_local('/SmallFolder/Test/')
+        self.assertEqual(len(list(states)), 22)
+        self.assertEqual(list(self._dao.iter_errors()), self._dao.get_errors())
+
+    def test_remote_descendant_refs(self):
+        folder = self._dao.get_state_from_local('/SmallFolder/Test')
+        remote_path = folder.remote_parent_path + '/' + folder.remote_ref
+        descendants = self._dao.get_remote_descendants(remote_path)
+        refs = self._dao.get_remote_descendant_refs(path=remote_path)
+        self.assertEqual(refs, {state.remote_ref.encode('utf-8'): state.id for state in descendants})
+        self.assertEqual(self._dao.get_remote_descendant_refs(ref=folder.remote_ref), refs)
+        # Only the refs and the ids are held, under 300 bytes a row
+        size = sys.getsizeof(refs) + sum(sys.getsizeof(ref) + sys.getsizeof(row_id)
+                                         for ref, row_id in refs.iteritems())
+        self.assertLess(size, 300 * len(refs))
+
+        # The rows are read back by chunks, skipping the removed ones
+        row_ids = sorted(refs.values()) + [max(refs.values()) + 1000]
+        self.assertEqual(sorted(state.id for state in self._dao.iter_states_from_ids(row_ids)),
+                         row_ids[:-1])
+        self.assertEqual(list(self._dao.iter_states_from_ids([])), [])
+
+    def test_state_queue(self):
+        queued = self._get_queued_ids(self._dao)
+        self.assertTrue(queued)
+        self.assertEqual(queued, self._get_to_sync_ids(self._dao))
+        # Folders first, then by path, a page at a time
+        items = self._dao.get_queue_items(limit=3)
+        self.assertEqual([item.id for item in items], queued[:3])
+        items = self._dao.get_queue_items(after=self._dao.get_queue_key(items[-1]),
+                                          last_id=queued[4])
+        self.assertEqual([item.id for item in items],
+                         [row_id for row_id in queued[3:] if row_id <= queued[4]])
+        # Parents come before their children across the pages
+        items = []
+        page = self._dao.get_queue_items(limit=2)
+        while page:
+            items.extend(page)
+            page = self._dao.get_queue_items(after=self._dao.get_queue_key(page[-1]), limit=2)
+        self.assertEqual([item.id for item in items], queued)
+        folders = [item.local_path or '' for item in items if item.priority]
+        self.assertEqual(folders, sorted(folders))
+        self.assertEqual(self._dao.get_queue_last_id(), max(queued))
+
+        # Synchronized rows leave the queue, modified ones come back
+        row = self._dao.get_state_from_id(queued[-1])
+        self.assertFalse(row.folderish)
+        self._dao.synchronize_state(row)
+        self.assertNotIn(row.id, self._get_queued_ids(self._dao))
+        row = self._dao.get_state_from_id(row.id)
+        self._dao.force_remote(row)
+        self.assertIn(row.id, self._get_queued_ids(self._dao))
+        self._dao.remove_state(row)
+        self.assertNotIn(row.id, self._get_queued_ids(self._dao))
+
+        # Retries survive a restart
+        row_id = queued[0]
+        self._dao.update_queue_retry(row_id, 4242, 2)
+        self._dao.dispose()
+        self._dao = EngineDAO(self.tmp_db.name)
+        item = [item for item in self._dao.get_queue_items()
+                if item.id == row_id][0]
+        self.assertEqual((item.not_before, item.attempt), (4242, 2))
+        self._dao.reset_queue_retries()
+        item = [item for item in self._dao.get_queue_items()
+                if item.id == row_id][0]
+        self.assertEqual(item.not_before, 0)
+
+        # A new state of the row is retried at once
+        self._dao.update_queue_retry(row_id, 4242, 2)
+        row = self._dao.get_state_from_id(row_id)
+        self.assertNotEqual(row.pair_state, 'locally_resolved')
+        self.assertTrue(self._dao.force_local(row))
+        item = [item for item in self._dao.get_queue_items()
+                if item.id == row_id][0]
+        self.assertEqual((item.not_before, item.attempt), (0, 0))
+
+        # A restart does not queue the whole table again
+        con = self._dao._get_write_connection()
+        con.execute("DELETE FROM StateQueue WHERE row_id = ?", (row_id,))
+        con.commit()
+        self._dao.dispose()
+        self._dao = EngineDAO(self.tmp_db.name)
+        self.assertNotIn(row_id, self._get_queued_ids(self._dao))
+
+    def test_digest_cache(self):
+        path = os.path.join(self.tmpdir, 'big.bin')
+
+        def write(data, mtime):
+            with open(path, 'wb') as f:
+                f.write(data)
+            os.utime(path, (mtime, mtime))
+
+        def digest():
+            info = FileInfo(unicode(self.tmpdir), u'/big.bin', False,
+                            datetime.now(), size=os.path.getsize(path),
+                            digest_cache=self._dao)
+            return info.get_digest()
+
+        write('a' * (FILE_BUFFER_SIZE + 1), 1500000000)
+        expected = digest()
+        self.assertEqual(self._dao.get_metrics()['digest_cache_misses'], 1)
+        self.assertEqual(digest(), expected)
+        self.assertEqual(self._dao.get_metrics()['digest_cache_hits'], 1)
+
+        # Any change of the stat identity invalidates the digest
+        write('b' * (FILE_BUFFER_SIZE + 1), 1500000001)
+        self.assertNotEqual(digest(), expected)
+        self.assertEqual(self._dao.get_metrics()['digest_cache_misses'], 2)
+
+        # Files modified just now are not cached
+        write('c' * (FILE_BUFFER_SIZE + 2), time.time())
+        digest()
+        digest()
+        self.assertEqual(self._dao.get_metrics()['digest_cache_misses'], 4)
+
+        self._dao.cache_digest(u'/other', 'md5', (1, 2, 3.0), 'digest')
+        self._dao.trim_digest_cache(1)
+        self.assertEqual(self._dao.get_cached_digest(u'/other', 'md5', (1, 2, 3.0)),
+                         'digest')
+        c = self._dao._get_read_connection().cursor()
+        self.assertEqual(c.execute('SELECT COUNT(*) FROM DigestCache').fetchone()[0], 1)
+
+    def test_query_profiler_threads(self):
+        profiler = QueryProfiler(threshold=0)
+
+        def record():
+            for _ in range(100):
+                profiler.record('SELECT 1', (), 0.001, 0)
+
+        threads = [Thread(target=record) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        metrics = profiler.get_metrics()
+        self.assertEqual(metrics['db_queries'], 400)
+        self.assertEqual(metrics['db_slow_queries'], 400)
+
+    @Options.mock()
+    def test_query_profiler(self):
+        self.assertEqual(self._dao.get_query_stats(), [])
+        Options.db_profiling = True
+        Options.db_slow_query_threshold = 0
+        init_db = self.get_db_temp_file()
+        dao = EngineDAO(init_db.name)
+        self.addCleanup(self._clean_dao, dao)
+        dao.update_config('profiled', 'value')
+        c = dao._get_read_connection().cursor()
+        for i in range(10):
+            c.execute("SELECT * FROM States WHERE id = %d AND local_name = 'n%d'"
+                      % (i, i))
+
+        metrics = dao.get_metrics()
+        self.assertGreaterEqual(metrics['db_queries'], 11)
+        self.assertEqual(metrics['db_query_retries'], 0)
+        self.assertEqual(metrics['db_slow_queries'], metrics['db_queries'])
+        stats = dict((stats['query'], stats) for stats in dao.get_query_stats())
+        # Literals are grouped in the same template
+        select = stats['SELECT * FROM States WHERE id = ? AND local_name = ?']
+        self.assertEqual(select['calls'], 10)
+        self.assertLessEqual(select['p50'], select['p99'])
+        self.assertIn('UPDATE OR IGNORE Configuration SET value=? WHERE name=?',
+                      stats)
+
+        dao._profiler.reset()
+        self.assertEqual(dao.get_query_stats(), [])
+        self.assertEqual(dao.get_metrics()['db_queries'], 0)
+
+    def test_maintenance(self):
+        c = self._dao._get_write_connection().cursor()
+        # Converted by the VACUUM on startup
+        self.assertEqual(c.execute('PRAGMA auto_vacuum').fetchone()[0], 2)
+        init_db = self.get_db_temp_file()
+        dao = EngineDAO(init_db.name)
+        self.addCleanup(self._clean_dao, dao)
+        self.assertEqual(dao.get_last_maintenance(), 0)
+        con = dao._get_write_connection()
+        con.executemany('INSERT INTO RemoteScan (path) VALUES (?)',
+                        (('/' + 'x' * 200 + str(i),) for i in xrange(5000)))
+        con.commit()
+        con.execute('DELETE FROM RemoteScan')
+        con.commit()
+        stats = dao.get_db_stats()
+        self.assertGreater(stats['db_freelist'], 0)
+        self.assertGreater(stats['db_fragmentation'], 0)
+        self.assertEqual(dao.get_metrics()['db_freelist'], stats['db_freelist'])
+
+        stats = dao.run_maintenance()
+        self.assertEqual(stats['db_freelist'], 0)
+        self.assertEqual(stats['db_fragmentation'], 0)
+        metrics = dao.get_metrics()
+        self.assertEqual(metrics['db_maintenance_runs'], 1)
+        self.assertGreater(metrics['db_vacuumed_pages'], 0)
+        self.assertGreater(dao.get_last_maintenance(), 0)
+        c = dao._get_read_connection().cursor()
+        self.assertTrue(c.execute("SELECT * FROM sqlite_master"
+                                  " WHERE name = 'sqlite_stat1'").fetchone())
+        self.assertEqual(dao.run_maintenance(full=True)['db_wal_size'], 0)
+
+    def test_states_snapshot(self):
+        snapshot = os.path.join(self.tmpdir, 'snapshot.db')
+        self.assertEqual(self._dao.export_states(snapshot, local_folder=u'/old'), 63)
+        with self.assertRaises(ValueError):
+            self._dao.export_states(snapshot)
+
+        init_db = self.get_db_temp_file()
+        dao = EngineDAO(init_db.name)
+        self.addCleanup(self._clean_dao, dao)
+        dao.update_config('server_url', 'http://other/nuxeo/')
+        with self.assertRaises(ValueError):
+            dao.import_states(snapshot)
+        self.assertEqual(dao.get_count(), 0)
+
+        dao.update_config('server_url', 'http://localhost:8080/nuxeo/')
+        info = dao.import_states(snapshot, rebase=(u'/SmallFolder/Test', u'/Rebased'))
+        self.assertEqual(info['local_folder'], u'/old')
+        self.assertEqual((info['imported'], info['skipped']), (58, 5))
+        self.assertEqual(dao.get_count(), 58)
+        self.assertEqual(dao.get_count(condition="pair_state='synchronized'"), 58)
+        self.assertEqual(len(dao.get_states_from_partial_local('/SmallFolder/Test/')), 0)
+        folder = dao.get_state_from_local('/Rebased')
+        self.assertEqual((folder.local_parent_path, folder.local_name), ('/', 'Rebased'))
+        self.assertEqual(len(dao.get_local_children('/Rebased')), 22)
+        # Skipped states need a full remote scan
+        self.assertIsNone(dao.get_config('remote_last_event_log_id'))
+        self.assertEqual(sorted(row.id for row in dao.iter_states(size=5)),
+                         sorted(row.id for row in dao.get_states_from_partial_local('/')))
+
+        # Missing and modified files are downloaded again
+        states = list(dao.iter_states())
+        dao.update_imported_state(states[1], None)
+        self.assertEqual(dao.get_state_from_id(states[1].id).pair_state, 'remotely_created')
+        info = FileInfo(unicode(self.tmpdir), states[2].local_path, False, datetime.now())
+        dao.update_imported_state(states[2], info, digest='other')
+        self.assertEqual(dao.get_state_from_id(states[2].id).pair_state, 'remotely_modified')
+        self.assertEqual(sorted(self._get_queued_ids(dao)), [states[1].id, states[2].id])
+
+    def test_descendants_wildcards(self):
+        # LIKE wildcards in names are plain characters
+        folder = self._dao.get_state_from_local('/SmallFolder/Test')
+        self._dao.update_local_parent_path(folder, 'Te_t', '/SmallFolder')
+        self.assertEqual(len(self._dao.get_local_children('/SmallFolder/Te_t')), 22)
+        states = self._dao.get_states_from_partial_local('/SmallFolder/Te_t/')
+        self.assertEqual(len(states), 22)
+        self.assertFalse(self._dao.get_states_from_partial_local('/SmallFolder/Te%'))
+
+    def test_state_counters(self):
+        self.assertFalse(self._dao.check_state_counters())
+        c = self._dao._get_read_connection().cursor()
+
+        def count(condition):
+            return c.execute('SELECT COUNT(*) FROM States WHERE '
+                             + condition).fetchone()[0]
+
+        self.assertEqual(self._dao.get_sync_count(filetype='file'),
+                         count("pair_state='synchronized' AND folderish=0"))
+        self.assertEqual(self._dao.get_sync_count(filetype='folder'),
+                         count("pair_state='synchronized' AND folderish=1"))
+        self.assertEqual(self._dao.get_syncing_count(),
+                         count("pair_state NOT IN ('synchronized', 'conflicted',"
+                               " 'unsynchronized') AND error_count < 3"))
+        self.assertEqual(
+            self._dao.get_global_size(),
+            c.execute("SELECT SUM(size) FROM States"
+                      " WHERE pair_state='synchronized'").fetchone()[0])
+
+        # Updates, deletions and insertions are tracked
+        folder = self._dao.get_state_from_local('/SmallFolder/Test')
+        self._dao.set_conflict_state(self._dao.get_state_from_local(
+            '/SmallFolder/Test__4.txt'))
+        self._dao.mark_descendants_remotely_created(folder)
+        info = FileInfo(u'/', u'/SmallFolder/New', True, datetime.now())
+        self._dao.insert_local_state(info, u'/SmallFolder')
+        self._dao.remove_state(folder)
+        self._dao.increase_error(self._dao.get_state_from_local(
+            '/SmallFolder/IMAG0061.jpg'), 'Test')
+        self.assertEqual(self._dao.get_conflict_count(), 4)
+        self.assertFalse(self._dao.check_state_counters())
+
+        # A restart does not count the whole table again
+        con = self._dao._get_write_connection()
+        con.execute("UPDATE StateCounters SET count = count + 1")
+        con.commit()
+        self._dao.dispose()
+        self._dao = EngineDAO(self.tmp_db.name)
+        self.assertTrue(self._dao.check_state_counters())
+        self._dao.reinit_states()
+        self.assertFalse(self._dao.check_state_counters())
+        self.assertEqual(self._dao.get_sync_count(), 0)
+        self.assertIsNone(self._dao.get_global_size())
+
     def test_conflicts(self):
         self.assertEqual(self._dao.get_conflict_count(), 3)
         self.assertEqual(len(self._dao.get_conflicts()), 3)
@@ -123,6 +754,7 @@ class EngineDAOTest(unittest.TestCase):
         # Synchronize should reset error
         self.assertTrue(self._dao.synchronize_state(row))
         self.assertEqual(self._dao.get_error_count(2), 0)
+        self.assertFalse(self._dao.check_state_counters())
 
     def test_remote_scans(self):
         self.assertFalse(self._dao.is_path_scanned("/"))
@@ -204,6 +836,36 @@ class EngineDAOTest(unittest.TestCase):
         self._dao.synchronize_state(row)
         self.assertFalse(self._dao.release_processor(666))
 
+    def test_processor_leases(self):
+        self.assertTrue(self._dao.acquire_processor(666, 2))
+        self.assertTrue(self._dao.acquire_processor(666, 3))
+        self.assertEqual(self._dao.get_processor(2), 666)
+        self.assertTrue(self._dao.is_processing(3))
+        self.assertFalse(self._dao.is_processing(4))
+        self.assertEqual(self._dao.get_metrics()['db_processor_leases'], 2)
+        # Leases are not written to the database
+        self.assertEqual(self._dao.get_state_from_id(2).processor, 0)
+        # All the rows of a processor are released at once
+        self.assertTrue(self._dao.release_processor(666))
+        self.assertFalse(self._dao.is_processing(2))
+        self.assertFalse(self._dao.is_processing(3))
+
+        # Unknown rows cannot be acquired
+        with self.assertRaises(sqlite3.OperationalError):
+            self._dao.acquire_state(666, 9999)
+        self.assertFalse(self._dao.is_processing(9999))
+        self.assertEqual(self._dao.acquire_state(666, 2).id, 2)
+        with self.assertRaises(sqlite3.OperationalError):
+            self._dao.acquire_state(777, 2)
+        # A failed acquisition keeps the other rows of the processor
+        with self.assertRaises(sqlite3.OperationalError):
+            self._dao.acquire_state(666, 9999)
+        self.assertEqual(self._dao.get_processor(2), 666)
+
+        # Nothing survives a restart
+        self._dao.reinit_processors()
+        self.assertFalse(self._dao.is_processing(2))
+
     def test_configuration(self):
         result = self._dao.get_config("empty", "DefaultValue")
         self.assertEqual(result, "DefaultValue")
@@ -231,3 +893,89 @@ class EngineDAOTest(unittest.TestCase):
         self.assertEqual(len(self._dao.get_filters()), 1)
         self._dao.add_filter(u"/otherFilter")
         self.assertEqual(len(self._dao.get_filters()), 2)
+        self.assertTrue(self._dao.is_filter(u"/fakeFilter/Test_Parent/Child"))
+        self.assertTrue(self._dao.is_filter(u"/otherFilter"))
+        self.assertFalse(self._dao.is_filter(u"/otherFilterSibling"))
+        self.assertFalse(self._dao.is_filter(u"/"))
+
+        # Wildcards are plain characters
+        self._dao.add_filter(u"/a_b")
+        self._dao.add_filter(u"/axb/child")
+        self._dao.remove_filter(u"/a_b")
+        self.assertTrue(self._dao.is_filter(u"/axb/child"))
+        self.assertFalse(self._dao.is_filter(u"/a_b"))
+
+    def test_paths_to_scan(self):
+        self._dao.add_path_to_scan(u"/root/folder/sub")
+        self._dao.add_path_to_scan(u"/root/other")
+        # Scanning the ancestor covers the descendants requested before
+        self._dao.add_path_to_scan(u"/root/folder")
+        self.assertEqual(sorted(row.path for row in self._dao.get_paths_to_scan()),
+                         [u"/root/folder/", u"/root/other/"])
+        # But not the ones requested during its scan, it may be past them
+        self._dao.add_path_to_scan(u"/root/folder/sub2")
+        self._dao.delete_path_to_scan(u"/root/folder")
+        self.assertEqual(sorted(row.path for row in self._dao.get_paths_to_scan()),
+                         [u"/root/folder/sub2/", u"/root/other/"])
+        # Filtered folders are not scanned
+        self._dao.add_filter(u"/root/other")
+        self._dao.delete_path_to_scan(u"/root/folder/sub2")
+        self.assertFalse(self._dao.get_paths_to_scan())
+        self._dao.add_path_to_scan(u"/root/folder/sub")
+        self.assertEqual(len(self._dao.get_paths_to_scan()), 1)
+
+        self.assertFalse(self._dao.is_path_scanned(u"/root/folder"))
+        self._dao.add_path_scanned(u"/root/folder")
+        self.assertTrue(self._dao.is_path_scanned(u"/root/folder/"))
+        self.assertFalse(self._dao.is_path_scanned(u"/root/folder/sub"))
+
+        # The in-memory structures are loaded back at the next start
+        self._dao.dispose()
+        self._dao = EngineDAO(self.tmp_db.name)
+        self.assertTrue(self._dao.is_path_scanned(u"/root/folder"))
+        self.assertTrue(self._dao.is_filter(u"/root/other/child"))
+        self._dao.add_path_to_scan(u"/root/folder/sub/child")
+        self.assertEqual(len(self._dao.get_paths_to_scan()), 2)
+        self._dao.clean_scanned()
+        self.assertFalse(self._dao.is_path_scanned(u"/root/folder"))
+
+    def test_downloads(self):
+        path = u"/Folder 1/.File 1.txt.nxpart"
+        self.assertIsNone(self._dao.get_download(path))
+        self._dao.save_download(path, u"remote-ref", u"digest")
+        self._dao.save_download(path, u"remote-ref", u"digest", downloaded=1024)
+        download = self._dao.get_download(path)
+        self.assertEqual((download.remote_ref, download.digest, download.downloaded),
+                         (u"remote-ref", u"digest", 1024))
+        self.assertIsNotNone(download.last_update)
+        self._dao.remove_download(path)
+        self.assertIsNone(self._dao.get_download(path))
+
+    def test_uploads(self):
+        path = u"/tmp/File 1.bin"
+        self.assertIsNone(self._dao.get_upload(path))
+        self._dao.save_upload(path, u"batch", 4096, 1.5, 1024, b"\x00\x05")
+        upload = self._dao.get_upload(path)
+        self.assertEqual((upload.batch_id, upload.file_size, upload.mtime, upload.chunk_size),
+                         (u"batch", 4096, 1.5, 1024))
+        self.assertEqual(bytes(upload.chunks), b"\x00\x05")
+        self._dao.remove_upload(path)
+        self.assertIsNone(self._dao.get_upload(path))
+
+    def test_path_trie(self):
+        trie = PathTrie([u"/a/b/", u"/a/c/", u"/d/"])
+        self.assertEqual(len(trie), 3)
+        self.assertIn(u"/a/b/", trie)
+        self.assertNotIn(u"/a/", trie)
+        self.assertTrue(trie.has_ancestor(u"/a/b/c/"))
+        self.assertFalse(trie.has_ancestor(u"/a/"))
+        self.assertFalse(trie.has_ancestor(u"/a/bc/"))
+        self.assertFalse(trie.add(u"/d/"))
+        self.assertEqual(trie.discard_subtree(u"/a/"), 2)
+        self.assertEqual(trie.get_paths(), [u"/d/"])
+        trie.discard(u"/d/")
+        self.assertFalse(trie.has_ancestor(u"/d/e/"))
+        trie.add(u"/")
+        self.assertTrue(trie.has_ancestor(u"/anything/"))
+        self.assertEqual(trie.discard_subtree(u"/"), 1)
+        self.assertEqual(len(trie), 0)
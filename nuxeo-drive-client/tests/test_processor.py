@@ -0,0 +1,143 @@
+# coding: utf-8
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+
+from nxdrive.client.remote_file_system_client import RemoteFileInfo
+from nxdrive.engine.dao.sqlite import EngineDAO
+from nxdrive.engine.processor import Processor
+from nxdrive.engine.queue_manager import QueueManager
+from nxdrive.engine.workers import ThreadInterrupt
+from nxdrive.options import Options
+
+
+class LocalInfo(object):
+
+    def __init__(self, path, size):
+        self.path = path
+        self.folderish = False
+        self.size = size
+        self.last_modification_time = datetime(2017, 1, 1)
+
+    def get_digest(self):
+        return 'digest-' + os.path.basename(self.path)
+
+
+class LocalClient(object):
+    """ Local client of files that all exist, interrupting the digest checks if told so. """
+
+    def __init__(self):
+        self.remote_ids = dict()
+        self.interrupt = False
+
+    def abspath(self, path):
+        return '/sync' + path
+
+    def get_remote_id(self, path):
+        return self.remote_ids.get(path)
+
+    def set_remote_id(self, path, remote_id):
+        self.remote_ids[path] = remote_id
+
+    def get_info(self, path):
+        return LocalInfo(path, 10)
+
+    def is_equal_digests(self, local_digest, remote_digest, local_path, remote_digest_algorithm=None):
+        if self.interrupt:
+            raise ThreadInterrupt()
+        return True
+
+
+class RemoteClient(object):
+
+    def __init__(self):
+        self.uploads = []
+
+    def stream_files(self, parent_ref, files):
+        self.uploads.append([name for _, name in files])
+        return [RemoteFileInfo(name, 'ref-' + name, parent_ref, '/Folder/ref-' + name, False,
+                               datetime(2017, 1, 1), 'user', 'digest-' + name, 'md5', None,
+                               True, True, True, False, None, None, False)
+                for _, name in files]
+
+
+class Signal(object):
+
+    def connect(self, slot):
+        pass
+
+
+class Engine(object):
+    uid = 'engine'
+
+    def __init__(self, dao, queue_manager):
+        self.invalidClientsCache = Signal()
+        self._dao = dao
+        self._queue_manager = queue_manager
+
+    def get_dao(self):
+        return self._dao
+
+    def get_queue_manager(self):
+        return self._queue_manager
+
+
+class ParentPair(object):
+    remote_ref = 'folder-ref'
+    remote_parent_path = '/root'
+    remote_name = 'Folder'
+
+
+class UploadBatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(u'-nxdrive-tests')
+        self.dao = EngineDAO(os.path.join(self.folder, u'engine.db'))
+        self.manager = QueueManager(None, self.dao)
+        self.processor = Processor(Engine(self.dao, self.manager), None)
+        self.processor._thread_id = 1
+        self.local_client = LocalClient()
+        self.remote_client = RemoteClient()
+        self.row_ids = [self.dao.insert_local_state(LocalInfo(u'/Folder/' + name, 10), u'/Folder')
+                        for name in (u'main.txt', u'a.txt', u'b.txt')]
+        # The first one is being processed
+        queue = self.manager._local_file_queue
+        self.assertTrue(queue.remove(self.row_ids[0]))
+        self.doc_pair = self.dao.acquire_state(1, self.row_ids[0])
+
+    def tearDown(self):
+        self.dao.dispose()
+        shutil.rmtree(self.folder)
+
+    def upload_batch(self):
+        return self.processor._upload_batch(self.doc_pair, ParentPair(), self.local_client,
+                                            self.remote_client)
+
+    @Options.mock()
+    def test_upload_batch(self):
+        Options.batch_upload_files = 10
+        info = self.upload_batch()
+        self.assertEqual(info.uid, 'ref-main.txt')
+        self.assertEqual(self.remote_client.uploads, [['main.txt', 'a.txt', 'b.txt']])
+        for row_id in self.row_ids[1:]:
+            self.assertEqual(self.dao.get_state_from_id(row_id).pair_state, 'synchronized')
+        self.assertEqual(self.manager._local_file_queue.get_items(), [])
+
+    @Options.mock()
+    def test_interrupted_batch(self):
+        Options.batch_upload_files = 10
+        self.local_client.interrupt = True
+        self.assertRaises(ThreadInterrupt, self.upload_batch)
+        # All the created documents, the main one too, are bound to their rows
+        for row_id, name in zip(self.row_ids, (u'main.txt', u'a.txt', u'b.txt')):
+            row = self.dao.get_state_from_id(row_id)
+            self.assertEqual(row.remote_ref, 'ref-' + name)
+            self.assertEqual(self.local_client.get_remote_id(row.local_path), 'ref-' + name)
+        # The other pairs are queued again at their place, without lease
+        self.assertEqual([item.id for item in self.manager._local_file_queue.get_items()],
+                         self.row_ids[1:])
+        for row_id in self.row_ids[1:]:
+            self.assertEqual(self.dao.get_processor(row_id), 0)
+        self.assertEqual(len(self.remote_client.uploads), 1)
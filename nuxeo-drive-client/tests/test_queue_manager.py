@@ -0,0 +1,382 @@
+# coding: utf-8
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from datetime import datetime, timedelta
+
+from nxdrive.client.remote_file_system_client import RemoteFileInfo
+from nxdrive.engine.dao.sqlite import EngineDAO
+from nxdrive.engine.queue_manager import DependencyGraph, PIN_ADVANCE, \
+    ProcessorPool, QueueItem, QueueManager, QueueScheduler, \
+    RECENCY_ADVANCE, SchedulingQueue, is_creation
+
+
+def drain(queue):
+    items = []
+    while not queue.empty():
+        items.append(queue.get().id)
+    return items
+
+
+class QueueSchedulerTest(unittest.TestCase):
+
+    def test_fifo_without_policies(self):
+        queue = SchedulingQueue(QueueScheduler(policies=[]))
+        for row_id in range(5):
+            queue.put(QueueItem(row_id, False, 'locally_created', size=row_id))
+        self.assertEqual(drain(queue), [0, 1, 2, 3, 4])
+
+    def test_unknown_policy(self):
+        scheduler = QueueScheduler(policies=['size', 'unknown'])
+        self.assertEqual(scheduler.priorities, ['size', 'default'])
+
+    def test_size(self):
+        queue = SchedulingQueue(QueueScheduler(policies=['size']))
+        queue.put(QueueItem(1, False, 'remotely_created', size=500 * 1024 ** 2))
+        queue.put(QueueItem(2, True, 'remotely_created'))
+        queue.put(QueueItem(3, False, 'remotely_created', size=10))
+        queue.put(QueueItem(4, False, 'remotely_created', size=1024 ** 2))
+        self.assertEqual(drain(queue), [3, 4, 1, 2])
+
+    def test_recency(self):
+        now = datetime.utcnow()
+        queue = SchedulingQueue(QueueScheduler(policies=['recency']))
+        queue.put(QueueItem(1, False, 'locally_modified',
+                            last_local_updated=now - timedelta(hours=1)))
+        queue.put(QueueItem(2, False, 'locally_modified',
+                            last_local_updated=str(now - timedelta(minutes=5))))
+        queue.put(QueueItem(3, False, 'locally_modified', last_local_updated=now))
+        # Remote changes are not concerned
+        queue.put(QueueItem(4, False, 'remotely_modified', last_local_updated=now))
+        self.assertEqual(drain(queue), [3, 2, 1, 4])
+
+    def test_aging(self):
+        scheduler = QueueScheduler(policies=['recency'])
+        old = QueueItem(1, False, 'locally_modified')
+        recent = QueueItem(2, False, 'locally_modified',
+                           last_local_updated=datetime.utcnow())
+        # An item waiting for longer than the advance is served first
+        old_time, _ = scheduler.schedule(old, 0)
+        recent_time, priority = scheduler.schedule(recent, RECENCY_ADVANCE + 1)
+        self.assertEqual(priority, 'recency')
+        self.assertLess(old_time, recent_time)
+
+    def test_pin(self):
+        scheduler = QueueScheduler(policies=['pin', 'direct_edit', 'size'])
+        queue = SchedulingQueue(scheduler)
+        for row_id in range(1, 4):
+            queue.put(QueueItem(row_id, False, 'remotely_modified', size=10))
+        scheduler.boost(3, 'pin')
+        scheduler.boost(2, 'direct_edit')
+        queue.reschedule(3)
+        queue.reschedule(2)
+        self.assertEqual([item.id for item in queue.get_items()], [3, 2, 1])
+        self.assertEqual(drain(queue), [3, 2, 1])
+        # Pins last, other boosts are cleared once the item is processed
+        self.assertTrue(scheduler.is_boosted(3, 'pin'))
+        self.assertFalse(scheduler.is_boosted(2, 'direct_edit'))
+        scheduler.unboost(3)
+        self.assertFalse(scheduler.is_boosted(3, 'pin'))
+
+    def test_peek(self):
+        queue = SchedulingQueue(QueueScheduler(policies=['pin']))
+        self.assertIsNone(queue.peek())
+        queue.put(QueueItem(1, False, 'remotely_created'))
+        queue.scheduler.boost(2, 'pin')
+        queue.put(QueueItem(2, False, 'remotely_created'))
+        self.assertLess(queue.peek(), queue.queue[-1][0] - PIN_ADVANCE + 1)
+        self.assertEqual(queue.get().id, 2)
+
+    def test_metrics(self):
+        scheduler = QueueScheduler(policies=['pin', 'size'])
+        queue = SchedulingQueue(scheduler)
+        scheduler.boost(1, 'pin')
+        queue.put(QueueItem(1, False, 'remotely_created', size=10))
+        queue.put(QueueItem(2, False, 'remotely_created', size=10))
+        queue.put(QueueItem(3, True, 'remotely_created'))
+        metrics = scheduler.get_metrics()
+        self.assertEqual(metrics['queue_pin_depth'], 1)
+        self.assertEqual(metrics['queue_size_depth'], 1)
+        self.assertEqual(metrics['queue_default_depth'], 1)
+        drain(queue)
+        metrics = scheduler.get_metrics()
+        self.assertEqual(metrics['queue_pin_depth'], 0)
+        self.assertEqual(metrics['queue_default_depth'], 0)
+        self.assertGreaterEqual(metrics['queue_default_wait'], 0)
+
+        # A rescheduled item moves to its new priority
+        queue.put(QueueItem(4, False, 'remotely_created', size=10))
+        scheduler.boost(4, 'pin')
+        queue.reschedule(4)
+        metrics = scheduler.get_metrics()
+        self.assertEqual(metrics['queue_pin_depth'], 1)
+        self.assertEqual(metrics['queue_size_depth'], 0)
+
+
+class SchedulingQueueTest(unittest.TestCase):
+
+    def test_coalesce(self):
+        queue = SchedulingQueue(QueueScheduler(policies=[]))
+        self.assertTrue(queue.push(QueueItem(1, False, 'locally_created')))
+        self.assertTrue(queue.push(QueueItem(2, False, 'locally_created')))
+        for _ in range(100):
+            self.assertFalse(queue.push(QueueItem(1, False, 'locally_modified')))
+        self.assertEqual(queue.qsize(), 2)
+        self.assertEqual(queue.coalesced, 100)
+        self.assertEqual(queue.unfinished_tasks, 2)
+        queue.put(QueueItem(2, False, 'locally_modified'))
+        self.assertEqual(queue.unfinished_tasks, 2)
+        self.assertLessEqual(len(queue.queue),
+                             2 + SchedulingQueue.COMPACT_THRESHOLD + 1)
+        # The row keeps its place with its last state
+        item = queue.get()
+        self.assertEqual((item.id, item.pair_state), (1, 'locally_modified'))
+        self.assertEqual(queue.get().id, 2)
+        self.assertTrue(queue.empty())
+        self.assertIsNone(queue.peek())
+        self.assertEqual(queue.scheduler.get_metrics()['queue_default_depth'], 0)
+
+    def test_remove(self):
+        queue = SchedulingQueue(QueueScheduler(policies=[]))
+        queue.put(QueueItem(1, False, 'remotely_created'))
+        queue.put(QueueItem(2, False, 'remotely_created'))
+        self.assertIn(1, queue)
+        self.assertTrue(queue.remove(1))
+        self.assertFalse(queue.remove(1))
+        self.assertNotIn(1, queue)
+        self.assertEqual(queue.qsize(), 1)
+        self.assertEqual([item.id for item in queue.get_items()], [2])
+        self.assertEqual(queue.unfinished_tasks, 1)
+        self.assertEqual(queue.get().id, 2)
+        self.assertEqual(queue.scheduler.get_metrics()['queue_default_depth'], 0)
+        # Only the served item is waited for
+        queue.task_done()
+        queue.join()
+
+    def test_pop(self):
+        queue = SchedulingQueue(QueueScheduler(policies=[]))
+        self.assertIsNone(queue.pop())
+        queue.put(QueueItem(1, True, 'locally_moved'))
+        queue.put(QueueItem(2, True, 'locally_created'))
+        self.assertIsNone(queue.pop(predicate=is_creation))
+        self.assertEqual(queue.pop().id, 1)
+        self.assertEqual(queue.pop(predicate=is_creation).id, 2)
+        self.assertTrue(queue.empty())
+
+    def test_take(self):
+        queue = SchedulingQueue(QueueScheduler(policies=[]))
+        for row_id in range(1, 6):
+            queue.put(QueueItem(row_id, False, 'locally_created'))
+            # Distinct queuing times
+            time.sleep(0.001)
+        items = queue.take(lambda item: item.id % 2, 2)
+        self.assertEqual([item.id for item, _ in items], [1, 3])
+        self.assertEqual(queue.qsize(), 3)
+        self.assertNotIn(1, queue)
+        # An item left out of a batch goes back to its former place
+        item, queued_at = items[1]
+        self.assertTrue(queue.restore(item, queued_at))
+        self.assertFalse(queue.restore(item, queued_at))
+        self.assertEqual(drain(queue), [2, 3, 4, 5])
+        self.assertEqual(queue.scheduler.get_metrics()['queue_default_depth'], 0)
+
+
+class DependencyGraphTest(unittest.TestCase):
+
+    @staticmethod
+    def item(row_id, path, folderish=True, pair_state='locally_created'):
+        return QueueItem(row_id, folderish, pair_state, local_path=path)
+
+    def test_children_wait_for_parent(self):
+        graph = DependencyGraph()
+        self.assertIsNone(graph.add(self.item(1, '/a')))
+        self.assertIsNone(graph.add(self.item(2, '/b')))
+        self.assertEqual(graph.add(self.item(3, '/a/c')), 1)
+        self.assertEqual(graph.add(self.item(4, '/a/c/d.txt', False)), 3)
+        self.assertEqual(graph.add(self.item(5, '/a/e.txt', False,
+                                             'locally_modified')), 1)
+        self.assertIsNone(graph.add(self.item(6, '/f.txt', False)))
+        self.assertIsNone(graph.add(QueueItem(7, False, 'locally_created')))
+        self.assertTrue(graph.is_held(4))
+        self.assertEqual(graph.get_metrics(),
+                         {'dependency_nodes': 3, 'dependency_held': 3})
+
+        # Released level by level
+        self.assertEqual([item.id for item in graph.done(1)], [3, 5])
+        self.assertIsNone(graph.add(self.item(3, '/a/c')))
+        self.assertIsNone(graph.add(self.item(5, '/a/e.txt', False)))
+        self.assertTrue(graph.is_held(4))
+        self.assertEqual([item.id for item in graph.done(3)], [4])
+        self.assertIsNone(graph.add(self.item(4, '/a/c/d.txt', False)))
+        self.assertEqual(graph.done(2), [])
+        self.assertEqual(graph.get_metrics(),
+                         {'dependency_nodes': 0, 'dependency_held': 0})
+
+    def test_ancestor(self):
+        graph = DependencyGraph()
+        graph.add(QueueItem(1, True, 'remotely_created', local_path='/a'))
+        # The parent is not pushed yet, the closest creation holds the row
+        item = QueueItem(2, False, 'remotely_created', local_path='/a/b/c',
+                         local_parent_path='/a/b')
+        self.assertEqual(graph.add(item), 1)
+
+    def test_push_again(self):
+        graph = DependencyGraph()
+        graph.add(self.item(1, '/a'))
+        graph.add(self.item(2, '/a/b.txt', False))
+        # The last push of a row replaces the held one
+        self.assertEqual(graph.add(self.item(2, '/a/b.txt', False,
+                                             'locally_modified')), 1)
+        held = graph.done(1)
+        self.assertEqual([(item.id, item.pair_state) for item in held],
+                         [(2, 'locally_modified')])
+        self.assertFalse(graph.is_held(2))
+
+
+class ProcessorPoolTest(unittest.TestCase):
+
+    def adjust(self, pool, pending, transfers=0, speed=0, failures=0):
+        """ Simulate a period with transfers of 1s at `speed` B/s. """
+        for _ in range(transfers):
+            pool.record_transfer(speed, 1)
+        for _ in range(failures):
+            pool.record_failure()
+        self._now += 10
+        pool.adjust(pending, now=self._now)
+        return pool.size
+
+    def setUp(self):
+        self._now = 0
+
+    def new_pool(self, minimum=0, maximum=18, size=3):
+        pool = ProcessorPool(minimum, maximum, size, interval=10)
+        pool._start = self._now
+        return pool
+
+    def test_fixed(self):
+        pool = self.new_pool(3, 3, 5)
+        self.assertFalse(pool.is_adaptive())
+        self.assertEqual(self.adjust(pool, 100), 3)
+
+    def test_interval(self):
+        pool = self.new_pool()
+        self.assertFalse(pool.adjust(100, now=5))
+        self.assertEqual(pool.size, 3)
+        self.assertTrue(pool.adjust(100, now=10))
+        self.assertEqual(pool.size, 4)
+
+    def test_additive_increase(self):
+        pool = self.new_pool()
+        for size in range(4, 19):
+            self.assertEqual(self.adjust(pool, 100, transfers=size, speed=1000), size)
+        # Within the bounds
+        self.assertEqual(self.adjust(pool, 100, transfers=20, speed=1000), 18)
+        # Not more processors than files waiting
+        pool = self.new_pool()
+        self.assertEqual(self.adjust(pool, 2, transfers=3, speed=1000), 3)
+        metrics = pool.get_metrics()
+        self.assertEqual(metrics['processors_decision'], ProcessorPool.HOLD)
+        self.assertEqual(metrics['processors_limit'], 3)
+
+    def test_multiplicative_decrease(self):
+        pool = self.new_pool(minimum=1, size=16)
+        self.assertEqual(self.adjust(pool, 100, transfers=5, failures=5), 8)
+        self.assertEqual(self.adjust(pool, 100, failures=1), 4)
+        self.assertEqual(self.adjust(pool, 100, failures=3), 2)
+        self.assertEqual(self.adjust(pool, 100, failures=3), 1)
+        self.assertEqual(self.adjust(pool, 100, failures=3), 1)
+        metrics = pool.get_metrics()
+        self.assertEqual(metrics['processors_decreases'], 4)
+        self.assertEqual(metrics['processors_error_rate'], 100)
+
+    def test_throughput_drop(self):
+        pool = self.new_pool()
+        self.assertEqual(self.adjust(pool, 100, transfers=10, speed=1000), 4)
+        # The new processor slowed down the transfers
+        self.assertEqual(self.adjust(pool, 100, transfers=5, speed=1000), 3)
+        self.assertEqual(pool.get_metrics()['processors_decision'],
+                         ProcessorPool.DECREASE)
+        # Then hold while the throughput does not recover
+        self.assertEqual(self.adjust(pool, 100, transfers=4, speed=1000), 3)
+        self.assertEqual(self.adjust(pool, 100, transfers=4, speed=1000), 4)
+        metrics = pool.get_metrics()
+        self.assertEqual(metrics['processors_throughput'], 400)
+        self.assertEqual(metrics['processors_transfer_speed'], 1000)
+
+
+class QueueManagerDAOTest(unittest.TestCase):
+    """ Pushes of the rows written by an EngineDAO, with their StateRow pairs. """
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(u'-nxdrive-tests')
+        self.dao = EngineDAO(os.path.join(self.folder, u'engine.db'))
+        self.manager = QueueManager(None, self.dao)
+
+    def tearDown(self):
+        self.dao.dispose()
+        shutil.rmtree(self.folder)
+
+    def insert_remote(self, name, folderish, local_parent_path):
+        info = RemoteFileInfo(name, name + '-ref', 'root-ref', '/' + name, folderish,
+                              datetime(2017, 1, 1), 'user', None if folderish else 'digest',
+                              None if folderish else 'md5', None, True, True, True,
+                              folderish, None, None, False)
+        local_path = local_parent_path.rstrip('/') + '/' + name
+        row_id = self.dao.insert_remote_state(info, '/root', local_path, local_parent_path)
+        return self.dao.get_state_from_id(row_id)
+
+    def test_state_row_pushes(self):
+        row = self.insert_remote(u'File.txt', False, u'/')
+        queue = self.manager._remote_file_queue
+        self.assertEqual([item.id for item in queue.get_items()], [row.id])
+        item = queue.get_items()[0]
+        self.assertEqual((item.local_path, item.local_parent_path), (u'/File.txt', u'/'))
+        self.assertEqual(item.last_local_updated, None)
+        # Other writes pushing a StateRow
+        self.dao.reset_error(row)
+        self.assertTrue(self.dao.force_remote(self.dao.get_state_from_id(row.id)))
+        self.assertEqual([(item.id, item.pair_state) for item in queue.get_items()],
+                         [(row.id, 'remotely_modified')])
+
+    def test_error_retry(self):
+        row = self.insert_remote(u'File.txt', False, u'/')
+        queue = self.manager._remote_file_queue
+        self.assertTrue(queue.remove(row.id))
+        con = self.dao._get_write_connection()
+        con.execute("UPDATE States SET size = 42, last_local_updated = ? WHERE id = ?",
+                    (datetime(2017, 1, 2), row.id))
+        con.commit()
+        row = self.dao.get_state_from_id(row.id)
+        self.manager.push_error(row, interval=0)
+        self.assertEqual(queue.get_items(), [])
+        # Retried with what the scheduling policies need
+        self.manager._on_error_timer()
+        item = queue.get_items()[0]
+        self.assertEqual((item.id, item.size), (row.id, 42))
+        self.assertEqual(item.last_local_updated, row.last_local_updated)
+        self.assertIsNotNone(item.last_local_updated)
+        self.assertEqual((item.local_path, item.local_parent_path), (u'/File.txt', u'/'))
+
+    def test_dependencies(self):
+        folder = self.insert_remote(u'Folder', True, u'/')
+        other = self.insert_remote(u'Other', True, u'/')
+        child = self.insert_remote(u'File.txt', False, u'/Folder')
+        # The child is held until its parent folder is created
+        self.assertTrue(self.manager._dependencies.is_held(child.id))
+        self.assertEqual(self.manager.get_metrics()['dependency_held'], 1)
+        self.assertEqual(self.manager._remote_file_queue.get_items(), [])
+        # Pushing it again, after a reset of its error, keeps it held
+        self.dao.reset_error(child)
+        self.assertTrue(self.manager._dependencies.is_held(child.id))
+        self.assertEqual(self.manager._remote_file_queue.get_items(), [])
+
+        # Both folders can be created in parallel
+        self.assertEqual(self.manager._dispatch(self.manager._get_folder_creation).id, folder.id)
+        self.assertEqual(self.manager._get_folder_creation().id, other.id)
+        # The child is released once its parent is over
+        self.assertIsNone(self.manager._dispatch(lambda: None))
+        self.assertFalse(self.manager._dependencies.is_held(child.id))
+        self.assertEqual([item.id for item in self.manager._remote_file_queue.get_items()],
+                         [child.id])
@@ -470,6 +470,27 @@ class TestRemoteFileSystemClient(UnitTestCase):
         self.assertEqual(fs_item_info.digest,
                          local_client.get_info('/testFile.pdf').get_digest())
 
+    def test_streaming_upload_batch(self):
+        remote_client = self.remote_file_system_client_1
+
+        files = []
+        for i in range(3):
+            file_path = os.path.join(self.upload_tmp_dir, 'file_%d.txt' % i)
+            with open(file_path, 'wb') as f:
+                f.write('Content of file %d.' % i)
+            files.append((file_path, 'Batch file %d.txt' % i))
+        # A missing file fails alone
+        files.append((os.path.join(self.upload_tmp_dir, 'missing.txt'),
+                      'missing.txt'))
+
+        results = remote_client.stream_files(self.workspace_id, files)
+        self.assertEqual(len(results), 4)
+        for i, fs_item_info in enumerate(results[:3]):
+            self.assertEqual(fs_item_info.name, 'Batch file %d.txt' % i)
+            self.assertEqual(remote_client.get_content(fs_item_info.uid),
+                             'Content of file %d.' % i)
+        self.assertIsInstance(results[3], OSError)
+
     def test_bad_mime_type(self):
         remote_client = self.remote_file_system_client_1
 
@@ -0,0 +1,126 @@
+# coding: utf-8
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from threading import Thread
+
+from nxdrive.client.base_automation_client import BaseAutomationClient, \
+    CorruptedFile
+
+CONTENT = ''.join(chr(i % 256) for i in xrange(100 * 1024))
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """ Serve CONTENT, honoring the Range headers unless told otherwise. """
+
+    ranges = []
+    accept_ranges = True
+    # Start of the served range when it should not be the requested one
+    range_start = None
+
+    def do_GET(self):
+        range_ = self.headers.getheader('Range')
+        self.ranges.append(range_)
+        if range_ is None or not self.accept_ranges:
+            self.send_response(200)
+            body = CONTENT
+        else:
+            start = int(range_[len('bytes='):-1])
+            if self.range_start is not None:
+                start = self.range_start
+            if start >= len(CONTENT):
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%d' % len(CONTENT))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, len(CONTENT) - 1, len(CONTENT)))
+            body = CONTENT[start:]
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class NoAccessCheckClient(BaseAutomationClient):
+
+    def check_access(self):
+        pass
+
+
+class ResumeDownloadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), RangeHandler)
+        self.server_thread = Thread(target=self.server.serve_forever)
+        self.server_thread.start()
+        self.url = 'http://127.0.0.1:%d/' % self.server.server_port
+        self.client = NoAccessCheckClient(self.url, 'Administrator', 'device', '1.0',
+                                          password='Administrator', proxies={})
+        self.folder = tempfile.mkdtemp(u'-nxdrive-tests')
+        self.file_out = os.path.join(self.folder, u'.file.txt.nxpart')
+        self.digest = hashlib.md5(CONTENT).hexdigest()
+        RangeHandler.ranges = []
+        RangeHandler.accept_ranges = True
+        RangeHandler.range_start = None
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.server_thread.join()
+        shutil.rmtree(self.folder)
+
+    def write_partial(self, data):
+        with open(self.file_out, 'wb') as f:
+            f.write(data)
+
+    def download(self):
+        self.client.do_get(self.url + 'file', file_out=self.file_out,
+                           digest=self.digest, resume=True)
+        with open(self.file_out, 'rb') as f:
+            return f.read()
+
+    def test_resume(self):
+        self.write_partial(CONTENT[:1000])
+        self.assertEqual(self.download(), CONTENT)
+        self.assertEqual(RangeHandler.ranges, ['bytes=1000-'])
+
+    def test_no_partial_file(self):
+        self.assertEqual(self.download(), CONTENT)
+        self.assertEqual(RangeHandler.ranges, [None])
+
+    def test_range_ignored(self):
+        RangeHandler.accept_ranges = False
+        self.write_partial(CONTENT[:1000])
+        self.assertEqual(self.download(), CONTENT)
+
+    def test_other_range(self):
+        # A part not starting at the partial file size is not appended
+        RangeHandler.range_start = 500
+        self.write_partial(CONTENT[:1000])
+        self.assertEqual(self.download(), CONTENT)
+        self.assertEqual(RangeHandler.ranges, ['bytes=1000-', None])
+
+    def test_range_not_satisfiable(self):
+        self.write_partial(CONTENT + 'garbage')
+        self.assertEqual(self.download(), CONTENT)
+        self.assertEqual(RangeHandler.ranges, ['bytes=%d-' % (len(CONTENT) + 7), None])
+
+    def test_corrupted_partial_file(self):
+        # The prefix is hashed again, a wrong one fails the digest check
+        self.write_partial('x' * 1000)
+        self.assertRaises(CorruptedFile, self.download)
+        self.assertFalse(os.path.exists(self.file_out))
+        # And the next attempt starts over
+        self.assertEqual(self.download(), CONTENT)
+
+    def test_no_resume(self):
+        self.write_partial('x' * 1000)
+        self.client.do_get(self.url + 'file', file_out=self.file_out, digest=self.digest)
+        self.assertEqual(RangeHandler.ranges, [None])
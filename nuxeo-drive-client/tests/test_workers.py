@@ -0,0 +1,57 @@
+# coding: utf-8
+import unittest
+from time import sleep, time
+
+from nxdrive.engine.workers import PollWorker
+
+
+class CountingPollWorker(PollWorker):
+
+    def __init__(self):
+        super(CountingPollWorker, self).__init__(3600)
+        self.polls = 0
+
+    def _poll(self):
+        self.polls += 1
+        return True
+
+
+def wait_for(condition, timeout=5):
+    end = time() + timeout
+    while not condition() and time() < end:
+        sleep(0.01)
+    return condition()
+
+
+class WorkerWakeupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.worker = CountingPollWorker()
+        self.worker.start()
+        self.assertTrue(wait_for(lambda: self.worker.polls == 1))
+
+    def tearDown(self):
+        self.worker.stop()
+
+    def test_force_poll(self):
+        start = time()
+        self.worker.force_poll()
+        self.assertTrue(wait_for(lambda: self.worker.polls == 2))
+        self.assertLess(time() - start, 0.5)
+
+    def test_stop(self):
+        start = time()
+        self.worker.stop()
+        self.assertFalse(self.worker.get_thread().isRunning())
+        self.assertLess(time() - start, 0.5)
+
+    def test_wake(self):
+        worker = CountingPollWorker()
+        # A wake-up done before the wait is not lost
+        worker.wake()
+        start = time()
+        worker._wait(5)
+        self.assertLess(time() - start, 0.5)
+        start = time()
+        worker._wait(0.2)
+        self.assertGreaterEqual(time() - start, 0.15)
@@ -0,0 +1,44 @@
+# coding: utf-8
+"""
+Compare EngineDAO.is_filter() with the previous scan of every filter.
+
+Usage (from the nuxeo-drive-client folder):
+    python ../tools/benchmark/dao_filters.py [filters]
+"""
+import os
+import sys
+import tempfile
+import timeit
+
+from nxdrive.engine.dao.sqlite import EngineDAO
+
+ROOT = '/org.nuxeo.drive.service.impl.DefaultTopLevelFolderItemFactory#/'
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    dao = EngineDAO(os.path.join(tempfile.mkdtemp(), 'filters.db'))
+    for i in xrange(count):
+        dao.add_filter(ROOT + 'defaultSyncRootFolderItemFactory#default#%d/'
+                       'folder_%d' % (i % 10, i))
+    filters = dao.get_filters()
+    paths = [ROOT + 'defaultSyncRootFolderItemFactory#default#%d/folder_%d/'
+             'sub/file_%d' % (i % 10, i * 7, i) for i in xrange(1000)]
+
+    def legacy():
+        for path in paths:
+            any([path.startswith(f.path) for f in filters])
+
+    def trie():
+        for path in paths:
+            dao.is_filter(path)
+
+    for label, func in (('list of filters', legacy), ('PathTrie', trie)):
+        duration = timeit.timeit(func, number=10) / 10
+        print '%-20s %d filters, 1000 paths: %8.3f ms' % (
+            label, count, duration * 1000)
+    dao.dispose()
+
+
+if __name__ == '__main__':
+    main()
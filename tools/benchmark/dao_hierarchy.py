@@ -0,0 +1,103 @@
+# coding: utf-8
+"""
+Compare the hierarchy queries of the EngineDAO with the previous LIKE ones.
+
+Usage (from the nuxeo-drive-client folder):
+    python ../tools/benchmark/dao_hierarchy.py [rows] [database]
+"""
+import os
+import sys
+import tempfile
+import timeit
+
+from nxdrive.engine.dao.sqlite import EngineDAO
+
+FOLDERS_PER_LEVEL = 10
+FILES_PER_FOLDER = 100
+ROOT_REF = 'root'
+
+
+def generate_states(rows):
+    """ Yield States rows of a balanced tree until `rows` rows are generated. """
+
+    count = 0
+    level = [('', '', ROOT_REF)]
+    while count < rows:
+        next_level = []
+        for local_path, remote_path, ref in level:
+            for i in range(FILES_PER_FOLDER + FOLDERS_PER_LEVEL):
+                if count >= rows:
+                    return
+                folderish = i < FOLDERS_PER_LEVEL
+                name = ('folder_%d' if folderish else 'file_%d.txt') % i
+                child_ref = '%s-%d' % (ref, i)
+                yield (local_path + '/' + name, local_path or '/', name,
+                       child_ref, ref, remote_path + '/' + ref, name,
+                       int(folderish), 'synchronized', 'synchronized',
+                       'synchronized')
+                if folderish:
+                    next_level.append((local_path + '/' + name,
+                                       remote_path + '/' + ref, child_ref))
+                count += 1
+        level = next_level
+
+
+def fill(dao, rows):
+    con = dao._get_write_connection()
+    con.executemany(
+        'INSERT INTO States (local_path, local_parent_path, local_name,'
+        ' remote_ref, remote_parent_ref, remote_parent_path, remote_name,'
+        ' folderish, local_state, remote_state, pair_state)'
+        ' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', generate_states(rows))
+    con.commit()
+
+
+def bench(label, func, number=10):
+    duration = timeit.timeit(func, number=number) / number
+    print '%-40s %10.3f ms' % (label, duration * 1000)
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    db = sys.argv[2] if len(sys.argv) > 2 else os.path.join(
+        tempfile.mkdtemp(), 'hierarchy.db')
+    dao = EngineDAO(db)
+    if not dao.get_count():
+        print 'Generating %d rows in %r' % (rows, db)
+        fill(dao, rows)
+
+    folder = dao.get_state_from_local('/folder_1/folder_2')
+    remote_path = folder.remote_parent_path + '/' + folder.remote_ref
+    c = dao._get_read_connection().cursor()
+
+    print 'Descendants of %r: %d' % (folder.local_path,
+                                     len(dao.get_remote_descendants(remote_path)))
+    bench('get_remote_descendants',
+          lambda: dao.get_remote_descendants(remote_path))
+    bench('LIKE remote_parent_path',
+          lambda: c.execute('SELECT * FROM States WHERE remote_parent_path'
+                            ' LIKE ?', (remote_path + '%',)).fetchall())
+    bench('get_remote_descendants_from_ref',
+          lambda: dao.get_remote_descendants_from_ref(folder.remote_ref))
+    bench('LIKE %ref%',
+          lambda: c.execute('SELECT * FROM States WHERE remote_parent_path'
+                            ' LIKE ?', ('%' + folder.remote_ref + '%',)).fetchall())
+    bench('get_states_from_partial_local',
+          lambda: dao.get_states_from_partial_local(folder.local_path + '/'))
+    bench('LIKE local_path',
+          lambda: c.execute('SELECT * FROM States WHERE local_path LIKE ?',
+                            (folder.local_path + '/%',)).fetchall())
+
+    def move():
+        # Rename back and forth to keep the tree stable
+        dao.update_local_parent_path(folder, 'renamed', '/folder_1')
+        moved = dao.get_state_from_id(folder.id)
+        moved.local_path = '/folder_1/renamed'
+        dao.update_local_parent_path(moved, 'folder_2', '/folder_1')
+    bench('update_local_parent_path (x2)', move, number=3)
+
+    dao.dispose()
+
+
+if __name__ == '__main__':
+    main()
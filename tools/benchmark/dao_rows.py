@@ -0,0 +1,90 @@
+# coding: utf-8
+"""
+Compare the slotted StateRow with the previous sqlite3.Row based one.
+
+Usage (from the nuxeo-drive-client folder):
+    python ../tools/benchmark/dao_rows.py [rows]
+"""
+import gc
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+import psutil
+
+from nxdrive.engine.dao.sqlite import EngineDAO, StateRow
+
+
+class LegacyStateRow(sqlite3.Row):
+    """ StateRow as it was before being slotted. """
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except IndexError:
+            raise IndexError('No key with that name.', locals())
+
+
+def fill(dao, rows):
+    con = dao._get_write_connection()
+    con.executemany(
+        'INSERT INTO States (local_path, local_parent_path, local_name,'
+        ' remote_ref, remote_parent_ref, remote_parent_path, remote_name,'
+        ' folderish, last_local_updated, local_state, remote_state,'
+        ' pair_state) VALUES (?, ?, ?, ?, ?, ?, ?, 0, ?, ?, ?, ?)',
+        (('/folder/file_%d.txt' % i, '/folder', 'file_%d.txt' % i,
+          'ref-%d' % i, 'root', '/root', 'file_%d.txt' % i,
+          '2017-11-22 10:00:00', 'synchronized', 'synchronized',
+          'synchronized') for i in xrange(rows)))
+    con.commit()
+
+
+def scan(children):
+    """ Attribute accesses of LocalWatcher._scan_recursive() on known children. """
+    by_name = dict((child.local_name, child) for child in children)
+    updated = 0
+    for name, child in by_name.iteritems():
+        if (child.last_local_updated is not None
+                and child.last_local_updated.split('.')[0] != '2017-11-22 10:00:01'
+                and child.remote_ref is not None
+                and child.pair_state == 'synchronized'
+                and not child.folderish):
+            child.local_state = 'modified'
+            updated += 1
+    return updated
+
+
+def bench(db, factory):
+    dao = EngineDAO(db, state_factory=factory)
+    process = psutil.Process(os.getpid())
+    gc.collect()
+    rss = process.memory_info().rss
+    start = time.clock()
+    children = dao.get_local_children('/folder')
+    fetched = time.clock()
+    scan(children)
+    scanned = time.clock()
+    memory = process.memory_info().rss - rss
+    print '%-16s get_local_children %7.1f ms  scan %7.1f ms  rss +%6.1f MiB' % (
+        factory.__name__, (fetched - start) * 1000, (scanned - fetched) * 1000,
+        memory / 1024.0 / 1024.0)
+    del children
+    dao.dispose()
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    db = os.path.join(tempfile.mkdtemp(), 'rows.db')
+    dao = EngineDAO(db)
+    print 'Generating %d rows in %r' % (rows, db)
+    fill(dao, rows)
+    dao.dispose()
+    for _ in range(2):
+        bench(db, LegacyStateRow)
+        bench(db, StateRow)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+# coding: utf-8
+"""
+Compare the CPU used by idle workers, with the previous 10 ms polling loop
+and with the wake-up based one.
+
+Usage (from the nuxeo-drive-client folder):
+    python ../tools/benchmark/worker_idle.py [workers] [seconds]
+"""
+import os
+import sys
+import time
+
+import psutil
+from PyQt4.QtCore import QCoreApplication
+
+from nxdrive.engine.workers import DummyWorker, ThreadInterrupt
+
+
+class LegacyDummyWorker(DummyWorker):
+    """ DummyWorker as it was before the wake-ups. """
+
+    def _interact(self):
+        QCoreApplication.processEvents()
+        while self._pause and self._continue:
+            QCoreApplication.processEvents()
+            time.sleep(0.01)
+        if not self._continue:
+            raise ThreadInterrupt()
+
+    def _execute(self):
+        while True:
+            self._interact()
+            time.sleep(0.01)
+
+
+class CountingMixin(object):
+    """ Count the iterations of the worker loop. """
+
+    loops = 0
+
+    def _interact(self):
+        self.loops += 1
+        super(CountingMixin, self)._interact()
+
+
+def bench(factory, count, duration):
+    workers = [type(factory.__name__, (CountingMixin, factory), {})()
+               for _ in range(count)]
+    for worker in workers:
+        worker.get_thread().started.connect(worker.run)
+        worker.start()
+    process = psutil.Process(os.getpid())
+    time.sleep(0.5)
+    loops = sum(worker.loops for worker in workers)
+    cpu = process.cpu_times()
+    time.sleep(duration)
+    used = process.cpu_times()
+    loops = sum(worker.loops for worker in workers) - loops
+    for worker in workers:
+        worker.stop()
+    cpu_time = (used.user - cpu.user) + (used.system - cpu.system)
+    print '%-18s cpu %5.1f%%  wake-ups %8.1f/s' % (
+        factory.__name__, cpu_time * 100 / duration, float(loops) / duration)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    duration = float(sys.argv[2]) if len(sys.argv) > 2 else 10
+    app = QCoreApplication(sys.argv)
+    print '%d idle workers during %gs' % (count, duration)
+    bench(LegacyDummyWorker, count, duration)
+    bench(DummyWorker, count, duration)
+    del app
+
+
+if __name__ == '__main__':
+    main()